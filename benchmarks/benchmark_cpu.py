@@ -0,0 +1,193 @@
+"""CPU micro-benchmarks of the local hot paths of the wrapper, no API call is made.
+
+    # run and print the timings
+    python benchmarks/benchmark_cpu.py
+    # store the timings of this machine as the baseline
+    python benchmarks/benchmark_cpu.py --save_baseline
+    # fail (exit code 1) if a benchmark is more than 20% slower than the baseline, or
+    # (exit code 2) if there is no baseline yet
+    python benchmarks/benchmark_cpu.py --compare --tolerance 0.2
+
+Baselines depend on the machine, store them on the machine running the comparison.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trex import DetectionBatch, TRex2APIWrapper, visualize  # noqa: E402
+from trex.image import encode_image  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+IMAGE_SIZES = {
+    "vga": (640, 480),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+BOX_COUNTS = (10, 1000, 100000)
+# (image size, number of boxes) of the visualization benchmarks
+VISUALIZE_CASES = (("vga", 10), ("1080p", 1000), ("8k", 100000))
+
+
+def make_objects(num_boxes: int, image_size, num_images: int = 4, seed: int = 0):
+    """Synthetic objects as returned by the API, split over `num_images` images."""
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    top_left = rng.uniform(0, 1, (num_boxes, 2)) * [width * 0.9, height * 0.9]
+    sizes = rng.uniform(0.01, 0.1, (num_boxes, 2)) * [width, height]
+    boxes = np.concatenate([top_left, top_left + sizes], axis=1).tolist()
+    scores = rng.uniform(0, 1, num_boxes).tolist()
+    labels = rng.integers(1, 4, num_boxes).tolist()
+    objects = [
+        SimpleNamespace(bbox=box, score=score, category_id=label)
+        for box, score, label in zip(boxes, scores, labels)
+    ]
+    bounds = np.linspace(0, num_boxes, num_images + 1).astype(int)
+    return [objects[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def make_image(image_size, seed: int = 0) -> np.ndarray:
+    """Synthetic image with smooth gradients and noise, so PNG compression has work."""
+    width, height = image_size
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    image = (xs[None, :, None] + ys[:, None, None]) / 2 + rng.normal(0, 8, (height, 1, 3))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def build_benchmarks(quick: bool):
+    """Return {name: (setup, func)}, `setup` builds the inputs outside of the timing."""
+    # postprocess does not use the clients, skip creating them
+    trex2 = TRex2APIWrapper.__new__(TRex2APIWrapper)
+    box_counts = BOX_COUNTS[:-1] if quick else BOX_COUNTS
+    image_sizes = list(IMAGE_SIZES)[:-1] if quick else list(IMAGE_SIZES)
+    visualize_cases = VISUALIZE_CASES[:-1] if quick else VISUALIZE_CASES
+    benchmarks = {}
+    for num_boxes in box_counts:
+        benchmarks[f"postprocess[{num_boxes}]"] = (
+            lambda n=num_boxes: make_objects(n, IMAGE_SIZES["1080p"]),
+            trex2.postprocess,
+        )
+        benchmarks[f"threshold_filter[{num_boxes}]"] = (
+            lambda n=num_boxes: trex2.postprocess(make_objects(n, IMAGE_SIZES["1080p"])),
+            lambda results: DetectionBatch.from_results(results).filter(0.3).to_list(),
+        )
+    for name in image_sizes:
+        benchmarks[f"encode_png[{name}]"] = (
+            lambda size=IMAGE_SIZES[name]: make_image(size),
+            lambda image: encode_image(image, "PNG"),
+        )
+    for name, num_boxes in visualize_cases:
+        size = IMAGE_SIZES[name]
+
+        def setup(size=size, num_boxes=num_boxes):
+            # the demos visualize the arrays of a filtered DetectionBatch
+            result = trex2.postprocess_batch(make_objects(num_boxes, size, num_images=1))[0]
+            return Image.fromarray(make_image(size)), result
+
+        benchmarks[f"visualize[{name},{num_boxes}]"] = (
+            setup,
+            # visualize draws in place, draw on a copy
+            lambda inputs: visualize(inputs[0].copy(), inputs[1], draw_score=True),
+        )
+    return benchmarks
+
+
+def measure(setup, func, min_time: float, min_rounds: int, max_rounds: int):
+    """Time `func` on the inputs of `setup` for at least `min_rounds` rounds and
+    `min_time` seconds.
+
+    Returns:
+        dict: min and median seconds per call and the number of rounds.
+    """
+    inputs = setup()
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < max_rounds and (len(timings) < min_rounds
+                                         or time.perf_counter() - start < min_time):
+        begin = time.perf_counter()
+        func(inputs)
+        timings.append(time.perf_counter() - begin)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "rounds": len(timings),
+    }
+
+
+def compare(results, baseline, tolerance: float):
+    """Return the names of the benchmarks whose min time regressed beyond `tolerance`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["min"] / baseline[name]["min"]
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+        print(f"  {name:<32} {ratio:6.2f}x baseline"
+              f"{'  REGRESSION' if name in regressions else ''}")
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="CPU micro-benchmarks")
+    parser.add_argument("--filter", type=str, default="",
+                        help="only run the benchmarks whose name contains this string")
+    parser.add_argument("--quick", action="store_true", help="skip the largest inputs")
+    parser.add_argument("--min_time", type=float, default=0.5,
+                        help="minimum seconds spent in each benchmark")
+    parser.add_argument("--min_rounds", type=int, default=3)
+    parser.add_argument("--max_rounds", type=int, default=1000)
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE,
+                        help="path of the baseline file")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="store the timings as the baseline")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare with the baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown relative to the baseline, 0.2 is 20%%")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.compare and not args.save_baseline and not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save_baseline first on this "
+              "machine", file=sys.stderr)
+        sys.exit(2)
+    results = {}
+    for name, (setup, func) in build_benchmarks(args.quick).items():
+        if args.filter not in name:
+            continue
+        results[name] = measure(setup, func, args.min_time, args.min_rounds, args.max_rounds)
+        result = results[name]
+        print(f"{name:<34} min {result['min'] * 1e3:10.3f} ms  median "
+              f"{result['median'] * 1e3:10.3f} ms  ({result['rounds']} rounds)")
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Comparison with {args.baseline}, tolerance {args.tolerance:.0%}:")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
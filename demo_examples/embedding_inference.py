@@ -1,10 +1,9 @@
 import argparse
 import os
 
-import numpy as np
 from PIL import Image
 
-from trex import TRex2APIWrapper, visualize
+from trex import DetectionBatch, TRex2APIWrapper, visualize
 
 
 def get_args():
@@ -40,18 +39,7 @@ if __name__ == "__main__":
     ]
     results = trex2.embedding_inference(prompts)
     # filter out the boxes with low score
-    filtered_results = []
-    for result in results:
-        scores = np.array(result["scores"])
-        labels = np.array(result["labels"])
-        boxes = np.array(result["boxes"])
-        filter_mask = scores > args.box_threshold
-        filtered_result = {
-            "scores": scores[filter_mask],
-            "labels": labels[filter_mask],
-            "boxes": boxes[filter_mask],
-        }
-        filtered_results.append(filtered_result)
+    filtered_results = DetectionBatch.from_results(results).filter(args.box_threshold)
     # visualize the results
     if not os.path.exists(args.vis_dir):
         os.makedirs(args.vis_dir)
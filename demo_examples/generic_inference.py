@@ -1,10 +1,7 @@
 import argparse
 import os
 
-import numpy as np
-from PIL import Image
-
-from trex import TRex2APIWrapper, visualize
+from trex import DetectionBatch, ImageHandle, TRex2APIWrapper, visualize
 
 
 def get_args():
@@ -29,7 +26,7 @@ def get_args():
 if __name__ == "__main__":
     args = get_args()
     trex2 = TRex2APIWrapper(args.token)
-    target_image = "assets/trex2_api_examples/generic_target.jpg"
+    target_image = ImageHandle("assets/trex2_api_examples/generic_target.jpg")
     prompts = [
         {
             "prompt_image": "assets/trex2_api_examples/generic_prompt1.jpg",
@@ -42,19 +39,10 @@ if __name__ == "__main__":
     ]
     result = trex2.generic_inference(target_image, prompts)
     # filter out the boxes with low score
-    scores = np.array(result["scores"])
-    labels = np.array(result["labels"])
-    boxes = np.array(result["boxes"])
-    filter_mask = scores > args.box_threshold
-    filtered_result = {
-        "scores": scores[filter_mask],
-        "labels": labels[filter_mask],
-        "boxes": boxes[filter_mask],
-    }
+    filtered_result = DetectionBatch.from_results([result]).filter(args.box_threshold)[0]
     # visualize the results
     if not os.path.exists(args.vis_dir):
         os.makedirs(args.vis_dir)
-    image = Image.open(target_image)
-    image = visualize(image, filtered_result, draw_score=True)
+    image = visualize(target_image, filtered_result, draw_score=True)
     image.save(os.path.join(args.vis_dir, f"generic.jpg"))
     print(f"Visualized image saved to {args.vis_dir}/generic.jpg")
@@ -1,10 +1,7 @@
 import argparse
 import os
 
-import numpy as np
-from PIL import Image
-
-from trex import TRex2APIWrapper, visualize
+from trex import DetectionBatch, ImageHandle, TRex2APIWrapper, visualize
 
 
 def get_args():
@@ -29,9 +26,11 @@ def get_args():
 if __name__ == "__main__":
     args = get_args()
     trex2 = TRex2APIWrapper(args.token)
+    # both prompts share one handle, the image is read once for the uploads and the drawings
+    prompt_image = ImageHandle("assets/trex2_api_examples/interactive1.jpeg")
     prompts = [
         {
-            "prompt_image": "assets/trex2_api_examples/interactive1.jpeg",
+            "prompt_image": prompt_image,
             "type": "rect",
             "prompts": [
                 {
@@ -42,7 +41,7 @@ if __name__ == "__main__":
             ],
         },
         {
-            "prompt_image": "assets/trex2_api_examples/interactive1.jpeg",
+            "prompt_image": prompt_image,
             "type": "point",
             "prompts": [
                 {"category_id": 1, "points": [[64, 383]]},
@@ -52,24 +51,11 @@ if __name__ == "__main__":
     ]
     results = trex2.interactve_inference(prompts)
     # filter out the boxes with low score
-    filtered_results = []
-    for result in results:
-        scores = np.array(result["scores"])
-        labels = np.array(result["labels"])
-        boxes = np.array(result["boxes"])
-        filter_mask = scores > args.box_threshold
-        filtered_result = {
-            "scores": scores[filter_mask],
-            "labels": labels[filter_mask],
-            "boxes": boxes[filter_mask],
-        }
-        filtered_results.append(filtered_result)
+    filtered_results = DetectionBatch.from_results(results).filter(args.box_threshold)
     # visualize the results
     if not os.path.exists(args.vis_dir):
         os.makedirs(args.vis_dir)
     for i, (prompt, result) in enumerate(zip(prompts, filtered_results)):
-        image_path = prompt["prompt_image"]
-        image = Image.open(image_path)
-        image = visualize(image, result, draw_score=True)
+        image = visualize(prompt["prompt_image"], result, draw_score=True)
         image.save(os.path.join(args.vis_dir, f"interactive_{i}.jpg"))
         print(f"Visualized image saved to {args.vis_dir}/interactive_{i}.jpg")
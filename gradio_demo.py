@@ -8,7 +8,8 @@ import numpy as np
 from gradio_image_prompter import ImagePrompter
 from PIL import Image, ImageDraw, ImageFont
 
-from trex import TRex2APIWrapper
+from trex import AsyncTRex2APIWrapper, DetectionBatch, ImageHandle, TRex2APIWrapper
+from trex.prompts import PromptValidationError
 
 
 def arg_parse():
@@ -22,6 +23,18 @@ def arg_parse():
     parser.add_argument(
         "--sam_checkpoint_path", type=str, help="path to checkpoint file"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="maximum number of requests processed at the same time",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="timeout of one API call in seconds, no timeout by default",
+    )
     args = parser.parse_args()
     return args
 
@@ -232,26 +245,20 @@ def trex2_postprocess(
     if isinstance(trex2_results, dict):
         trex2_results = [trex2_results]
     # filter based on visual threshold
-    scores = np.array(trex2_results[0]["scores"])
-    boxes = np.array(trex2_results[0]["boxes"])
-    labels = np.array(trex2_results[0]["labels"])
-    filter_mask = scores > float(visual_threshold)
-    boxes = boxes[filter_mask]
-    labels = labels[filter_mask]
-    scores = scores[filter_mask]
-    trex2_results[0]["boxes"] = boxes
-    trex2_results[0]["labels"] = labels
-    trex2_results[0]["scores"] = scores
-    target_image = Image.fromarray(target_image)
+    trex2_result = DetectionBatch.from_results(trex2_results[:1]).filter(
+        float(visual_threshold)
+    )[0]
+    boxes = trex2_result["boxes"]
+    target_image = target_image.to_pil()
     image_with_box = plot_boxes_to_image(
-        target_image, trex2_results[0], return_point, point_width, return_score
+        target_image, trex2_result, return_point, point_width, return_score
     )[0]
     visualization = np.array(image_with_box)
     mask = None
     return visualization, len(boxes), build_annotation(boxes, mask)
 
 
-def inference(
+async def inference(
     target_image,
     interactive_input,
     generic_vp1,
@@ -278,7 +285,9 @@ def inference(
         "8": generic_vp8,
     }
     if target_image is None:
-        gr.Error("Please provide a target image")
+        raise gr.Error("Please provide a target image")
+    # shared by the upload and the drawing, the file is read once
+    target_image = ImageHandle(target_image)
     # tell if generic visual prompt is empty
     generic_is_empty = True
     for _, v in generic_vp_dict.items():
@@ -288,17 +297,22 @@ def inference(
     # We support:
     # 1. interactive visual prompt
     # 2. generic visual prompt
-    if interactive_input is not None and generic_is_empty:
-        prompts = pack_model_input_interactive(interactive_input)
-        trex2_results = trex2.interactve_inference([prompts])
-    elif interactive_input is None and not generic_is_empty:
-        prompts = pack_model_input_generic(generic_vp_dict)
-        trex2_results = trex2.generic_inference(target_image, prompts)
-    else:
-        raise gr.Error(
-            "You should provide either interactive visual prompt or generic visual prompt"
-        )
-    visualization, num_count, coco_anno = trex2_postprocess(
+    try:
+        if interactive_input is not None and generic_is_empty:
+            prompts = pack_model_input_interactive(interactive_input)
+            trex2_results = await async_trex2.interactve_inference([prompts])
+        elif interactive_input is None and not generic_is_empty:
+            prompts = pack_model_input_generic(generic_vp_dict)
+            trex2_results = await async_trex2.generic_inference(target_image, prompts)
+        else:
+            raise gr.Error(
+                "You should provide either interactive visual prompt or generic visual prompt"
+            )
+    except PromptValidationError as e:
+        raise gr.Error(f"Invalid visual prompt: {e}")
+    # drawing is CPU bound, keep it off the event loop
+    visualization, num_count, coco_anno = await async_trex2.run_in_thread(
+        trex2_postprocess,
         target_image,
         trex2_results,
         visual_threshold,
@@ -311,7 +325,10 @@ def inference(
 
 
 args = arg_parse()
-trex2 = TRex2APIWrapper(args.trex2_api_token)
+trex2 = TRex2APIWrapper(args.trex2_api_token, pool_size=args.concurrency)
+async_trex2 = AsyncTRex2APIWrapper(
+    trex2, max_workers=args.concurrency, timeout=args.timeout
+)
 # args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 # sam = sam_model_registry['vit_l'](checkpoint=args.sam_checkpoint_path)
 # sam.to(device=args.device)
@@ -332,7 +349,11 @@ if __name__ == "__main__":
             with gr.Column():
                 with gr.Row():
                     with gr.Column():
-                        target_image = gr.Image(label="Input Target Image", width=300)
+                        # keep the uploaded file so it is sent to the API without
+                        # being decoded and re-encoded
+                        target_image = gr.Image(
+                            label="Input Target Image", width=300, type="filepath"
+                        )
                     with gr.Column():
                         with gr.Row():
                             return_point = gr.Checkbox(label="Return Point Anno")
@@ -411,6 +432,7 @@ if __name__ == "__main__":
                 with gr.Row():
                     clean = gr.Button("Clean Inputs")
                     infer = gr.Button("Run T-Rex2🦖🦖🦖")
+                    cancel = gr.Button("Cancel")
         clean.click(
             fn=clean_input,
             outputs=[
@@ -425,7 +447,7 @@ if __name__ == "__main__":
                 generic_vp8,
             ],
         )
-        infer.click(
+        infer_event = infer.click(
             fn=inference,
             inputs=[
                 target_image,
@@ -445,4 +467,6 @@ if __name__ == "__main__":
             ],
             outputs=[output_image, num_count, coco_anno],
         )
-    demo.launch()
+        # cancels the request of this session only, which frees its API client
+        cancel.click(fn=None, cancels=[infer_event])
+    demo.queue(default_concurrency_limit=args.concurrency).launch()
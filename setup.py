@@ -121,6 +121,9 @@ if __name__ == "__main__":
         license=license,
         install_requires=parse_requirements("requirements.txt"),
         packages=find_packages(exclude=("tests", )),
+        entry_points={
+            "console_scripts": ["trex=trex.cli:main", "trex-worker=trex.worker:main"]
+        },
         ext_modules=None,
         cmdclass={"build_ext": torch.utils.cpp_extension.BuildExtension},
     )
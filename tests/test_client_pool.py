@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("dds_cloudapi_sdk")
+
+from trex.client_pool import ClientPool  # noqa: E402
+from trex.deadline import CallCancelled, Deadline, DeadlineExceeded  # noqa: E402
+
+
+def make_pool(pool_size: int) -> ClientPool:
+    pool = ClientPool("token", pool_size=pool_size)
+    # no SDK client is needed to test the leases
+    pool.create_client = object
+    return pool
+
+
+def test_every_thread_is_served():
+    pool = make_pool(4)
+    stop = threading.Event()
+    counts = [0] * 40
+
+    def loop(i):
+        while not stop.is_set():
+            with pool.lease():
+                counts[i] += 1
+                time.sleep(0.001)
+
+    threads = [threading.Thread(target=loop, args=(i, )) for i in range(len(counts))]
+    for thread in threads:
+        thread.start()
+    time.sleep(1.0)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert min(counts) > 0
+    assert pool.free_slots == 4
+
+
+def test_waiters_are_served_in_arrival_order():
+    pool = make_pool(1)
+    order = []
+    with pool.lease():
+        threads = []
+        for i in range(5):
+
+            def wait(i=i):
+                with pool.lease():
+                    order.append(i)
+
+            threads.append(threading.Thread(target=wait))
+            threads[-1].start()
+            while len(pool.waiters) < i + 1:
+                time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+    assert order == list(range(5))
+
+
+def test_lease_timeout():
+    pool = make_pool(1)
+    with pool.lease():
+        with pytest.raises(TimeoutError):
+            with pool.lease(timeout=0.05):
+                pass
+        assert not pool.waiters
+    with pool.lease(timeout=0.05):
+        pass
+
+
+def test_lease_deadline():
+    pool = make_pool(1)
+    with pool.lease():
+        with pytest.raises(DeadlineExceeded):
+            with pool.lease(deadline=Deadline(0.05)):
+                pass
+        assert not pool.waiters
+
+
+def test_lease_cancelled_while_waiting():
+    pool = make_pool(1)
+    deadline = Deadline()
+    errors = []
+
+    def wait():
+        try:
+            with pool.lease(deadline=deadline):
+                pass
+        except CallCancelled as e:
+            errors.append(e)
+
+    with pool.lease():
+        thread = threading.Thread(target=wait)
+        thread.start()
+        while not pool.waiters:
+            time.sleep(0.001)
+        deadline.cancel()
+        thread.join(timeout=1.0)
+        assert len(errors) == 1
+        assert not pool.waiters
+    assert pool.free_slots == 1
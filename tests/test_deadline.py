@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("dds_cloudapi_sdk")
+
+from trex.deadline import CallCancelled, Deadline, DeadlineExceeded, race  # noqa: E402
+
+
+def test_deadline_check():
+    Deadline().check()
+    deadline = Deadline(0.01)
+    time.sleep(0.02)
+    assert deadline.expired
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+    deadline = Deadline()
+    deadline.cancel()
+    with pytest.raises(CallCancelled):
+        deadline.check()
+
+
+def test_race_returns_the_result():
+    assert race(lambda: 42) == (0, 42)
+
+
+def test_race_raises_the_error_of_the_call():
+    with pytest.raises(KeyError):
+        race(lambda: {}["missing"])
+
+
+def test_race_abandons_a_call_past_its_deadline():
+    release = threading.Event()
+    abandoned = []
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        race(release.wait, Deadline(0.05), on_abandon=abandoned.append)
+    assert time.monotonic() - start < 1.0
+    assert abandoned == [0]
+    release.set()
+
+
+def test_race_stops_on_cancel():
+    release = threading.Event()
+    deadline = Deadline()
+    threading.Timer(0.05, deadline.cancel).start()
+    with pytest.raises(CallCancelled):
+        race(release.wait, deadline)
+    release.set()
+
+
+def test_race_hedge_wins_and_primary_error_wins_over_hedge():
+    release = threading.Event()
+    abandoned = []
+    assert race(release.wait, hedge=lambda: "hedge", hedge_delay=0.01,
+                on_abandon=abandoned.append) == (1, "hedge")
+    assert abandoned == [0]
+    release.set()
+
+    def fail(error):
+        raise error
+
+    with pytest.raises(KeyError):
+        race(lambda: time.sleep(0.05) or fail(KeyError("primary")),
+             hedge=lambda: fail(ValueError("hedge")), hedge_delay=0.01)
@@ -0,0 +1,100 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("dds_cloudapi_sdk")
+
+import trex.client_pool  # noqa: E402
+from trex.multi_token import MultiTokenAPIWrapper, is_quota_error  # noqa: E402
+
+QUOTA_ERROR = "Failed to trigger task, error: quota exceeded"
+PROMPTS = [{"prompt_image": np.zeros((32, 32, 3), dtype=np.uint8), "rects": [[2, 2, 10, 10]]}]
+
+
+class StubClient:
+    """SDK client answering every task with one box, or failing with a quota error on the
+    tokens in `drained_tokens`."""
+
+    drained_tokens = set()
+    lock = threading.Lock()
+    tasks = []
+    uploads = []
+
+    def __init__(self, config):
+        self.token = config.token
+
+    def upload_file(self, path):
+        with self.lock:
+            self.uploads.append(self.token)
+        return f"https://upload/{self.token}/{len(self.uploads)}"
+
+    def run_task(self, task):
+        with self.lock:
+            self.tasks.append(self.token)
+        if self.token in self.drained_tokens:
+            raise RuntimeError(QUOTA_ERROR)
+        box = SimpleNamespace(score=0.9, category_id=1, bbox=[1.0, 2.0, 3.0, 4.0])
+        task.result = SimpleNamespace(objects=[box], object_batches=[[box]])
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    monkeypatch.setattr(trex.client_pool, "Client", StubClient)
+    monkeypatch.setattr(trex.client_pool, "Config", lambda token: SimpleNamespace(token=token))
+    monkeypatch.setattr(StubClient, "drained_tokens", {"bad"})
+    monkeypatch.setattr(StubClient, "tasks", [])
+    monkeypatch.setattr(StubClient, "uploads", [])
+    return StubClient
+
+
+def test_is_quota_error():
+    assert is_quota_error(RuntimeError(QUOTA_ERROR))
+    assert is_quota_error(SimpleNamespace(status_code=429))
+    # a task id or a prompt error containing the same digits is not a quota error
+    assert not is_quota_error(RuntimeError("Task 429-abc is failed, error: bad prompt"))
+    assert not is_quota_error(ValueError("quota"))
+
+
+def test_quota_error_drains_the_token_and_retries(stub_client):
+    trex2 = MultiTokenAPIWrapper(["bad", "good"], drain_seconds=60)
+    result = trex2.generic_inference("https://target.jpg", PROMPTS)
+    assert result["boxes"] == [[1.0, 2.0, 3.0, 4.0]]
+    bad = trex2.token_states[0]
+    assert bad.num_quota_errors == 1
+    assert bad.drained_until > time.monotonic()
+    # the drained token is not routed to anymore
+    num_bad_tasks = stub_client.tasks.count("bad")
+    trex2.generic_inference("https://target.jpg", PROMPTS)
+    assert stub_client.tasks.count("bad") == num_bad_tasks
+
+
+def test_stream_retries_on_another_token(stub_client):
+    trex2 = MultiTokenAPIWrapper(["bad", "good"], drain_seconds=60)
+    targets = [f"https://target/{i}.jpg" for i in range(8)]
+    results = dict(trex2.generic_inference_many(targets, PROMPTS, max_workers=2))
+    assert sorted(results) == list(range(len(targets)))
+    assert stub_client.tasks.count("good") == len(targets)
+    # the prompts were uploaded again for the token of the retry
+    assert "good" in stub_client.uploads
+
+
+def test_error_raised_when_all_tokens_are_drained(stub_client):
+    stub_client.drained_tokens = {"bad", "worse"}
+    trex2 = MultiTokenAPIWrapper(["bad", "worse"], drain_seconds=60)
+    with pytest.raises(RuntimeError, match="quota"):
+        trex2.generic_inference("https://target.jpg", PROMPTS)
+    assert stub_client.tasks == ["bad", "worse"] or stub_client.tasks == ["worse", "bad"]
+
+
+def test_uploads_take_no_budget(stub_client):
+    trex2 = MultiTokenAPIWrapper(["good"], tasks_per_minute=[1])
+    bucket = trex2.token_states[0].bucket
+    for i in range(3):
+        trex2.get_image_url(np.full((8, 8, 3), i, dtype=np.uint8))
+    assert len(stub_client.uploads) == 3
+    assert bucket.available >= 1
+    trex2.generic_inference("https://target.jpg", PROMPTS)
+    assert bucket.available < 1
@@ -0,0 +1,120 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("dds_cloudapi_sdk")
+
+import trex.client_pool  # noqa: E402
+from trex import TRex2APIWrapper  # noqa: E402
+from trex.deadline import CallCancelled, Deadline, DeadlineExceeded  # noqa: E402
+from trex.scheduler import PriorityClass, PriorityScheduler  # noqa: E402
+
+
+class StubClient:
+    """SDK client answering every task with no detection."""
+
+    def __init__(self, config):
+        pass
+
+    def upload_file(self, path):
+        return "https://upload/" + path
+
+    def run_task(self, task):
+        task.result = SimpleNamespace(objects=[], object_batches=[[]])
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    monkeypatch.setattr(trex.client_pool, "Client", StubClient)
+    monkeypatch.setattr(trex.client_pool, "Config", lambda token: SimpleNamespace(token=token))
+
+
+def wait_queued(scheduler: PriorityScheduler, name: str, count: int):
+    while scheduler.stats()[name]["queued"] < count:
+        time.sleep(0.001)
+
+
+def test_admissions_follow_the_weights():
+    scheduler = PriorityScheduler(
+        max_concurrency=1,
+        classes=[PriorityClass("heavy", weight=3.0), PriorityClass("light", weight=1.0)])
+    order = []
+
+    def call(name):
+        with scheduler.slot(name):
+            order.append(name)
+
+    threads = []
+    with scheduler.slot("light"):
+        for name in ("heavy", "light"):
+            for _ in range(8):
+                threads.append(threading.Thread(target=call, args=(name, )))
+                threads[-1].start()
+            wait_queued(scheduler, name, 8)
+    for thread in threads:
+        thread.join()
+    # 3 heavy calls for every light call while both classes are waiting
+    assert 5 <= order[:8].count("heavy") <= 7
+    assert sorted(order) == ["heavy"] * 8 + ["light"] * 8
+
+
+def test_reserved_slots_are_kept_for_their_class():
+    # a quarter of 4 slots is reserved for interactive calls
+    scheduler = PriorityScheduler(max_concurrency=4)
+    held = [scheduler.acquire("bulk") for _ in range(3)]
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire("bulk", Deadline(0.05))
+    with scheduler.slot("interactive", Deadline(0.05)):
+        pass
+    assert scheduler.stats()["bulk"]["abandoned"] == 1
+    for priority_class in held:
+        scheduler.release(priority_class)
+
+
+def test_reserved_quota_is_kept_for_its_class():
+    # a burst of 1 task, plus 1 task reserved for interactive calls
+    scheduler = PriorityScheduler(max_concurrency=8, tasks_per_minute=60)
+    with scheduler.slot("bulk"):
+        pass
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire("bulk", Deadline(0.05))
+    with scheduler.slot("interactive", Deadline(0.05)):
+        pass
+
+
+def test_waiting_call_can_be_cancelled():
+    scheduler = PriorityScheduler(max_concurrency=1, classes=[PriorityClass("only")])
+    deadline = Deadline()
+    errors = []
+
+    def call():
+        try:
+            scheduler.acquire("only", deadline)
+        except CallCancelled as e:
+            errors.append(e)
+
+    with scheduler.slot("only"):
+        thread = threading.Thread(target=call)
+        thread.start()
+        wait_queued(scheduler, "only", 1)
+        deadline.cancel()
+        thread.join(timeout=1.0)
+    assert len(errors) == 1
+    assert scheduler.stats()["only"]["queued"] == 0
+
+
+def test_streams_run_in_the_bound_priority(stub_client):
+    scheduler = PriorityScheduler(max_concurrency=4)
+    trex2 = TRex2APIWrapper("token", pool_size=4, scheduler=scheduler)
+    prompts = [{"prompt_image": "https://prompt.jpg", "rects": [[1, 1, 5, 5]]}]
+    targets = [f"https://target/{i}.jpg" for i in range(6)]
+    with trex2.bind_priority("interactive"):
+        assert len(list(trex2.generic_inference_many(targets, prompts, max_workers=2))) == 6
+    list(trex2.iter_generic([(target, prompts) for target in targets], priority="interactive"))
+    stats = scheduler.stats()
+    assert stats["interactive"]["admitted"] == 12
+    assert stats["bulk"]["admitted"] == 0
+    with pytest.raises(ValueError):
+        list(trex2.iter_generic([(targets[0], prompts)], priority="unknown"))
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("dds_cloudapi_sdk")
+
+from trex.workqueue import WorkQueue  # noqa: E402
+
+
+def make_queue(tmp_path, **kwargs) -> WorkQueue:
+    return WorkQueue(str(tmp_path / "queue.db"), **kwargs)
+
+
+def test_add_skips_known_keys(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.add([{"i": 0}, {"i": 1}], keys=["a", "b"]) == 2
+    assert queue.add([{"i": 1}, {"i": 2}], keys=["b", "c"]) == 1
+    assert queue.counts()["pending"] == 3
+
+
+def test_concurrent_claims_never_share_an_item(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.add([{"i": i} for i in range(50)])
+    claimed = []
+    lock = threading.Lock()
+
+    def work(owner):
+        while True:
+            items = queue.claim(owner, limit=3)
+            if not items:
+                return
+            with lock:
+                claimed.extend(item_id for item_id, _ in items)
+
+    threads = [threading.Thread(target=work, args=(f"worker{i}", )) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == list(range(1, 51))
+    assert queue.counts()["leased"] == 50
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.05)
+    queue.add([{"i": 0}])
+    [(item_id, payload)] = queue.claim("dead")
+    assert payload == {"i": 0}
+    assert queue.claim("alive") == []
+    time.sleep(0.1)
+    assert queue.claim("alive") == [(item_id, payload)]
+    # the heartbeat of the expired owner tells it to abandon the item
+    assert queue.heartbeat("dead", [item_id]) == []
+    assert queue.heartbeat("alive", [item_id]) == [item_id]
+
+
+def test_item_fails_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.01, max_attempts=2)
+    queue.add([{"i": 0}], keys=["a"])
+    for _ in range(2):
+        assert len(queue.claim("worker")) == 1
+        time.sleep(0.02)
+    assert queue.claim("worker") == []
+    assert queue.counts()["failed"] == 1
+    assert [key for key, _, _ in queue.errors()] == ["a"]
+    assert queue.reset_failed() == 1
+    assert len(queue.claim("worker")) == 1
+
+
+def test_fail_retries_until_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    queue.add([{"i": 0}])
+    [(item_id, _)] = queue.claim("worker")
+    queue.fail(item_id, "worker", "boom")
+    assert queue.counts()["pending"] == 1
+    [(item_id, _)] = queue.claim("worker")
+    queue.fail(item_id, "worker", "boom")
+    assert queue.counts()["failed"] == 1
+    assert queue.is_finished()
+
+
+def test_complete_is_idempotent(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.01)
+    queue.add([{"i": 0}], keys=["a"])
+    [(item_id, _)] = queue.claim("slow")
+    time.sleep(0.02)
+    queue.claim("fast")
+    assert queue.complete(item_id, {"result": "fast"})
+    # the late result of the worker whose lease expired is ignored
+    assert not queue.complete(item_id, {"result": "slow"})
+    assert list(queue.results()) == [("a", {"i": 0}, {"result": "fast"})]
+    # a completed item is not failed by its former owner
+    queue.fail(item_id, "slow", "late error")
+    assert queue.counts()["done"] == 1
+    assert queue.is_finished()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("dds_cloudapi_sdk")
+
+from trex.zones import ZoneLookup, Zones  # noqa: E402
+
+WIDTH, HEIGHT = 200, 100
+# two lanes sharing the border x = 100, a triangle and the full frame
+POLYGONS = [
+    [(0, 0), (100, 0), (100, 100), (0, 100)],
+    [(100, 0), (200, 0), (200, 100), (100, 100)],
+    [(20, 10), (180, 30), (60, 90)],
+    [(0, 0), (WIDTH, 0), (WIDTH, HEIGHT), (0, HEIGHT)],
+]
+
+
+def test_zone_lookup_is_abstract():
+    with pytest.raises(TypeError):
+        ZoneLookup(1)
+
+
+def test_raster_agrees_with_polygons():
+    zones = Zones(POLYGONS)
+    raster = zones.rasterize((WIDTH, HEIGHT))
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, (WIDTH, HEIGHT), (10000, 2))
+    # points on the pixel grid, i.e. on the borders of the zones
+    ys, xs = np.mgrid[:HEIGHT, :WIDTH]
+    points = np.concatenate([points, np.stack([xs.ravel(), ys.ravel()], axis=1)])
+    np.testing.assert_array_equal(zones.contains(points), raster.contains(points))
+
+
+def test_box_on_shared_border_is_in_one_lane():
+    zones = Zones(POLYGONS[:2])
+    raster = zones.rasterize((WIDTH, HEIGHT))
+    boxes = np.array([[90, 20, 110, 60], [80, 20, 120, 60], [60, 20, 140, 60]])
+    for lookup in (zones, raster):
+        assert lookup.membership(boxes).sum() == len(boxes)
+
+
+def test_box_touching_the_frame_border_is_in_the_frame():
+    zones = Zones(POLYGONS[3:])
+    raster = zones.rasterize((WIDTH, HEIGHT))
+    boxes = np.array([[10, 50, 30, HEIGHT], [WIDTH - 20, 50, WIDTH, HEIGHT]])
+    for anchor in ("bottom_center", "bottom_right", "top_left"):
+        for lookup in (zones, raster):
+            lookup.anchor = anchor
+            assert lookup.membership(boxes).all()
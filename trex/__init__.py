@@ -1,4 +1,11 @@
+from .async_wrapper import AsyncTRex2APIWrapper
+from .detections import DetectionBatch
+from .image import ImageHandle
 from .model_wrapper import TRex2APIWrapper
+from .multi_token import MultiTokenAPIWrapper
 from .visualize import visualize
 
-__all__ = ["TRex2APIWrapper", "visualize"]
+__all__ = [
+    "TRex2APIWrapper", "MultiTokenAPIWrapper", "AsyncTRex2APIWrapper", "DetectionBatch",
+    "ImageHandle", "visualize"
+]
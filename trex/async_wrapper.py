@@ -0,0 +1,87 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from .deadline import Deadline
+
+
+class AsyncTRex2APIWrapper:
+    """Non-blocking facade of a `TRex2APIWrapper` for asyncio code, e.g. async Gradio
+    handlers. Calls run in a dedicated thread pool so the event loop is never blocked.
+
+    Cancelling the awaiting coroutine, e.g. with `asyncio.Task.cancel` or a Gradio
+    `cancels=` event, cancels the deadline of the call, which frees its pool slot right
+    away.
+
+    Args:
+        trex2 (TRex2APIWrapper): The wrapper running the calls, can be shared with
+            synchronous code.
+        max_workers (int): Maximum number of calls running at the same time. Defaults to
+            32.
+        timeout (float): Default timeout of every call in seconds. Defaults to None, which
+            never times out.
+        priority (str): Priority class of the calls in the scheduler of the wrapper, e.g.
+            "interactive" for a demo used by annotators. Defaults to None, which is the
+            default class of the scheduler.
+    """
+
+    def __init__(self,
+                 trex2,
+                 max_workers: int = 32,
+                 timeout: float = None,
+                 priority: str = None):
+        self.trex2 = trex2
+        self.timeout = timeout
+        self.priority = priority
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="trex2")
+
+    async def call(self, method, *args, timeout: float = None):
+        """Run a workflow method of the wrapper in the thread pool.
+
+        Args:
+            method (Callable): Bound method of the wrapper accepting a `deadline` and a
+                `priority`.
+            timeout (float): Timeout of the call in seconds, defaults to `self.timeout`.
+        """
+        deadline = Deadline(self.timeout if timeout is None else timeout)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.executor,
+            functools.partial(method, *args, deadline=deadline, priority=self.priority))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            deadline.cancel()
+            raise
+
+    async def interactve_inference(self, prompts: List[Dict], timeout: float = None):
+        """Async version of `TRex2APIWrapper.interactve_inference`."""
+        return await self.call(self.trex2.interactve_inference, prompts, timeout=timeout)
+
+    async def generic_inference(self, target_image, prompts: List[dict],
+                                timeout: float = None):
+        """Async version of `TRex2APIWrapper.generic_inference`."""
+        return await self.call(self.trex2.generic_inference, target_image, prompts,
+                               timeout=timeout)
+
+    async def customize_embedding(self, prompts: List[dict], timeout: float = None):
+        """Async version of `TRex2APIWrapper.customize_embedding`."""
+        return await self.call(self.trex2.customize_embedding, prompts, timeout=timeout)
+
+    async def embedding_inference(self, prompts: List[dict], timeout: float = None):
+        """Async version of `TRex2APIWrapper.embedding_inference`."""
+        return await self.call(self.trex2.embedding_inference, prompts, timeout=timeout)
+
+    async def get_image_url(self, image, timeout: float = None) -> str:
+        """Async version of `TRex2APIWrapper.get_image_url`."""
+        return await self.call(self.trex2.get_image_url, image, timeout=timeout)
+
+    async def run_in_thread(self, func, *args, **kwargs):
+        """Run CPU-bound local work, e.g. postprocessing, in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+def box_area(boxes: np.ndarray) -> np.ndarray:
+    """Compute the area of boxes in shape (..., 4), [x1, y1, x2, y2] format."""
+    boxes = np.asarray(boxes, dtype=np.float32)
+    return np.clip(boxes[..., 2] - boxes[..., 0], 0, None) * np.clip(
+        boxes[..., 3] - boxes[..., 1], 0, None)
+
+
+def box_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """Compute the pairwise IoU of two sets of boxes.
+
+    Args:
+        boxes1 (np.ndarray): Boxes in shape (N, 4), [x1, y1, x2, y2] format.
+        boxes2 (np.ndarray): Boxes in shape (M, 4), [x1, y1, x2, y2] format.
+
+    Returns:
+        np.ndarray: IoU matrix in shape (N, M).
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    union = box_area(boxes1)[:, None] + box_area(boxes2)[None, :] - inter
+    return inter / np.maximum(union, np.finfo(np.float32).eps)
+
+
+def batched_box_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """Compute the pairwise IoU of two sets of boxes for a batch of images at once.
+
+    Args:
+        boxes1 (np.ndarray): Boxes in shape (B, N, 4), [x1, y1, x2, y2] format.
+        boxes2 (np.ndarray): Boxes in shape (B, M, 4), [x1, y1, x2, y2] format.
+
+    Returns:
+        np.ndarray: IoU matrices in shape (B, N, M).
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32)
+    boxes2 = np.asarray(boxes2, dtype=np.float32)
+    top_left = np.maximum(boxes1[:, :, None, :2], boxes2[:, None, :, :2])
+    bottom_right = np.minimum(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    union = box_area(boxes1)[:, :, None] + box_area(boxes2)[:, None, :] - inter
+    return inter / np.maximum(union, np.finfo(np.float32).eps)
+
+
+def xyxy_to_cxcywh(boxes: np.ndarray) -> np.ndarray:
+    """Convert boxes from [x1, y1, x2, y2] to [cx, cy, w, h] format."""
+    boxes = np.asarray(boxes, dtype=np.float32)
+    return np.concatenate([(boxes[..., :2] + boxes[..., 2:]) / 2, boxes[..., 2:] - boxes[..., :2]],
+                          axis=-1)
+
+
+def cxcywh_to_xyxy(boxes: np.ndarray) -> np.ndarray:
+    """Convert boxes from [cx, cy, w, h] to [x1, y1, x2, y2] format."""
+    boxes = np.asarray(boxes, dtype=np.float32)
+    return np.concatenate([boxes[..., :2] - boxes[..., 2:] / 2, boxes[..., :2] + boxes[..., 2:] / 2],
+                          axis=-1)
+
+
+# anchor point of a box as fractions of its width and height from the top left corner
+BOX_ANCHORS = {
+    "center": (0.5, 0.5),
+    "bottom_center": (0.5, 1.0),
+    "top_center": (0.5, 0.0),
+    "top_left": (0.0, 0.0),
+    "top_right": (1.0, 0.0),
+    "bottom_left": (0.0, 1.0),
+    "bottom_right": (1.0, 1.0),
+}
+
+
+def box_anchors(boxes: np.ndarray, anchor: str = "center") -> np.ndarray:
+    """Compute one anchor point per box, e.g. the bottom center where people and vehicles
+    touch the ground.
+
+    Args:
+        boxes (np.ndarray): Boxes in shape (N, 4), [x1, y1, x2, y2] format.
+        anchor (str): One of the keys of `BOX_ANCHORS`. Defaults to "center".
+
+    Returns:
+        np.ndarray: Points in shape (N, 2), [x, y] format.
+    """
+    assert anchor in BOX_ANCHORS, f"Invalid anchor {anchor}"
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    fractions = np.array(BOX_ANCHORS[anchor], dtype=np.float32)
+    return boxes[:, :2] + (boxes[:, 2:] - boxes[:, :2]) * fractions
@@ -0,0 +1,22 @@
+import argparse
+
+from . import server
+
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="trex", description="T-Rex2 API tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve the workflows over HTTP to share caches, batches and quota")
+    server.add_arguments(serve_parser)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.command == "serve":
+        server.serve(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Hashable, Iterator
+
+from dds_cloudapi_sdk import Client, Config
+
+from .deadline import POLL_INTERVAL, Deadline
+
+
+class UploadCache:
+    """Thread-safe LRU cache of uploaded image urls.
+
+    Args:
+        max_size (int): Maximum number of cached urls. Defaults to 1024.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.urls = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.urls)
+
+    def get(self, key: Hashable) -> str:
+        """Return the cached url of `key`, or None if it is not cached."""
+        with self.lock:
+            url = self.urls.get(key)
+            if url is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.urls.move_to_end(key)
+            return url
+
+    def put(self, key: Hashable, url: str):
+        """Cache the url of `key`, evicting the least recently used url if full."""
+        with self.lock:
+            self.urls[key] = url
+            self.urls.move_to_end(key)
+            while len(self.urls) > self.max_size:
+                self.urls.popitem(last=False)
+
+
+class ClientPool:
+    """Thread-safe pool of SDK clients sharing one token.
+
+    Each thread leases its own `Client` for the duration of a request, so uploads and tasks
+    from different threads never share a client. Released clients are kept and handed out
+    again most recently used first, which keeps the warmest clients (and the connections
+    they hold) in use, while clients idle for longer than `idle_timeout` are dropped.
+    Threads waiting for a client are served in arrival order: a released slot is handed
+    to the longest waiting thread, so a thread looping on calls can not take it back.
+
+    Args:
+        token (str): The token for T-Rex2 API.
+        pool_size (int): Maximum number of clients leased at the same time. Extra
+            requests wait for a free client. Defaults to 8.
+        idle_timeout (float): Seconds after which an idle client is discarded. Defaults
+            to 60.
+        upload_cache_size (int): Size of the upload url cache of the token. Upload urls
+            may be scoped to a token, so every pool has its own cache. Defaults to 0, which
+            disables the cache.
+    """
+
+    def __init__(self,
+                 token: str,
+                 pool_size: int = 8,
+                 idle_timeout: float = 60.0,
+                 upload_cache_size: int = 0):
+        assert pool_size > 0, "Pool size must be positive"
+        self.token = token
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        # idle clients as (client, release_time), the most recently released is last
+        self.idle_clients = []
+        self.num_leased = 0
+        self.num_created = 0
+        self.lock = threading.Lock()
+        self.free_slots = pool_size
+        # one event per waiting thread, set when a slot is handed to it
+        self.waiters = deque()
+        # leased clients not to be reused, e.g. still running an abandoned request
+        self.discarded = set()
+        self.upload_cache = UploadCache(upload_cache_size) if upload_cache_size > 0 else None
+
+    def create_client(self) -> Client:
+        """Create a new SDK client for the token of the pool."""
+        with self.lock:
+            self.num_created += 1
+        return Client(Config(token=self.token))
+
+    @contextmanager
+    def lease(self, timeout: float = None, deadline: Deadline = None) -> Iterator[Client]:
+        """Lease a client from the pool, blocking while all the clients are in use.
+
+        Args:
+            timeout (float): Maximum seconds to wait for a free client. Defaults to None,
+                which waits forever.
+            deadline (Deadline): Deadline and cancellation of the wait. Defaults to None.
+
+        Raises:
+            TimeoutError: If no client is free within `timeout`.
+            CallCancelled: If the deadline is cancelled while waiting.
+            DeadlineExceeded: If the deadline expires while waiting.
+        """
+        if not self.acquire_slot(timeout, deadline):
+            raise TimeoutError(f"No free client in the pool within {timeout}s")
+        try:
+            client = self.pop_idle_client() or self.create_client()
+            with self.lock:
+                self.num_leased += 1
+            try:
+                yield client
+            finally:
+                with self.lock:
+                    self.num_leased -= 1
+                    if client in self.discarded:
+                        self.discarded.remove(client)
+                    else:
+                        self.idle_clients.append((client, time.monotonic()))
+        finally:
+            self.release_slot()
+
+    def acquire_slot(self, timeout: float = None, deadline: Deadline = None) -> bool:
+        """Take a slot, waiting behind the threads already waiting. Returns False on
+        timeout, and raises like `Deadline.check` if the deadline ends first."""
+        with self.lock:
+            if self.free_slots > 0 and not self.waiters:
+                self.free_slots -= 1
+                return True
+            event = threading.Event()
+            self.waiters.append(event)
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                wait = None if give_up_at is None else max(give_up_at - time.monotonic(), 0.0)
+                if deadline is not None:
+                    deadline.check()
+                    wait = POLL_INTERVAL if wait is None else min(wait, POLL_INTERVAL)
+                if event.wait(wait):
+                    return True
+                if give_up_at is not None and time.monotonic() >= give_up_at:
+                    break
+        except BaseException:
+            if self.leave_queue(event):
+                # the slot was handed over right before giving up, pass it on
+                self.release_slot()
+            raise
+        # the slot may have been handed over right after the timeout
+        return self.leave_queue(event)
+
+    def leave_queue(self, event: threading.Event) -> bool:
+        """Stop waiting for a slot. Returns True if the slot was handed over already."""
+        with self.lock:
+            if event.is_set():
+                return True
+            self.waiters.remove(event)
+            return False
+
+    def release_slot(self):
+        """Hand the slot to the longest waiting thread, or free it."""
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().set()
+            else:
+                self.free_slots += 1
+
+    def discard(self, client: Client):
+        """Do not return a leased client to the pool at the end of its lease."""
+        with self.lock:
+            self.discarded.add(client)
+
+    def pop_idle_client(self) -> Client:
+        """Return the most recently released idle client, or None if there is none."""
+        now = time.monotonic()
+        with self.lock:
+            # the oldest clients are at the front
+            num_expired = 0
+            for _, release_time in self.idle_clients:
+                if now - release_time <= self.idle_timeout:
+                    break
+                num_expired += 1
+            del self.idle_clients[:num_expired]
+            if self.idle_clients:
+                return self.idle_clients.pop()[0]
+        return None
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional, Tuple
+
+# maximum seconds a waiting call sleeps before checking its deadline for cancellation
+POLL_INTERVAL = 0.05
+# maximum number of calls running in the threads of `race`, abandoned calls included
+MAX_RUNNING_CALLS = 256
+call_slots = threading.BoundedSemaphore(MAX_RUNNING_CALLS)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call does not complete before its deadline."""
+
+
+class CallCancelled(Exception):
+    """Raised when a call is cancelled with `Deadline.cancel`."""
+
+
+class Deadline:
+    """Deadline and cancellation handle of one or several calls.
+
+    The SDK has no way to abort a running request, so a call past its deadline or
+    cancelled is abandoned: the caller gets an error right away and its pool slot is freed,
+    while the request completes in the background and its result is dropped.
+
+    Args:
+        timeout (float): Seconds from now until the deadline. Defaults to None, which
+            never expires, e.g. for a call that is only cancellable.
+    """
+
+    def __init__(self, timeout: float = None):
+        self.expires_at = None if timeout is None else time.monotonic() + timeout
+        self.cancelled = False
+        # notified on cancellation, also used by `race` to wait for results
+        self.condition = threading.Condition()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline, None if it never expires."""
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def cancel(self):
+        """Cancel the calls running with this deadline, from any thread."""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def check(self):
+        """Raise if the deadline is cancelled or expired.
+
+        Raises:
+            CallCancelled: If `cancel` was called.
+            DeadlineExceeded: If the deadline is expired.
+        """
+        if self.cancelled:
+            raise CallCancelled("Call cancelled")
+        if self.expired:
+            raise DeadlineExceeded("Deadline exceeded")
+
+
+class LatencyTracker:
+    """Thread-safe sliding window of observed latencies.
+
+    Args:
+        window (int): Number of most recent latencies kept. Defaults to 256.
+        min_samples (int): Number of latencies needed before `quantile` returns a value.
+            Defaults to 20.
+    """
+
+    def __init__(self, window: int = 256, min_samples: int = 20):
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.latencies)
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the `q` quantile of the window, or None if there are too few samples."""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+
+def race(primary: Callable,
+         deadline: Deadline = None,
+         hedge: Callable = None,
+         hedge_delay: float = None,
+         on_abandon: Callable[[int], None] = None) -> Tuple[int, object]:
+    """Run a blocking call in a background thread and wait for it within a deadline,
+    optionally hedged by a duplicate call.
+
+    If `primary` is still running after `hedge_delay` seconds, `hedge` is started as well
+    and the first successful result wins. Calls still running when `race` returns or
+    raises are abandoned: they run to completion in their daemon thread and their result
+    is dropped.
+
+    The calls run in daemon threads rather than in a `ThreadPoolExecutor`, whose workers
+    are joined at exit, so that a stuck request does not hang the shutdown. At most
+    `MAX_RUNNING_CALLS` of them run at the same time, abandoned calls included: once the
+    limit is reached, new calls wait for a running one to end, within their deadline,
+    and hedges are not started.
+
+    Args:
+        primary (Callable): The call, without arguments.
+        deadline (Deadline): Deadline and cancellation of the call. Defaults to None,
+            which waits forever.
+        hedge (Callable): Duplicate of the call. Defaults to None, which never hedges.
+        hedge_delay (float): Seconds after which `hedge` is started.
+        on_abandon (Callable[[int], None]): Called with the index of every abandoned
+            call, 0 for `primary` and 1 for `hedge`, e.g. to discard their client.
+
+    Returns:
+        Tuple[int, object]: (index, result) of the winning call.
+
+    Raises:
+        CallCancelled: If the deadline is cancelled first.
+        DeadlineExceeded: If the deadline expires first.
+        Exception: The error of `primary` if all the started calls fail.
+    """
+    deadline = deadline or Deadline()
+    condition = deadline.condition
+    outcomes = []
+    running = set()
+    # index -> error of the failed calls
+    errors = {}
+
+    def start(index, func):
+
+        def target():
+            try:
+                outcome = (index, None, func())
+            except BaseException as e:
+                outcome = (index, e, None)
+            finally:
+                call_slots.release()
+            with condition:
+                outcomes.append(outcome)
+                condition.notify_all()
+
+        running.add(index)
+        threading.Thread(target=target, daemon=True).start()
+
+    hedge_at = None
+    if hedge is not None and hedge_delay is not None:
+        hedge_at = time.monotonic() + hedge_delay
+    deadline.check()
+    while not call_slots.acquire(timeout=POLL_INTERVAL):
+        deadline.check()
+    try:
+        with condition:
+            start(0, primary)
+            while True:
+                while outcomes:
+                    index, error, result = outcomes.pop(0)
+                    running.discard(index)
+                    if error is None:
+                        return index, result
+                    errors[index] = error
+                if not running:
+                    # the error of the call itself rather than of its hedge
+                    raise errors[0]
+                deadline.check()
+                timeout = deadline.remaining()
+                if hedge_at is not None:
+                    hedge_wait = hedge_at - time.monotonic()
+                    if hedge_wait <= 0:
+                        # no hedge when too many calls are running already
+                        if call_slots.acquire(blocking=False):
+                            start(1, hedge)
+                        hedge_at = None
+                        continue
+                    timeout = hedge_wait if timeout is None else min(timeout, hedge_wait)
+                condition.wait(timeout)
+    finally:
+        if on_abandon is not None:
+            for index in running:
+                on_abandon(index)
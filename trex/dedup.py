@@ -0,0 +1,217 @@
+import copy
+import io
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from .image import ImageHandle
+from .streaming import imap_unordered
+
+HASH_METHODS = ("ahash", "dhash", "phash")
+
+
+def load_gray(image: Union[str, bytes, np.ndarray, Image.Image, ImageHandle],
+              size: Tuple[int, int]) -> np.ndarray:
+    """Load an image as a small grayscale array.
+
+    Args:
+        image (Union[str, bytes, np.ndarray, Image.Image, ImageHandle]): File path, encoded
+            bytes, array, PIL image or handle. The pixels of a handle are reused if it was
+            decoded already.
+        size (Tuple[int, int]): (width, height) of the output.
+
+    Returns:
+        np.ndarray: Grayscale image in shape (height, width), float32.
+    """
+    if isinstance(image, ImageHandle):
+        image = image.array if image.is_decoded else (image.path or image.encoded)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+    if isinstance(image, (str, io.BytesIO)):
+        image = Image.open(image)
+        # let the JPEG decoder downscale while decoding, much faster for large images
+        image.draft("L", (size[0] * 4, size[1] * 4))
+    elif isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    image = image.convert("L").resize(size, Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32)
+
+
+def dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix in shape (n, n)."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    """Pack boolean bits in shape (N, 64) to uint64 hashes in shape (N)."""
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return packed.view(">u8").reshape(-1).astype(np.uint64)
+
+
+def hash_images(images: Sequence, method: str = "dhash", hash_size: int = 8) -> np.ndarray:
+    """Compute perceptual hashes of images, vectorized over the whole batch.
+
+    Args:
+        images (Sequence): File paths, encoded bytes, arrays, PIL images or handles.
+        method (str): One of "ahash" (mean threshold), "dhash" (horizontal gradient) or
+            "phash" (low frequency DCT). Defaults to "dhash".
+        hash_size (int): Side of the hash, hash_size * hash_size must be 64. Defaults to 8.
+
+    Returns:
+        np.ndarray: Hashes in shape (N), uint64.
+    """
+    assert method in HASH_METHODS, f"Invalid hash method {method}"
+    assert hash_size * hash_size == 64, "Hashes are packed in 64 bits"
+    if len(images) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    if method == "ahash":
+        grays = np.stack([load_gray(image, (hash_size, hash_size)) for image in images])
+        bits = grays > grays.mean(axis=(1, 2), keepdims=True)
+    elif method == "dhash":
+        grays = np.stack([load_gray(image, (hash_size + 1, hash_size)) for image in images])
+        bits = grays[:, :, 1:] > grays[:, :, :-1]
+    else:
+        side = hash_size * 4
+        grays = np.stack([load_gray(image, (side, side)) for image in images])
+        dct = dct_matrix(side)
+        coefficients = (dct @ grays @ dct.T)[:, :hash_size, :hash_size]
+        medians = np.median(coefficients.reshape(len(grays), -1), axis=1)
+        bits = coefficients > medians[:, None, None]
+    return pack_bits(bits)
+
+
+class BKTree:
+    """BK-tree over 64 bit hashes for Hamming distance range queries."""
+
+    def __init__(self):
+        # node: [hash, index, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash_value: int, index: int):
+        hash_value = int(hash_value)
+        node = [hash_value, index, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = bin(current[0] ^ hash_value).count("1")
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def query(self, hash_value: int, max_distance: int) -> List[Tuple[int, int]]:
+        """Return (distance, index) of all the hashes within `max_distance`."""
+        hash_value = int(hash_value)
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = bin(node[0] ^ hash_value).count("1")
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            # triangle inequality: only children in [d - max, d + max] can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return matches
+
+
+def group_hashes(hashes: np.ndarray, max_distance: int = 4) -> np.ndarray:
+    """Group near-identical hashes. Each hash joins the closest earlier representative
+    within `max_distance`, or becomes a new representative.
+
+    Args:
+        hashes (np.ndarray): Hashes in shape (N), uint64.
+        max_distance (int): Maximum Hamming distance between an image and the
+            representative of its group. Defaults to 4.
+
+    Returns:
+        np.ndarray: Index of the representative of each hash in shape (N).
+    """
+    tree = BKTree()
+    representatives = np.zeros(len(hashes), dtype=np.int64)
+    for index, hash_value in enumerate(hashes):
+        matches = tree.query(hash_value, max_distance)
+        if matches:
+            representatives[index] = min(matches)[1]
+        else:
+            tree.add(hash_value, index)
+            representatives[index] = index
+    return representatives
+
+
+class DedupStage:
+    """Run inference only once per group of near-identical images and share the result
+    with the rest of the group.
+
+    Images are file paths, encoded bytes, arrays, PIL images or `ImageHandle`s, which are
+    hashed locally before `infer_fn` gets them. Urls can not be hashed, and file objects
+    would be consumed by the hashing, wrap them in an `ImageHandle` instead.
+
+    Args:
+        infer_fn (Callable): Function taking one image and returning its result, e.g.
+            `lambda image: trex2.generic_inference(image, prompts)`.
+        method (str): Perceptual hash, one of "ahash", "dhash" or "phash". Defaults to
+            "dhash".
+        max_distance (int): Maximum Hamming distance to consider two images duplicates.
+            Defaults to 4.
+        max_workers (int): Number of representatives inferred at the same time. Defaults
+            to 4.
+    """
+
+    def __init__(self,
+                 infer_fn: Callable,
+                 method: str = "dhash",
+                 max_distance: int = 4,
+                 max_workers: int = 4):
+        assert method in HASH_METHODS, f"Invalid hash method {method}"
+        self.infer_fn = infer_fn
+        self.method = method
+        self.max_distance = max_distance
+        self.max_workers = max_workers
+        self.num_images = 0
+        self.num_inferred = 0
+
+    @property
+    def dedup_rate(self) -> float:
+        """Fraction of the images whose inference was skipped."""
+        return 1 - self.num_inferred / max(self.num_images, 1)
+
+    def group(self, images: Sequence) -> np.ndarray:
+        """Return the index of the representative of each image in shape (N)."""
+        return group_hashes(hash_images(images, self.method), self.max_distance)
+
+    def __call__(self, images: Sequence) -> List[Dict]:
+        """Infer the images, calling `infer_fn` once per group of duplicates.
+
+        Args:
+            images (Sequence): Images accepted by both `infer_fn` and `hash_images`.
+
+        Returns:
+            List[Dict]: Result of each image, in the same order as `images`.
+        """
+        representatives = self.group(images)
+        unique = np.unique(representatives)
+        results = {}
+        for i, result in imap_unordered(self.infer_fn, [images[j] for j in unique],
+                                        self.max_workers):
+            results[unique[i]] = result
+        self.num_images += len(images)
+        self.num_inferred += len(unique)
+        return [
+            results[j] if i == j else copy.deepcopy(results[j])
+            for i, j in enumerate(representatives)
+        ]
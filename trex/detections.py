@@ -0,0 +1,155 @@
+from typing import Dict, Iterator, List, Union
+
+import numpy as np
+
+
+class DetectionBatch:
+    """Detections of a batch of images stored in contiguous arrays.
+
+    The detections of all the images are concatenated, and the detections of image `i` are
+    `boxes[offsets[i]:offsets[i + 1]]`. Indexing returns zero-copy views on the arrays.
+
+    Args:
+        boxes (np.ndarray): Boxes in shape (N, 4), [xmin, ymin, xmax, ymax] format.
+        scores (np.ndarray): Scores in shape (N).
+        labels (np.ndarray): Labels in shape (N).
+        offsets (np.ndarray): Start of the detections of each image in shape (B + 1),
+            offsets[0] is 0 and offsets[-1] is N.
+    """
+
+    __slots__ = ("boxes", "scores", "labels", "offsets")
+
+    def __init__(self, boxes: np.ndarray, scores: np.ndarray, labels: np.ndarray,
+                 offsets: np.ndarray):
+        self.boxes = np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.scores = np.ascontiguousarray(scores, dtype=np.float32).reshape(-1)
+        self.labels = np.ascontiguousarray(labels, dtype=np.int32).reshape(-1)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64).reshape(-1)
+        assert len(self.boxes) == len(self.scores) == len(self.labels) == self.offsets[-1], \
+            "Boxes, scores, labels and offsets do not match"
+
+    @classmethod
+    def from_object_batches(cls, object_batches: List[List]) -> "DetectionBatch":
+        """Build a batch from the objects returned by the API, see
+        `TRex2APIWrapper.postprocess`. Generic inference objects have no category_id and
+        get label 0."""
+        counts = [len(batch) for batch in object_batches]
+        total = sum(counts)
+        objects = [obj for batch in object_batches for obj in batch]
+        scores = np.fromiter((obj.score for obj in objects), dtype=np.float32, count=total)
+        labels = np.fromiter((getattr(obj, "category_id", 0) for obj in objects),
+                             dtype=np.int32,
+                             count=total)
+        boxes = np.array([obj.bbox for obj in objects], dtype=np.float32).reshape(-1, 4)
+        return cls(boxes, scores, labels, np.concatenate([[0], np.cumsum(counts)]))
+
+    @classmethod
+    def from_results(cls, results: List[Dict]) -> "DetectionBatch":
+        """Build a batch from results in the dict format returned by the wrapper."""
+        counts = [len(result["scores"]) for result in results]
+        if sum(counts) == 0:
+            return cls.empty(len(results))
+        return cls(
+            np.concatenate([np.asarray(r["boxes"], dtype=np.float32).reshape(-1, 4)
+                            for r in results]),
+            np.concatenate([np.asarray(r["scores"], dtype=np.float32).reshape(-1)
+                            for r in results]),
+            np.concatenate([np.asarray(r["labels"], dtype=np.int32).reshape(-1)
+                            for r in results]),
+            np.concatenate([[0], np.cumsum(counts)]),
+        )
+
+    @classmethod
+    def empty(cls, batch_size: int = 0) -> "DetectionBatch":
+        """Build a batch of `batch_size` images without detections."""
+        return cls(np.zeros((0, 4)), np.zeros(0), np.zeros(0), np.zeros(batch_size + 1))
+
+    def __len__(self) -> int:
+        """Number of images in the batch."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> Dict[str, np.ndarray]:
+        """Detections of one image as zero-copy views, in the dict format of the wrapper."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Image index out of range")
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return {
+            "scores": self.scores[start:end],
+            "labels": self.labels[start:end],
+            "boxes": self.boxes[start:end],
+        }
+
+    def __iter__(self) -> Iterator[Dict[str, np.ndarray]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f"DetectionBatch(num_images={len(self)}, num_detections={self.num_detections})"
+
+    @property
+    def num_detections(self) -> int:
+        return len(self.scores)
+
+    @property
+    def counts(self) -> np.ndarray:
+        """Number of detections of each image in shape (B)."""
+        return np.diff(self.offsets)
+
+    @property
+    def image_ids(self) -> np.ndarray:
+        """Index of the image of each detection in shape (N)."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def select(self, mask: np.ndarray) -> "DetectionBatch":
+        """Keep the detections where `mask` (shape (N), bool) is True."""
+        counts = np.bincount(self.image_ids[mask], minlength=len(self))
+        return DetectionBatch(self.boxes[mask], self.scores[mask], self.labels[mask],
+                              np.concatenate([[0], np.cumsum(counts)]))
+
+    def filter(self, score_threshold: float) -> "DetectionBatch":
+        """Keep the detections with a score higher than `score_threshold`."""
+        return self.select(self.scores > score_threshold)
+
+    def topk(self, k: int) -> "DetectionBatch":
+        """Keep the `k` highest scoring detections of each image, sorted by score."""
+        image_ids = self.image_ids
+        # sort by image, then by decreasing score
+        order = np.lexsort((-self.scores, image_ids))
+        ranks = np.arange(len(order)) - self.offsets[image_ids[order]]
+        order = order[ranks < k]
+        counts = np.bincount(image_ids[order], minlength=len(self))
+        return DetectionBatch(self.boxes[order], self.scores[order], self.labels[order],
+                              np.concatenate([[0], np.cumsum(counts)]))
+
+    def to_list(self) -> List[Dict]:
+        """Convert to the list of dicts with python lists returned by the wrapper. Scores and
+        boxes are python floats of the float32 values of the batch, so they are not the
+        exact values returned by the API, e.g. a score of 0.1 becomes 0.10000000149011612,
+        and integer boxes become floats. `TRex2APIWrapper.postprocess` keeps the exact
+        values:
+            [
+                {
+                    "scores": (List[float]): A list of scores for each object in the batch
+                    "labels": (List[int]): A list of labels for each object in the batch
+                    "boxes": (List[List[float]]): A list of boxes for each object in the batch
+                }
+            ]
+        """
+        scores, labels, boxes = self.scores.tolist(), self.labels.tolist(), self.boxes.tolist()
+        return [{
+            "scores": scores[start:end],
+            "labels": labels[start:end],
+            "boxes": boxes[start:end],
+        } for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+
+def as_detection_batch(results: Union[Dict, List[Dict], DetectionBatch]) -> DetectionBatch:
+    """Convert one result, a list of results as returned by `postprocess`, or a
+    `DetectionBatch` to a `DetectionBatch`."""
+    if isinstance(results, DetectionBatch):
+        return results
+    if isinstance(results, dict):
+        results = [results]
+    return DetectionBatch.from_results(results)
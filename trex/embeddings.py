@@ -0,0 +1,585 @@
+import argparse
+import json
+import os
+import struct
+import tempfile
+import urllib.request
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+# safetensors dtype -> numpy dtype, BF16 has no numpy equivalent and is handled apart
+SAFETENSORS_DTYPES = {
+    "F64": "<f8",
+    "F32": "<f4",
+    "F16": "<f2",
+    "I64": "<i8",
+    "I32": "<i4",
+    "I16": "<i2",
+    "I8": "i1",
+    "U8": "u1",
+    "BOOL": "?",
+    "BF16": "<u2",
+}
+NUMPY_DTYPES = {np.dtype(v).str: k for k, v in SAFETENSORS_DTYPES.items() if k != "BF16"}
+
+BANK_METADATA_KEY = "trex_embedding_bank"
+# metadata key of the number of visual prompts an embedding was customized from
+PROMPT_COUNT_KEY = "prompt_count"
+
+
+def read_safetensors_header(path: str) -> Tuple[Dict, int]:
+    """Read the header of a safetensors file without reading the tensors.
+
+    Returns:
+        Tuple[Dict, int]: The header and the offset of the tensor data in the file.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def tensor_from_buffer(buffer: np.ndarray, info: Dict) -> np.ndarray:
+    """Build a tensor from its raw bytes and its safetensors header entry. The tensor is a
+    zero-copy view on `buffer`, except BF16 tensors which are converted to float32."""
+    array = buffer.view(SAFETENSORS_DTYPES[info["dtype"]]).reshape(info["shape"])
+    if info["dtype"] == "BF16":
+        array = (array.astype(np.uint32) << 16).view(np.float32)
+    return array
+
+
+def float32_to_bf16(array: np.ndarray) -> np.ndarray:
+    """Convert float32 values to BF16 bit patterns (uint16), rounding to nearest even."""
+    bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+    rounding = 0x7FFF + ((bits >> 16) & 1)
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def parse_safetensors(content: bytes) -> Tuple[Dict[str, np.ndarray], Dict[str, str]]:
+    """Parse the content of a safetensors file with numpy, torch is not required.
+
+    Returns:
+        Tuple[Dict[str, np.ndarray], Dict[str, str]]: The tensors and the metadata.
+    """
+    header_size = struct.unpack("<Q", content[:8])[0]
+    header = json.loads(content[8:8 + header_size])
+    metadata = header.pop("__metadata__", {})
+    data = np.frombuffer(content, dtype=np.uint8, offset=8 + header_size)
+    tensors = {
+        name: tensor_from_buffer(data[info["data_offsets"][0]:info["data_offsets"][1]], info)
+        for name, info in header.items()
+    }
+    return tensors, metadata
+
+
+def load_safetensors(path: str) -> Tuple[Dict[str, np.ndarray], Dict[str, str]]:
+    """Load a safetensors file with numpy, torch is not required.
+
+    Returns:
+        Tuple[Dict[str, np.ndarray], Dict[str, str]]: The tensors and the metadata.
+    """
+    with open(path, "rb") as f:
+        return parse_safetensors(f.read())
+
+
+def safetensors_bytes(tensors: Dict[str, Union[np.ndarray, Tuple[str, List, bytes]]],
+                      metadata: Dict[str, str] = None) -> bytes:
+    """Serialize tensors to the safetensors format.
+
+    Args:
+        tensors (Dict): Name -> tensor. A tensor is either a numpy array or a raw
+            (dtype, shape, data) tuple, where dtype is a safetensors dtype such as "BF16".
+        metadata (Dict[str, str]): Optional string metadata. Defaults to None.
+
+    Returns:
+        bytes: The content of the safetensors file.
+    """
+    header = {}
+    chunks = []
+    offset = 0
+    for name, tensor in tensors.items():
+        if isinstance(tensor, np.ndarray):
+            tensor = np.ascontiguousarray(tensor)
+            dtype = NUMPY_DTYPES.get(tensor.dtype.str)
+            assert dtype is not None, f"Unsupported dtype {tensor.dtype} of tensor {name}"
+            tensor = (dtype, list(tensor.shape), tensor.tobytes())
+        dtype, shape, data = tensor
+        header[name] = {
+            "dtype": dtype,
+            "shape": list(shape),
+            "data_offsets": [offset, offset + len(data)]
+        }
+        chunks.append(data)
+        offset += len(data)
+    if metadata:
+        header["__metadata__"] = metadata
+    header = json.dumps(header, separators=(",", ":")).encode()
+    # pad the header so that the tensor data is 8 bytes aligned
+    header += b" " * (-len(header) % 8)
+    return struct.pack("<Q", len(header)) + header + b"".join(chunks)
+
+
+def save_safetensors(path: str,
+                     tensors: Dict[str, Union[np.ndarray, Tuple[str, List, bytes]]],
+                     metadata: Dict[str, str] = None):
+    """Save tensors to a safetensors file, see `safetensors_bytes` for the arguments."""
+    with open(path, "wb") as f:
+        f.write(safetensors_bytes(tensors, metadata))
+
+
+def download_embedding(url: str, path: str, prompt_count: int = None) -> str:
+    """Download an embedding returned by `customize_embedding`.
+
+    Args:
+        url (str): Url of the embedding.
+        path (str): Path of the safetensors file to write.
+        prompt_count (int): Number of visual prompts the embedding was customized from,
+            stored in the metadata so that it can be refined later with
+            `merge_embeddings`. Defaults to None, which stores nothing.
+
+    Returns:
+        str: `path`
+    """
+    with urllib.request.urlopen(url) as response:
+        data = response.read()
+    if prompt_count is not None:
+        tensors, metadata = parse_safetensors(data)
+        metadata[PROMPT_COUNT_KEY] = str(prompt_count)
+        data = safetensors_bytes(tensors, metadata)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def merge_embeddings(base_path: str,
+                     update_path: str,
+                     output_path: str,
+                     base_count: int = None,
+                     update_count: int = None) -> int:
+    """Merge two embeddings of the same category with a running mean weighted by the
+    number of visual prompts each one was customized from. Refining an embedding with new
+    prompts therefore only needs to customize the new prompts.
+
+    Args:
+        base_path (str): Safetensors file of the existing embedding.
+        update_path (str): Safetensors file of the embedding of the new prompts.
+        output_path (str): Path of the merged embedding, can be `base_path`.
+        base_count (int): Prompt count of the existing embedding. Defaults to None, which
+            reads it from the metadata of the file.
+        update_count (int): Prompt count of the new embedding. Defaults to None, which
+            reads it from the metadata of the file.
+
+    Returns:
+        int: The prompt count of the merged embedding, stored in its metadata.
+    """
+    base, base_metadata = load_safetensors(base_path)
+    update, update_metadata = load_safetensors(update_path)
+    base_header, _ = read_safetensors_header(base_path)
+    if base_count is None:
+        assert PROMPT_COUNT_KEY in base_metadata, f"Unknown prompt count of {base_path}"
+        base_count = int(base_metadata[PROMPT_COUNT_KEY])
+    if update_count is None:
+        assert PROMPT_COUNT_KEY in update_metadata, f"Unknown prompt count of {update_path}"
+        update_count = int(update_metadata[PROMPT_COUNT_KEY])
+    assert base.keys() == update.keys(), "Embeddings have different tensors"
+    total_count = base_count + update_count
+    merged = {}
+    for name, tensor in base.items():
+        assert tensor.shape == update[name].shape, f"Tensor {name} has different shapes"
+        mean = (tensor.astype(np.float64) * base_count +
+                update[name].astype(np.float64) * update_count) / total_count
+        if base_header[name]["dtype"] == "BF16":
+            merged[name] = ("BF16", list(tensor.shape), float32_to_bf16(mean).tobytes())
+        else:
+            merged[name] = mean.astype(tensor.dtype)
+    save_safetensors(output_path, merged, dict(base_metadata,
+                                               **{PROMPT_COUNT_KEY: str(total_count)}))
+    return total_count
+
+
+class EmbeddingBank:
+    """Read-only bank of category embeddings stored in one memory-mapped file.
+
+    A bank is a valid safetensors file: the tensor "<category>/<name>" is the tensor
+    <name> of the embedding of <category>, and the metadata holds an index mapping each
+    category to its tensors and to the metadata of its original file. Opening a bank only
+    reads the header, tensors are zero-copy views on the memory map, so processes sharing a
+    bank share its page cache.
+
+    Args:
+        path (str): Path to the bank, see `pack_embeddings`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        header, data_start = read_safetensors_header(path)
+        metadata = header.pop("__metadata__", {})
+        assert BANK_METADATA_KEY in metadata, f"{path} is not an embedding bank"
+        self.index = json.loads(metadata[BANK_METADATA_KEY])
+        self.header = header
+        self.data = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start) \
+            if os.path.getsize(path) > data_start else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, category: str) -> bool:
+        return category in self.index
+
+    def __getitem__(self, category: str) -> Dict[str, np.ndarray]:
+        return self.get(category)
+
+    @property
+    def categories(self) -> List[str]:
+        return list(self.index)
+
+    def raw_tensors(self, category: str) -> Dict[str, Tuple[str, List, memoryview]]:
+        """Tensors of a category as raw (dtype, shape, data) tuples, without conversion."""
+        tensors = {}
+        for name, key in self.index[category]["tensors"].items():
+            info = self.header[key]
+            start, end = info["data_offsets"]
+            tensors[name] = (info["dtype"], info["shape"], memoryview(self.data[start:end]))
+        return tensors
+
+    def get(self, category: str) -> Dict[str, np.ndarray]:
+        """Tensors of the embedding of a category, as zero-copy views on the bank."""
+        tensors = {}
+        for name, key in self.index[category]["tensors"].items():
+            info = self.header[key]
+            start, end = info["data_offsets"]
+            tensors[name] = tensor_from_buffer(self.data[start:end], info)
+        return tensors
+
+    def metadata(self, category: str) -> Dict[str, str]:
+        """Metadata of the original embedding file of a category."""
+        return dict(self.index[category]["metadata"])
+
+    def safetensors_bytes(self, category: str) -> bytes:
+        """The embedding of a category as the content of a standalone safetensors file,
+        e.g. to pass it to `embedding_inference`."""
+        return safetensors_bytes(self.raw_tensors(category), self.metadata(category) or None)
+
+    def extract(self, category: str, path: str):
+        """Write the embedding of a category to a standalone safetensors file."""
+        with open(path, "wb") as f:
+            f.write(self.safetensors_bytes(category))
+
+
+def pack_embeddings(embeddings: Union[List[str], Dict[str, str]], bank_path: str):
+    """Pack individual safetensors embeddings into one bank. The raw tensor bytes are
+    copied as they are.
+
+    Args:
+        embeddings (Union[List[str], Dict[str, str]]): Category name -> safetensors path.
+            For a list of paths the category name is the file name without extension.
+        bank_path (str): Path of the bank to write.
+    """
+    if not isinstance(embeddings, dict):
+        embeddings = {
+            os.path.splitext(os.path.basename(path))[0]: path
+            for path in embeddings
+        }
+    tensors = {}
+    index = {}
+    for category, path in embeddings.items():
+        header, data_start = read_safetensors_header(path)
+        metadata = header.pop("__metadata__", {})
+        with open(path, "rb") as f:
+            f.seek(data_start)
+            data = f.read()
+        index[category] = {"tensors": {}, "metadata": metadata}
+        for name, info in header.items():
+            key = f"{category}/{name}"
+            start, end = info["data_offsets"]
+            tensors[key] = (info["dtype"], info["shape"], data[start:end])
+            index[category]["tensors"][name] = key
+    save_safetensors(bank_path, tensors, {BANK_METADATA_KEY: json.dumps(index)})
+
+
+def unpack_embeddings(bank_path: str, output_dir: str) -> Dict[str, str]:
+    """Unpack a bank to one safetensors file per category.
+
+    Returns:
+        Dict[str, str]: Category name -> path of the written file.
+    """
+    bank = EmbeddingBank(bank_path)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for category in bank.categories:
+        paths[category] = os.path.join(output_dir, f"{category}.safetensors")
+        bank.extract(category, paths[category])
+    return paths
+
+
+def embedding_count(metadata: Dict[str, str]) -> int:
+    """Prompt count stored in the metadata of an embedding, 1 if unknown."""
+    return int(metadata.get(PROMPT_COUNT_KEY, 1))
+
+
+class EmbeddingIndex:
+    """Cosine similarity index over category embeddings, to find the existing categories
+    a new embedding duplicates instead of adding one more category to every
+    `embedding_inference` request.
+
+    The tensors of an embedding are flattened, in name order, to one L2 normalized vector,
+    so all the similarities of a query are one matrix product.
+
+    Args:
+        duplicate_threshold (float): Cosine similarity from which two embeddings are
+            near-duplicates. Defaults to 0.95.
+    """
+
+    def __init__(self, duplicate_threshold: float = 0.95):
+        self.duplicate_threshold = duplicate_threshold
+        self.categories = []
+        self.vectors = None
+        # category -> safetensors path, or (bank, category) for banked embeddings
+        self.sources = {}
+        # category -> prompt count
+        self.counts = {}
+
+    @classmethod
+    def from_files(cls, embeddings: Union[List[str], Dict[str, str]],
+                   duplicate_threshold: float = 0.95) -> "EmbeddingIndex":
+        """Index safetensors files, see `pack_embeddings` for `embeddings`."""
+        if not isinstance(embeddings, dict):
+            embeddings = {
+                os.path.splitext(os.path.basename(path))[0]: path
+                for path in embeddings
+            }
+        index = cls(duplicate_threshold)
+        for category, path in embeddings.items():
+            index.add(category, path)
+        return index
+
+    @classmethod
+    def from_bank(cls, bank: Union[str, EmbeddingBank],
+                  duplicate_threshold: float = 0.95) -> "EmbeddingIndex":
+        """Index all the categories of an `EmbeddingBank` or the path of a bank."""
+        if not isinstance(bank, EmbeddingBank):
+            bank = EmbeddingBank(bank)
+        index = cls(duplicate_threshold)
+        for category in bank.categories:
+            index.add(category, bank.get(category),
+                      prompt_count=embedding_count(bank.metadata(category)))
+            index.sources[category] = (bank, category)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.categories)
+
+    def __contains__(self, category: str) -> bool:
+        return category in self.sources
+
+    @staticmethod
+    def vectorize(embeddings: Union[str, Dict[str, np.ndarray], np.ndarray]) -> np.ndarray:
+        """Normalized vector of an embedding, given as a safetensors path, its tensors or a
+        vector. Also accepts a batch of vectors in shape (M, D)."""
+        if isinstance(embeddings, str):
+            embeddings = load_safetensors(embeddings)[0]
+        if isinstance(embeddings, dict):
+            embeddings = np.concatenate([
+                np.asarray(embeddings[name], dtype=np.float32).reshape(-1)
+                for name in sorted(embeddings)
+            ])
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, np.finfo(np.float32).eps)
+
+    def similarities(self, embeddings) -> np.ndarray:
+        """Cosine similarities in shape (M, N) of M embeddings with the N indexed ones."""
+        vectors = np.atleast_2d(self.vectorize(embeddings))
+        if self.vectors is None:
+            return np.zeros((len(vectors), 0), dtype=np.float32)
+        return vectors @ self.vectors.T
+
+    @property
+    def dim(self) -> int:
+        return -1 if self.vectors is None else self.vectors.shape[1]
+
+    def query(self, embeddings, k: int = 5) -> List[List[Tuple[str, float]]]:
+        """Nearest categories of one or several embeddings.
+
+        Args:
+            embeddings: A safetensors path, a dict of tensors, a vector or vectors in shape
+                (M, D).
+            k (int): Number of categories returned per embedding. Defaults to 5.
+
+        Returns:
+            List[List[Tuple[str, float]]]: (category, similarity) by decreasing similarity,
+                for every embedding.
+        """
+        similarities = self.similarities(embeddings)
+        k = min(k, similarities.shape[1])
+        if k == 0:
+            return [[] for _ in range(len(similarities))]
+        # top k without sorting all the categories, then sort the k
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        return [[(self.categories[i], float(similarities[row, i])) for i in top[row]]
+                for row in range(len(top))]
+
+    def add(self, category: str, embedding: Union[str, Dict[str, np.ndarray]],
+            prompt_count: int = None) -> List[Tuple[str, float]]:
+        """Register the embedding of a category.
+
+        Args:
+            category (str): Name of the category, replaced if it is already indexed.
+            embedding (Union[str, Dict[str, np.ndarray]]): Safetensors path or tensors.
+            prompt_count (int): Number of visual prompts of the embedding, the weight of
+                the embedding when merged. Defaults to None, which reads it from the file
+                metadata, or 1.
+
+        Returns:
+            List[Tuple[str, float]]: The near-duplicates of the embedding among the other
+                categories, (category, similarity) by decreasing similarity. Consider
+                reusing the first one instead of adding a category.
+        """
+        if prompt_count is None:
+            prompt_count = (embedding_count(load_safetensors(embedding)[1])
+                            if isinstance(embedding, str) else 1)
+        vector = self.vectorize(embedding)
+        assert self.vectors is None or vector.shape[0] == self.dim, \
+            f"Embedding of {category} has dimension {vector.shape[0]}, expected {self.dim}"
+        if category in self:
+            self.remove(category)
+        duplicates = [(name, similarity) for name, similarity in self.query(vector, len(self))[0]
+                      if similarity >= self.duplicate_threshold]
+        self.categories.append(category)
+        self.vectors = vector[None] if self.vectors is None else np.vstack([self.vectors,
+                                                                           vector[None]])
+        self.sources[category] = embedding if isinstance(embedding, str) else None
+        self.counts[category] = prompt_count
+        return duplicates
+
+    def remove(self, category: str):
+        i = self.categories.index(category)
+        del self.categories[i]
+        self.vectors = np.delete(self.vectors, i, axis=0) if len(self.categories) else None
+        del self.sources[category]
+        del self.counts[category]
+
+    def duplicate_pairs(self, threshold: float = None) -> List[Tuple[str, str, float]]:
+        """All the pairs of near-duplicate categories, (category, category, similarity) by
+        decreasing similarity."""
+        threshold = self.duplicate_threshold if threshold is None else threshold
+        if self.vectors is None:
+            return []
+        similarities = self.vectors @ self.vectors.T
+        rows, columns = np.nonzero(np.triu(similarities >= threshold, k=1))
+        order = np.argsort(-similarities[rows, columns], kind="stable")
+        return [(self.categories[rows[i]], self.categories[columns[i]],
+                 float(similarities[rows[i], columns[i]])) for i in order]
+
+    def clusters(self, threshold: float = None) -> List[List[str]]:
+        """Groups of categories connected by near-duplicate pairs, the groups of more than
+        one category, each one sorted by decreasing prompt count."""
+        parents = {category: category for category in self.categories}
+
+        def find(category):
+            while parents[category] != category:
+                parents[category] = parents[parents[category]]
+                category = parents[category]
+            return category
+
+        for first, second, _ in self.duplicate_pairs(threshold):
+            parents[find(first)] = find(second)
+        groups = {}
+        for category in self.categories:
+            groups.setdefault(find(category), []).append(category)
+        return [
+            sorted(group, key=lambda category: -self.counts[category])
+            for group in groups.values() if len(group) > 1
+        ]
+
+    def source_path(self, category: str, scratch_dir: str) -> str:
+        """Path of the safetensors file of a category, extracted to `scratch_dir` if it is
+        banked."""
+        source = self.sources[category]
+        if isinstance(source, tuple):
+            bank, name = source
+            path = os.path.join(scratch_dir, f"{category}.safetensors")
+            bank.extract(name, path)
+            return path
+        assert source is not None, f"Embedding of {category} was added without a file"
+        return source
+
+    def merge_duplicates(self, output_dir: str, threshold: float = None) -> Dict[str, str]:
+        """Merge every cluster of near-duplicates into its category with the most prompts,
+        with `merge_embeddings`. The merged embeddings are written to
+        `output_dir/<category>.safetensors` and replace the clusters in the index.
+
+        Returns:
+            Dict[str, str]: Merged category -> category it was merged into, to relabel
+                existing annotations.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        mapping = {}
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            for group in self.clusters(threshold):
+                target = group[0]
+                output_path = os.path.join(output_dir, f"{target}.safetensors")
+                count = self.counts[target]
+                base_path = self.source_path(target, scratch_dir)
+                for category in group[1:]:
+                    count = merge_embeddings(base_path, self.source_path(category, scratch_dir),
+                                             output_path, count, self.counts[category])
+                    base_path = output_path
+                    mapping[category] = target
+                    self.remove(category)
+                self.add(target, output_path, prompt_count=count)
+        return mapping
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Pack or unpack an embedding bank")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack safetensors files into a bank")
+    pack_parser.add_argument("bank", type=str, help="Path of the bank to write")
+    pack_parser.add_argument("embeddings",
+                             type=str,
+                             nargs="+",
+                             help="Safetensors files, named after their category")
+    unpack_parser = subparsers.add_parser("unpack", help="Unpack a bank to safetensors files")
+    unpack_parser.add_argument("bank", type=str, help="Path of the bank to read")
+    unpack_parser.add_argument("output_dir", type=str, help="Directory of the output files")
+    duplicates_parser = subparsers.add_parser(
+        "duplicates", help="Print the clusters of near-duplicate embeddings")
+    duplicates_parser.add_argument("embeddings",
+                                   type=str,
+                                   nargs="+",
+                                   help="Safetensors files named after their category, or "
+                                   "one bank")
+    duplicates_parser.add_argument("--threshold",
+                                   type=float,
+                                   default=0.95,
+                                   help="cosine similarity of near-duplicates")
+    duplicates_parser.add_argument("--merge_dir",
+                                   type=str,
+                                   default=None,
+                                   help="merge each cluster and write the results here")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.command == "pack":
+        pack_embeddings(args.embeddings, args.bank)
+        print(f"Packed {len(args.embeddings)} embeddings to {args.bank}")
+    elif args.command == "unpack":
+        paths = unpack_embeddings(args.bank, args.output_dir)
+        print(f"Unpacked {len(paths)} embeddings to {args.output_dir}")
+    else:
+        if len(args.embeddings) == 1 and not args.embeddings[0].endswith(".safetensors"):
+            index = EmbeddingIndex.from_bank(args.embeddings[0], args.threshold)
+        else:
+            index = EmbeddingIndex.from_files(args.embeddings, args.threshold)
+        for group in index.clusters():
+            print(" ".join(group))
+        if args.merge_dir is not None:
+            mapping = index.merge_duplicates(args.merge_dir)
+            print(f"Merged {len(mapping)} categories into {len(set(mapping.values()))}")
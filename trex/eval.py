@@ -0,0 +1,324 @@
+import argparse
+import json
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from .box_ops import batched_box_iou
+from .detections import DetectionBatch, as_detection_batch
+
+# IoU thresholds of the COCO AP, 0.5:0.05:0.95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+# recall points of the interpolated precision of the COCO AP
+RECALL_POINTS = np.linspace(0, 1, 101)
+# score thresholds of `threshold_sweep`
+SCORE_THRESHOLDS = np.linspace(0, 1, 101)[:-1]
+# maximum number of (prediction, ground truth) IoUs computed at once by `match_detections`
+CHUNK_SIZE = 1 << 22
+
+Results = Union[Dict, List[Dict], DetectionBatch]
+
+
+def coco_to_batch(entries: List[Dict], image_ids: List, with_scores: bool) -> DetectionBatch:
+    """Group COCO annotations or results, with [x, y, w, h] boxes, per image."""
+    index = {image_id: i for i, image_id in enumerate(image_ids)}
+    entries = [entry for entry in entries if entry["image_id"] in index]
+    images = np.array([index[entry["image_id"]] for entry in entries], dtype=np.int64)
+    order = np.argsort(images, kind="stable")
+    boxes = np.array([entry["bbox"] for entry in entries], dtype=np.float32).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    labels = np.array([entry["category_id"] for entry in entries], dtype=np.int32)
+    scores = (np.array([entry["score"] for entry in entries], dtype=np.float32)
+              if with_scores else np.ones(len(entries), dtype=np.float32))
+    counts = np.bincount(images, minlength=len(image_ids))
+    return DetectionBatch(boxes[order], scores[order], labels[order],
+                          np.concatenate([[0], np.cumsum(counts)]))
+
+
+def load_coco_ground_truth(annotation_file: str,
+                           image_ids: List = None) -> Tuple[DetectionBatch, List]:
+    """Load the ground truth of a COCO annotation file. Crowd annotations are dropped.
+
+    Args:
+        annotation_file (str): Path of the annotation file.
+        image_ids (List): COCO ids of the images, in the order of the predictions.
+            Defaults to None, which uses all the images of the file in file order.
+
+    Returns:
+        Tuple[DetectionBatch, List]: Ground truth boxes with category ids as labels and
+            scores of 1, and the image ids.
+    """
+    with open(annotation_file) as f:
+        coco = json.load(f)
+    if image_ids is None:
+        image_ids = [image["id"] for image in coco["images"]]
+    annotations = [
+        annotation for annotation in coco["annotations"] if not annotation.get("iscrowd", 0)
+    ]
+    return coco_to_batch(annotations, image_ids, with_scores=False), image_ids
+
+
+def load_coco_results(results_file: str, image_ids: List) -> DetectionBatch:
+    """Load predictions in the COCO results format, a list of {"image_id", "category_id",
+    "bbox", "score"}, for the images `image_ids`."""
+    with open(results_file) as f:
+        return coco_to_batch(json.load(f), image_ids, with_scores=True)
+
+
+def match_detections(predictions: Results,
+                     ground_truth: Results,
+                     iou_thresholds: Sequence[float] = IOU_THRESHOLDS,
+                     class_aware: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """Match predictions to ground truth boxes like the COCO evaluation: in decreasing
+    score order, each prediction takes the unmatched ground truth box of its image (and
+    label) with the highest IoU, if that IoU is at least the threshold.
+
+    The matching runs for all the IoU thresholds and a chunk of images at once, with one
+    step per prediction rank instead of one per prediction.
+
+    Args:
+        predictions (Results): Predictions of B images, results of `postprocess` or a
+            `DetectionBatch`.
+        ground_truth (Results): Ground truth boxes of the same B images.
+        iou_thresholds (Sequence[float]): IoU thresholds, T values. Defaults to the COCO
+            thresholds 0.5:0.05:0.95.
+        class_aware (bool): Only match boxes with the same label. Defaults to True, set to
+            False for generic inference whose labels are all 0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Match masks of the predictions in shape (N, T) and of
+            the ground truth boxes in shape (M, T), in the order of the inputs.
+    """
+    pred = as_detection_batch(predictions)
+    gt = as_detection_batch(ground_truth)
+    assert len(pred) == len(gt), "Predictions and ground truth must have the same images"
+    thresholds = np.asarray(iou_thresholds, dtype=np.float32).reshape(-1)
+    pred_matches = np.zeros((pred.num_detections, len(thresholds)), dtype=bool)
+    gt_matches = np.zeros((gt.num_detections, len(thresholds)), dtype=bool)
+    # sort by image, then by decreasing score, the images keep their offsets
+    order = np.lexsort((-pred.scores, pred.image_ids))
+    pred_counts, gt_counts = pred.counts, gt.counts
+    images = np.nonzero((pred_counts > 0) & (gt_counts > 0))[0]
+    # images of similar sizes in the same chunk limit the padding
+    images = images[np.lexsort((gt_counts[images], pred_counts[images]))]
+    begin = 0
+    while begin < len(images):
+        end, max_gt = begin, 0
+        while end < len(images):
+            max_gt = max(max_gt, gt_counts[images[end]])
+            if end > begin and (end + 1 - begin) * pred_counts[images[end]] * max_gt > CHUNK_SIZE:
+                break
+            end += 1
+        chunk = images[begin:end]
+        begin = end
+        num_pred, num_gt = pred_counts[chunk].max(), gt_counts[chunk].max()
+        # padded detections of the chunk, pred_index in decreasing score order
+        pred_valid = np.arange(num_pred) < pred_counts[chunk, None]
+        pred_index = order[np.where(pred_valid, pred.offsets[chunk, None] + np.arange(num_pred),
+                                    0)]
+        gt_valid = np.arange(num_gt) < gt_counts[chunk, None]
+        gt_index = np.where(gt_valid, gt.offsets[chunk, None] + np.arange(num_gt), 0)
+        ious = batched_box_iou(pred.boxes[pred_index], gt.boxes[gt_index])
+        pairs = pred_valid[:, :, None] & gt_valid[:, None, :]
+        if class_aware:
+            pairs &= pred.labels[pred_index][:, :, None] == gt.labels[gt_index][:, None, :]
+        ious[~pairs] = -1
+        # unmatched ground truth boxes per threshold in shape (C, T, G)
+        available = np.repeat(gt_valid[:, None, :], len(thresholds), axis=1)
+        rows = np.arange(len(chunk))[:, None]
+        columns = np.arange(len(thresholds))[None, :]
+        for rank in range(num_pred):
+            candidates = np.where(available, ious[:, None, rank, :], -1)
+            best = candidates.argmax(axis=2)
+            hits = candidates[rows, columns, best] >= thresholds
+            available[rows, columns, best] &= ~hits
+            valid = pred_valid[:, rank]
+            pred_matches[pred_index[valid, rank]] = hits[valid]
+        gt_matches[gt_index[gt_valid]] = ~available.transpose(0, 2, 1)[gt_valid]
+    return pred_matches, gt_matches
+
+
+def evaluate_detections(predictions: Results,
+                        ground_truth: Results,
+                        iou_thresholds: Sequence[float] = IOU_THRESHOLDS,
+                        max_detections: int = 100,
+                        class_aware: bool = True) -> Dict:
+    """COCO style AP and AR, over all the object sizes.
+
+    AP is the precision interpolated at 101 recall points, AR the recall with the
+    `max_detections` best predictions of each image, both averaged over the labels of the
+    ground truth and the IoU thresholds.
+
+    Args:
+        predictions (Results): Predictions of B images, results of `postprocess` or a
+            `DetectionBatch`.
+        ground_truth (Results): Ground truth boxes of the same B images, see
+            `load_coco_ground_truth`.
+        iou_thresholds (Sequence[float]): IoU thresholds. Defaults to 0.5:0.05:0.95.
+        max_detections (int): Predictions kept per image. Defaults to 100, None keeps all.
+        class_aware (bool): Evaluate each label separately. Defaults to True, set to
+            False for generic inference whose labels are all 0.
+
+    Returns:
+        Dict: {
+            "AP" (float), "AR" (float): Means over the labels and thresholds,
+            "AP50" (float), "AP75" (float): AP at IoU 0.5 and 0.75, if evaluated,
+            "ap" (np.ndarray), "ar" (np.ndarray): Per threshold and label in shape (T, K),
+            "labels" (np.ndarray): The K labels of the ground truth,
+            "iou_thresholds" (np.ndarray): The T thresholds,
+        }
+    """
+    pred = as_detection_batch(predictions)
+    gt = as_detection_batch(ground_truth)
+    if max_detections is not None:
+        pred = pred.topk(max_detections)
+    thresholds = np.asarray(iou_thresholds, dtype=np.float32).reshape(-1)
+    pred_matches, gt_matches = match_detections(pred, gt, thresholds, class_aware)
+    pred_labels = pred.labels if class_aware else np.zeros_like(pred.labels)
+    gt_labels = gt.labels if class_aware else np.zeros_like(gt.labels)
+    labels, num_gt = np.unique(gt_labels, return_counts=True)
+    # sort by label, then by decreasing score
+    order = np.lexsort((-pred.scores, pred_labels))
+    starts = np.searchsorted(pred_labels[order], labels, side="left")
+    ends = np.searchsorted(pred_labels[order], labels, side="right")
+    ap = np.zeros((len(thresholds), len(labels)))
+    ar = np.zeros((len(thresholds), len(labels)))
+    for k, label in enumerate(labels):
+        ar[:, k] = gt_matches[gt_labels == label].mean(axis=0)
+        matches = pred_matches[order[starts[k]:ends[k]]]
+        if len(matches) == 0:
+            continue
+        true_positives = np.cumsum(matches, axis=0)
+        recall = true_positives / num_gt[k]
+        precision = true_positives / np.arange(1, len(matches) + 1)[:, None]
+        # precision envelope, the best precision at any higher recall
+        precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+        for t in range(len(thresholds)):
+            indices = np.searchsorted(recall[:, t], RECALL_POINTS, side="left")
+            reached = indices < len(matches)
+            ap[t, k] = np.where(reached, precision[np.minimum(indices, len(matches) - 1), t],
+                                0).mean()
+    metrics = {
+        "AP": float(ap.mean()) if ap.size else 0.0,
+        "AR": float(ar.mean()) if ar.size else 0.0,
+    }
+    for name, threshold in (("AP50", 0.5), ("AP75", 0.75)):
+        index = np.flatnonzero(np.isclose(thresholds, threshold))
+        if len(index) and len(labels):
+            metrics[name] = float(ap[index[0]].mean())
+    metrics.update({"ap": ap, "ar": ar, "labels": labels, "iou_thresholds": thresholds})
+    return metrics
+
+
+def count_errors(predictions: Results, ground_truth: Results,
+                 score_threshold: float = 0.3) -> Dict[str, float]:
+    """Counting errors per image, the count of an image is its number of predictions with a
+    score higher than `score_threshold`.
+
+    Returns:
+        Dict[str, float]: {"MAE": mean absolute error, "RMSE": root mean squared error}
+    """
+    pred = as_detection_batch(predictions).filter(score_threshold)
+    gt = as_detection_batch(ground_truth)
+    assert len(pred) == len(gt), "Predictions and ground truth must have the same images"
+    errors = (pred.counts - gt.counts).astype(np.float64)
+    return {
+        "MAE": float(np.abs(errors).mean()) if len(errors) else 0.0,
+        "RMSE": float(np.sqrt((errors**2).mean())) if len(errors) else 0.0,
+    }
+
+
+def threshold_sweep(predictions: Results,
+                    ground_truth: Results,
+                    score_thresholds: Sequence[float] = SCORE_THRESHOLDS,
+                    iou_threshold: float = 0.5,
+                    class_aware: bool = True) -> Dict[str, np.ndarray]:
+    """Detection and counting metrics at every score threshold, from one matching.
+
+    The greedy matching goes by decreasing score, so raising the threshold only drops
+    predictions without changing the matches of the others, and every threshold is read
+    from cumulative histograms of the scores.
+
+    Args:
+        predictions (Results): Predictions of B images, results of `postprocess` or a
+            `DetectionBatch`.
+        ground_truth (Results): Ground truth boxes of the same B images.
+        score_thresholds (Sequence[float]): K increasing thresholds, predictions with a
+            score higher than the threshold are kept. Defaults to 0, 0.01, ..., 0.99.
+        iou_threshold (float): IoU of a match. Defaults to 0.5.
+        class_aware (bool): Only match boxes with the same label. Defaults to True.
+
+    Returns:
+        Dict[str, np.ndarray]: Arrays in shape (K): "score_thresholds", "precision" (0
+            without prediction), "recall", "f1", "num_detections", "count_mae" and
+            "count_rmse".
+    """
+    pred = as_detection_batch(predictions)
+    gt = as_detection_batch(ground_truth)
+    thresholds = np.asarray(score_thresholds, dtype=np.float32).reshape(-1)
+    assert np.all(np.diff(thresholds) > 0), "Score thresholds must be increasing"
+    matches, _ = match_detections(pred, gt, [iou_threshold], class_aware)
+    # number of thresholds under each score, a prediction is kept at threshold k if k < bin
+    bins = np.searchsorted(thresholds, pred.scores, side="left")
+    num_bins = len(thresholds) + 1
+
+    def kept(histogram: np.ndarray) -> np.ndarray:
+        # number of entries in the bins after k, for every threshold k
+        return np.cumsum(histogram[..., ::-1], axis=-1)[..., ::-1][..., 1:]
+
+    num_detections = kept(np.bincount(bins, minlength=num_bins))
+    true_positives = kept(np.bincount(bins, weights=matches[:, 0], minlength=num_bins))
+    precision = true_positives / np.maximum(num_detections, 1)
+    recall = true_positives / max(gt.num_detections, 1)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, np.finfo(np.float64).eps)
+    # per image counts at every threshold in shape (B, K)
+    cells = np.bincount(pred.image_ids * num_bins + bins, minlength=len(pred) * num_bins)
+    errors = kept(cells.reshape(len(pred), num_bins)) - gt.counts[:, None]
+    return {
+        "score_thresholds": thresholds,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "num_detections": num_detections,
+        "count_mae": np.abs(errors).mean(axis=0) if len(pred) else np.zeros(len(thresholds)),
+        "count_rmse": (np.sqrt((errors.astype(np.float64)**2).mean(axis=0))
+                       if len(pred) else np.zeros(len(thresholds))),
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Evaluate predictions against COCO ground truth")
+    parser.add_argument("annotations", type=str, help="COCO annotation file")
+    parser.add_argument("results", type=str, help="predictions in the COCO results format")
+    parser.add_argument("--class_agnostic",
+                        action="store_true",
+                        help="match boxes of any label, e.g. for generic inference")
+    parser.add_argument("--max_detections", type=int, default=100)
+    parser.add_argument("--score_threshold",
+                        type=float,
+                        default=0.3,
+                        help="score threshold of the counting errors")
+    parser.add_argument("--sweep",
+                        action="store_true",
+                        help="also print the metrics at every score threshold")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    ground_truth, image_ids = load_coco_ground_truth(args.annotations)
+    predictions = load_coco_results(args.results, image_ids)
+    metrics = evaluate_detections(predictions,
+                                  ground_truth,
+                                  max_detections=args.max_detections,
+                                  class_aware=not args.class_agnostic)
+    metrics.update(count_errors(predictions, ground_truth, args.score_threshold))
+    print(json.dumps({name: value for name, value in metrics.items()
+                      if isinstance(value, float)}, indent=2))
+    if args.sweep:
+        sweep = threshold_sweep(predictions, ground_truth, class_aware=not args.class_agnostic)
+        print("threshold precision recall     f1   count_mae count_rmse")
+        for k, threshold in enumerate(sweep["score_thresholds"]):
+            print(f"{threshold:9.2f} {sweep['precision'][k]:9.4f} {sweep['recall'][k]:6.4f} "
+                  f"{sweep['f1'][k]:6.4f} {sweep['count_mae'][k]:11.3f} "
+                  f"{sweep['count_rmse'][k]:10.3f}")
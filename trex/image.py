@@ -0,0 +1,295 @@
+import hashlib
+import io
+import threading
+from typing import BinaryIO, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# magic numbers of the encoded formats we upload as they are
+FILE_SIGNATURES = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"BM", ".bmp"),
+    (b"II*\x00", ".tif"),
+    (b"MM\x00*", ".tif"),
+)
+
+
+def is_url(image) -> bool:
+    """Tell if an image is a url, e.g. one already returned by `get_image_url`."""
+    return isinstance(image, str) and image.startswith(("http://", "https://"))
+
+
+def is_file_like(image) -> bool:
+    return hasattr(image, "read") and not isinstance(image, (str, bytes))
+
+
+def read_file_like(file: BinaryIO) -> bytes:
+    """Read the content of a binary file-like object, restoring its position if possible."""
+    if isinstance(file, io.BytesIO):
+        return file.getvalue()
+    position = file.tell() if file.seekable() else None
+    data = file.read()
+    if position is not None:
+        file.seek(position)
+    return data
+
+
+def guess_suffix(data: bytes) -> str:
+    """Guess the file extension of encoded image bytes (or a safetensors embedding)."""
+    for signature, suffix in FILE_SIGNATURES:
+        if data.startswith(signature):
+            return suffix
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if len(data) > 9 and data[8:10] == b'{"':
+        # safetensors files start with the header size and a JSON header
+        return ".safetensors"
+    return ".bin"
+
+
+def encode_image(image: Union[np.ndarray, Image.Image], format: str = "PNG") -> bytes:
+    """Encode a decoded image, as an array or a PIL image, to bytes."""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if format == "PNG" and image.mode not in ("1", "L", "LA", "I", "P", "RGB", "RGBA"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def read_image_size(
+        image: Union[str, np.ndarray, Image.Image, bytes, BinaryIO]) -> Optional[Tuple[int, int]]:
+    """Return the (width, height) of an image in any format accepted by `get_image_url`.
+    Files and encoded bytes are opened lazily, so only their header is read and the pixels
+    are not decoded. Returns None for urls, whose size is unknown without downloading them.
+    """
+    if is_url(image):
+        return None
+    if isinstance(image, ImageHandle):
+        return image.size
+    if isinstance(image, Image.Image):
+        return image.size
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+    if is_file_like(image):
+        if not image.seekable():
+            # the header can not be read without consuming the stream
+            return None
+        position = image.tell()
+        try:
+            with Image.open(image) as opened:
+                return opened.size
+        finally:
+            image.seek(position)
+    with Image.open(image) as opened:
+        return opened.size
+
+
+def image_digest(image: Union[str, np.ndarray, Image.Image, bytes, BinaryIO]) -> str:
+    """Hash of the content of an image in any format accepted by `get_image_url`. Urls are
+    hashed as strings."""
+    if isinstance(image, ImageHandle):
+        return image.digest
+    hasher = hashlib.sha1()
+    if is_url(image):
+        hasher.update(image.encode())
+    elif isinstance(image, str):
+        with open(image, "rb") as f:
+            hasher.update(f.read())
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        hasher.update(image)
+    elif is_file_like(image):
+        hasher.update(read_file_like(image))
+    elif isinstance(image, Image.Image):
+        hasher.update(str((image.size, image.mode)).encode())
+        hasher.update(image.tobytes())
+    else:
+        image = np.ascontiguousarray(image)
+        hasher.update(str((image.shape, image.dtype.str)).encode())
+        hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+class ImageHandle:
+    """An image shared by the uploads, crops and visualizations of a request, decoded at
+    most once.
+
+    The source is kept as it is, so a file is uploaded from its path and encoded bytes are
+    uploaded without re-encoding. The decoded pixels, the size, the encoded bytes and the
+    content digest are computed on first use and cached, from any thread. Crops and tiles
+    are handles on zero-copy views of the decoded pixels.
+
+    Every trex function taking an image accepts a handle, e.g. `get_image_url`,
+    `visualize`, the prompt validation, `read_image_size` and `image_digest`.
+
+    Args:
+        image (Union[str, np.ndarray, Image.Image, bytes, BinaryIO]): A file path,
+            encoded bytes, a binary file-like object (read once), a PIL image or an array
+            in HWC format. Urls can not be decoded and are not accepted.
+    """
+
+    def __init__(self, image: Union[str, np.ndarray, Image.Image, bytes, BinaryIO]):
+        assert not is_url(image), "Urls can not be wrapped in an ImageHandle"
+        assert not isinstance(image, ImageHandle), "The image is already a handle"
+        if is_file_like(image):
+            image = read_file_like(image)
+        if isinstance(image, (bytearray, memoryview)):
+            image = bytes(image)
+        self.source = image
+        self.pixels = None
+        self.data = image if isinstance(image, bytes) else None
+        self.image_size = None
+        self.content_digest = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def wrap(cls, image) -> "ImageHandle":
+        """Return `image` if it is a handle, a new handle on it otherwise."""
+        return image if isinstance(image, ImageHandle) else cls(image)
+
+    def __deepcopy__(self, memo) -> "ImageHandle":
+        # the pixels are read-only, copies of a request share the handle
+        return self
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        source = self.path or type(self.source).__name__
+        return f"ImageHandle({source}, decoded={self.pixels is not None})"
+
+    @property
+    def path(self) -> Optional[str]:
+        """Path of the source file, None for other sources."""
+        return self.source if isinstance(self.source, str) else None
+
+    @property
+    def is_decoded(self) -> bool:
+        return self.pixels is not None or isinstance(self.source, (np.ndarray, Image.Image))
+
+    @property
+    def needs_encoding(self) -> bool:
+        """Tell if an upload has to encode the pixels, i.e. the source is decoded and was
+        not encoded yet."""
+        return self.data is None and self.path is None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(width, height), read from the header of encoded sources without decoding."""
+        if self.image_size is None:
+            if self.pixels is not None:
+                self.image_size = self.pixels.shape[1], self.pixels.shape[0]
+            else:
+                self.image_size = read_image_size(self.source)
+        return self.image_size
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    @property
+    def array(self) -> np.ndarray:
+        """The decoded pixels in HWC format, read-only since they are shared. Encoded
+        sources are decoded to RGB, arrays are returned as they are."""
+        if self.pixels is None:
+            with self.lock:
+                if self.pixels is None:
+                    source = self.source
+                    if isinstance(source, np.ndarray):
+                        pixels = source.view()
+                    else:
+                        if not isinstance(source, Image.Image):
+                            source = Image.open(source if self.path else io.BytesIO(source))
+                        if source.mode != "RGB":
+                            source = source.convert("RGB")
+                        pixels = np.asarray(source)
+                    pixels.flags.writeable = False
+                    self.pixels = pixels
+        return self.pixels
+
+    def to_pil(self) -> Image.Image:
+        """A new PIL image of the pixels, e.g. to draw on."""
+        if isinstance(self.source, Image.Image):
+            return self.source.copy()
+        return Image.fromarray(self.array)
+
+    @property
+    def encoded(self) -> bytes:
+        """The encoded image: the bytes of the source file or bytes, PNG for decoded
+        sources."""
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    if self.path is not None:
+                        with open(self.path, "rb") as f:
+                            self.data = f.read()
+                    else:
+                        self.data = encode_image(self.source, format="PNG")
+        return self.data
+
+    @property
+    def suffix(self) -> str:
+        """File extension of the encoded image."""
+        return guess_suffix(self.encoded[:16])
+
+    @property
+    def digest(self) -> str:
+        """Content hash, the same as `image_digest` of the source."""
+        if self.content_digest is None:
+            if isinstance(self.source, bytes) or self.path is not None:
+                self.content_digest = hashlib.sha1(self.encoded).hexdigest()
+            else:
+                self.content_digest = image_digest(self.source)
+        return self.content_digest
+
+    def crop(self, box) -> "ImageHandle":
+        """Handle on a zero-copy view of the [x1, y1, x2, y2] region of the pixels,
+        clipped to the image."""
+        width, height = self.size
+        x1, y1, x2, y2 = (int(round(value)) for value in box)
+        x1, x2 = min(max(x1, 0), width), min(max(x2, 0), width)
+        y1, y2 = min(max(y1, 0), height), min(max(y2, 0), height)
+        assert x2 > x1 and y2 > y1, f"Empty crop {box} of an image of size {self.size}"
+        return ImageHandle(self.array[y1:y2, x1:x2])
+
+    def tiles(self, tile_size: int,
+              overlap: int = 0) -> List[Tuple[Tuple[int, int, int, int], "ImageHandle"]]:
+        """Split the image in tiles of at most `tile_size` pixels, overlapping by `overlap`
+        pixels, with the last row and column of tiles aligned on the image border.
+
+        Returns:
+            List[Tuple[Tuple[int, int, int, int], ImageHandle]]: ([x1, y1, x2, y2] region,
+                handle on a zero-copy view) of every tile, row by row.
+        """
+        assert 0 <= overlap < tile_size, "The overlap must be smaller than the tile size"
+        width, height = self.size
+
+        def starts(length: int) -> List[int]:
+            if length <= tile_size:
+                return [0]
+            values = list(range(0, length - tile_size, tile_size - overlap))
+            return values + [length - tile_size]
+
+        tiles = []
+        for y in starts(height):
+            for x in starts(width):
+                box = (x, y, min(x + tile_size, width), min(y + tile_size, height))
+                tiles.append((box, self.crop(box)))
+        return tiles
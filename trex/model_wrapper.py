@@ -1,5 +1,17 @@
+import copy
+import functools
+import hashlib
+import json
+import os
 import tempfile
-from typing import Dict, List, Union
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import ExitStack, contextmanager
+from typing import (AsyncIterator, BinaryIO, Callable, Dict, Hashable, Iterable, Iterator, List,
+                    Sized, Tuple, Union)
+
 import numpy as np
 from dds_cloudapi_sdk import (
     BatchEmbdInfer,
@@ -9,7 +21,6 @@ from dds_cloudapi_sdk import (
     BatchRectInfer,
     BatchRectPrompt,
     Client,
-    Config,
     TRexEmbdCustomize,
     TRexEmbdInfer,
     TRexGenericInfer,
@@ -17,6 +28,92 @@ from dds_cloudapi_sdk import (
 )
 from PIL import Image
 
+from .client_pool import ClientPool
+from .deadline import Deadline, DeadlineExceeded, LatencyTracker, race
+from .detections import DetectionBatch
+from .embeddings import download_embedding, merge_embeddings
+from .image import (ImageHandle, encode_image, guess_suffix, image_digest, is_file_like,
+                    is_url, read_file_like)
+from .prompts import (MAX_BATCH_SIZE, PromptValidationError, validate_embedding_prompts,
+                      validate_generic_prompts, validate_interactive_prompts)
+from .scheduler import PriorityScheduler
+from .streaming import aimap_batched, aimap_unordered, imap_batched, imap_unordered
+
+
+def hash_prompts(prompts: List[dict]) -> str:
+    """Compute a stable hash of generic prompts, including the content of the prompt images.
+
+    Args:
+        prompts (List[dict]): Generic prompts, same format as in `generic_inference`.
+
+    Returns:
+        str: Hex digest of the prompts.
+    """
+    hasher = hashlib.sha1()
+    for prompt in prompts:
+        hasher.update(image_digest(prompt["prompt_image"]).encode())
+        annotation = {k: v for k, v in prompt.items() if k != "prompt_image"}
+        hasher.update(json.dumps(annotation, sort_keys=True, default=str).encode())
+    return hasher.hexdigest()
+
+
+def check_batch_size(batch_size: int):
+    """Raise a `ValueError` if `batch_size` is not in [1, MAX_BATCH_SIZE]."""
+    if not 0 < batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f"Batch size must be in [1, {MAX_BATCH_SIZE}], got {batch_size}")
+
+
+def count_prompts(prompts: List[dict]) -> int:
+    """Count the visual prompts, i.e. boxes or points, of generic prompts."""
+    return sum(len(prompt.get("rects", prompt.get("points", []))) for prompt in prompts)
+
+
+def image_cache_key(image: Union[str, np.ndarray, Image.Image, bytes, ImageHandle]) -> Hashable:
+    """Compute the upload cache key of an image. Files are identified by their path,
+    modification time and size, other images by a hash of their content.
+    """
+    if isinstance(image, ImageHandle):
+        if image.path is None:
+            return ("content", image.digest)
+        image = image.path
+    if isinstance(image, str):
+        stat = os.stat(image)
+        return ("file", os.path.abspath(image), stat.st_mtime_ns, stat.st_size)
+    return ("content", image_digest(image))
+
+
+def with_leased_client(method=None, charge_quota: bool = True):
+    """Run a wrapper method with a client leased for the current thread, so all the uploads
+    and the task of one call go through the same client.
+
+    The method also accepts a `deadline` keyword argument, a `Deadline` or a timeout in
+    seconds, which applies to the lease, the uploads and the task of the call, including
+    its nested calls, and a `priority` keyword argument, the name of the class of the call
+    in the scheduler of the wrapper.
+
+    Methods which run no task, e.g. uploads, are decorated with
+    `with_leased_client(charge_quota=False)`, see `TRex2APIWrapper.lease_client`."""
+    if method is None:
+        return functools.partial(with_leased_client, charge_quota=charge_quota)
+
+    @functools.wraps(method)
+    def wrapper(self,
+                *args,
+                deadline: Union[Deadline, float] = None,
+                priority: str = None,
+                **kwargs):
+        with ExitStack() as stack:
+            if deadline is not None:
+                if not isinstance(deadline, Deadline):
+                    deadline = Deadline(deadline)
+                stack.enter_context(self.bind_deadline(deadline))
+            if priority is not None:
+                stack.enter_context(self.bind_priority(priority))
+            return self.call_leased(functools.partial(method, self), *args,
+                                    charge_quota=charge_quota, **kwargs)
+
+    return wrapper
+
 
 class TRex2APIWrapper:
     """API wrapper for T-Rex2
@@ -26,11 +123,240 @@ class TRex2APIWrapper:
             educators, students, and researchers, we offer an API with extensive usage times to
             support your educational and research endeavors. Please send a request to this email
             address (weiliu@idea.edu.cn) and attach your usage purpose as well as your institution.
+        pool_size (int): Maximum number of SDK clients used at the same time. The wrapper is
+            thread-safe: each thread leases its own client from a pool for the duration of a
+            call. Defaults to 8.
+        idle_timeout (float): Seconds after which an idle pooled client is discarded.
+            Defaults to 60.
+        upload_cache_size (int): Number of upload urls cached, so that the same image is
+            uploaded only once. Defaults to 0, which disables the cache.
+        hedge_quantile (float): Hedge the tasks running longer than this quantile of the
+            observed latencies of their type, e.g. 0.95: a duplicate task is sent and the
+            first response wins. Defaults to None, which never hedges.
+        scheduler (PriorityScheduler): Scheduler admitting the calls by priority class
+            before they lease a client, e.g. to share the wrapper between annotators and
+            bulk jobs, see `trex.scheduler`. Defaults to None, which admits the calls in
+            the order they lease a client.
+
+    Every call to a workflow method accepts a `deadline` keyword argument, either a timeout
+    in seconds or a `trex.deadline.Deadline`, which can also be cancelled from another
+    thread. A call past its deadline raises `DeadlineExceeded` (a `TimeoutError`) and a
+    cancelled call raises `CallCancelled`, both free the pool slot of the call right away.
+
+    Prompts are validated and normalized by `trex.prompts` before any upload, malformed
+    prompts raise `PromptValidationError` (a `ValueError`). The singular `rect` and `point`
+    keys are accepted as aliases of `rects` and `points`.
     """
 
-    def __init__(self, token: str):
-        self.client = Client(Config(token=token))
+    def __init__(self,
+                 token: str,
+                 pool_size: int = 8,
+                 idle_timeout: float = 60.0,
+                 upload_cache_size: int = 0,
+                 hedge_quantile: float = None,
+                 scheduler: PriorityScheduler = None):
+        self.pool = ClientPool(token, pool_size, idle_timeout, upload_cache_size)
+        # client used outside of a lease, e.g. when accessing `client` directly
+        self.default_client = self.pool.create_client()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # compiled prompt embeddings, (token, prompts hash) -> Future of the embedding url
+        self.compiled_embeddings = {}
+        self.hedge_quantile = hedge_quantile
+        # task type name -> LatencyTracker
+        self.latencies = {}
+        self.scheduler = scheduler
+
+    @property
+    def client(self) -> Client:
+        """The client leased by the current thread, or a shared client outside of a lease."""
+        return getattr(self.local, "client", None) or self.default_client
+
+    @property
+    def current_pool(self) -> ClientPool:
+        """The pool of the client leased by the current thread."""
+        return getattr(self.local, "pool", None) or self.pool
+
+    @property
+    def current_deadline(self) -> Deadline:
+        """The deadline of the call running in the current thread, if any."""
+        return getattr(self.local, "deadline", None)
+
+    @property
+    def current_priority(self) -> str:
+        """The priority class of the call running in the current thread, None for the
+        default class of the scheduler."""
+        return getattr(self.local, "priority", None)
+
+    @contextmanager
+    def lease_client(self, charge_quota: bool = True) -> Iterator[Client]:
+        """Lease a client from the pool for the current thread. Nested leases in the same
+        thread reuse the outer client.
+
+        Args:
+            charge_quota (bool): Whether the lease runs a task. Leases which only upload
+                images, e.g. a standalone `get_image_url`, skip the scheduler and the
+                quota, and only wait for a client. Defaults to True.
+        """
+        client = getattr(self.local, "client", None)
+        if client is not None:
+            yield client
+            return
+        with self.lease_pool_client(charge_quota) as (pool, client), \
+                self.bind_client(pool, client):
+            yield client
+
+    @contextmanager
+    def lease_pool_client(self, charge_quota: bool = True) -> Iterator[Tuple[ClientPool, Client]]:
+        """Lease a client without binding it to the current thread. The lease can be
+        entered and exited in different threads, which bind it with `bind_client`. See
+        `lease_client` for `charge_quota`."""
+        deadline = self.current_deadline
+        with self.admit(charge_quota), self.pool.lease(deadline=deadline) as client:
+            yield self.pool, client
+
+    @contextmanager
+    def admit(self, charge_quota: bool = True) -> Iterator[None]:
+        """Wait for the scheduler, if any, to admit a call of the current priority and
+        hold its slot for the duration of the context. Calls running no task are not
+        scheduled."""
+        if self.scheduler is None or not charge_quota:
+            yield
+            return
+        with self.scheduler.slot(self.current_priority, self.current_deadline):
+            yield
+
+    @contextmanager
+    def bind_client(self, pool: ClientPool, client: Client) -> Iterator[Client]:
+        """Make `client` of `pool` the client of the current thread."""
+        previous = getattr(self.local, "pool", None), getattr(self.local, "client", None)
+        self.local.pool, self.local.client = pool, client
+        try:
+            yield client
+        finally:
+            self.local.pool, self.local.client = previous
+
+    def check_priority(self, priority: str):
+        """Raise a `ValueError` if the scheduler has no class `priority`."""
+        if self.scheduler is not None and priority not in self.scheduler.classes:
+            raise ValueError(f"Unknown priority class {priority}")
+
+    @contextmanager
+    def bind_priority(self, priority: str) -> Iterator[str]:
+        """Make `priority` the priority class of the calls of the current thread.
+
+        Raises:
+            ValueError: If the scheduler has no class `priority`.
+        """
+        self.check_priority(priority)
+        previous = self.current_priority
+        self.local.priority = priority
+        try:
+            yield priority
+        finally:
+            self.local.priority = previous
+
+    @contextmanager
+    def bind_deadline(self, deadline: Deadline) -> Iterator[Deadline]:
+        """Make `deadline` the deadline of the calls of the current thread."""
+        previous = self.current_deadline
+        self.local.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            self.local.deadline = previous
+
+    def run_task(self, task):
+        """Run a task with the client of the current thread, within the deadline of the
+        call and hedged if `hedge_quantile` is set.
 
+        Returns:
+            The task which completed first, either `task` or its hedged duplicate. Read the
+                result from the returned task.
+        """
+        deadline = self.current_deadline
+        name = type(task).__name__
+        tracker = self.latencies.get(name) or self.latencies.setdefault(name, LatencyTracker())
+        hedge_delay = None
+        if self.hedge_quantile is not None:
+            hedge_delay = tracker.quantile(self.hedge_quantile)
+        start = time.monotonic()
+        if deadline is None and hedge_delay is None:
+            self.client.run_task(task)
+            tracker.record(time.monotonic() - start)
+            return task
+        client, pool = self.client, self.current_pool
+        # copy before running, the SDK writes the result on the task
+        hedge_task = copy.deepcopy(task) if hedge_delay is not None else None
+
+        def run(client, task):
+            client.run_task(task)
+            return task
+
+        def abandon(index):
+            # the hedge runs on its own unpooled client
+            if index == 0:
+                pool.discard(client)
+
+        _, task = race(lambda: run(client, task), deadline,
+                       lambda: self.run_hedge(pool, hedge_task), hedge_delay, abandon)
+        tracker.record(time.monotonic() - start)
+        return task
+
+    def run_hedge(self, pool: ClientPool, task):
+        """Run the hedged duplicate of a task of `pool` on its own unpooled client."""
+        pool.create_client().run_task(task)
+        return task
+
+    def bind_stream(self,
+                    func: Callable,
+                    deadline: Union[Deadline, float] = None,
+                    priority: str = None) -> Callable:
+        """Wrap `func` to run in the worker threads of a streaming method with the deadline
+        and the priority class of the stream, by default those bound in the current
+        thread, which the workers do not inherit.
+
+        Raises:
+            ValueError: If the scheduler has no class `priority`.
+        """
+        if deadline is None:
+            deadline = self.current_deadline
+        elif not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        if priority is None:
+            priority = self.current_priority
+        else:
+            self.check_priority(priority)
+        if deadline is None and priority is None:
+            return func
+
+        def run(*args):
+            with ExitStack() as stack:
+                if deadline is not None:
+                    stack.enter_context(self.bind_deadline(deadline))
+                if priority is not None:
+                    stack.enter_context(self.bind_priority(priority))
+                return func(*args)
+
+        return run
+
+    def call_leased(self, func: Callable, *args, charge_quota: bool = True, **kwargs):
+        """Run `func`, e.g. a bound workflow method or one item of a streaming method, with
+        a client leased for the current thread. See `lease_client` for `charge_quota`."""
+        with self.lease_client(charge_quota):
+            return func(*args, **kwargs)
+
+    def upload_file(self, path: str) -> str:
+        """Upload a file with the client of the current thread, within the deadline of the
+        call."""
+        deadline = self.current_deadline
+        if deadline is None:
+            return self.client.upload_file(path)
+        client, pool = self.client, self.current_pool
+        return race(lambda: client.upload_file(path), deadline,
+                    on_abandon=lambda _: pool.discard(client))[1]
+
+    @with_leased_client
     def interactve_inference(self, prompts: List[Dict]):
         """Interactive visual prompt inference workflow. Users can provide prompt
         on current image and get the boxes, scores, labels. We take batch as input and
@@ -46,11 +372,11 @@ class TRex2APIWrapper:
                         "prompts": [
                             {
                                 "category_id": 1,
-                                "rect": [[ 10, 10, 20, 30 ],[ 10, 10, 20, 30 ]] // N * [xmin, ymin, xmax, ymax],
+                                "rects": [[ 10, 10, 20, 30 ],[ 10, 10, 20, 30 ]] // N * [xmin, ymin, xmax, ymax],
                             },
                             {
                                 "category_id": 2,
-                                "rect": [[ 10, 10, 20, 30 ],[ 10, 10, 20, 30 ]] // [xmin, ymin, xmax, ymax]
+                                "rects": [[ 10, 10, 20, 30 ],[ 10, 10, 20, 30 ]] // [xmin, ymin, xmax, ymax]
                             }
                         ]
                     }
@@ -61,11 +387,11 @@ class TRex2APIWrapper:
                         "prompts": [
                             {
                                 "category_id": 1,
-                                "point": [[ 10, 10],[ 10, 10]]  // N * [xmin, ymin, xmax, ymax],
+                                "points": [[ 10, 10],[ 10, 10]]  // N * [x, y],
                             },
                             {
                                 "category_id": 2,
-                                "point": [[ 10, 10],[ 10, 10]]  // [xmin, ymin, xmax, ymax]
+                                "points": [[ 10, 10],[ 10, 10]]  // N * [x, y]
                             }
                         ]
                     }
@@ -83,6 +409,7 @@ class TRex2APIWrapper:
                     }
                 ]
         """
+        prompts = validate_interactive_prompts(prompts)
         # construct input prompts
         input_prompts = []
         for prompt in prompts:
@@ -109,13 +436,14 @@ class TRex2APIWrapper:
                     ],
                 )
             else:
-                assert False, "Invalid prompt type"
+                raise PromptValidationError(f"Invalid prompt type {prompt['type']!r}")
             input_prompts.append(prompt)
         # call the API
         task = TRexInteractiveInfer(input_prompts)
-        self.client.run_task(task)
+        task = self.run_task(task)
         return self.postprocess(task.result.object_batches)
 
+    @with_leased_client
     def generic_inference(self, target_image: str, prompts: List[dict]):
         """Generic visual prompt inference workflow. Users can provide prompt on multiple image and
         get the boxes, scores on target image. In generic mode, we will hypothesis that there is
@@ -127,13 +455,13 @@ class TRex2APIWrapper:
             prompts (List[List[dict]]): annotation in standard coco format:
                 [
                     {
-                        "rect": [[ 10, 10, 20, 30],[ 10, 10, 20, 30]]  // [xmin, ymin, xmax, ymax],
-                        "point" (optional): [[cx, cy]]. Point and bbox can not be provided at the same time.
+                        "rects": [[ 10, 10, 20, 30],[ 10, 10, 20, 30]]  // [xmin, ymin, xmax, ymax],
+                        "points" (optional): [[cx, cy]]. Points and rects can not be provided at the same time.
                         "prompt_image" (Union[str, Image.Image]): A prompt image for the target image.
                     },
                     {
-                        "rect": [[ 10, 10, 40, 50],[ 20, 20, 30, 30]]  // [xmin, ymin, xmax, ymax],
-                        "point" (optional): [[cx, cy]]. Point and bbox can not be provided at the same time.
+                        "rects": [[ 10, 10, 40, 50],[ 20, 20, 30, 30]]  // [xmin, ymin, xmax, ymax],
+                        "points" (optional): [[cx, cy]]. Points and rects can not be provided at the same time.
                         "prompt_image" (Union[str, Image.Image]): A prompt image for the target image.
                     },
                 ]
@@ -149,36 +477,166 @@ class TRex2APIWrapper:
                     }
                 ]
         """
-        input_prompts = []
-        prompt_types = []
-        # check prompt type
-        for prompt in prompts:
-            if "rects" in prompt:
-                prompt_types.append("rects")
-            elif "points" in prompt:
-                prompt_types.append("points")
-            else:
-                assert False, "Invalid prompt type"
-        # check if prompt type is consistent
-        assert len(set(prompt_types)) == 1, "Prompt type must be consistent"
-        prompt_type = prompt_types[0]
-        for prompt in prompts:
-            if prompt_type == "rects":
-                prompt = BatchRectPrompt(
-                    image=self.get_image_url(prompt["prompt_image"]),
-                    rects=prompt["rects"],
-                )
-            elif prompt_type == "points":
-                prompt = BatchPointPrompt(
-                    image=self.get_image_url(prompt["prompt_image"]),
-                    points=prompt["points"],
-                )
-            input_prompts.append(prompt)
+        input_prompts = self.build_generic_prompts(prompts)
         # call the API
         task = TRexGenericInfer(self.get_image_url(target_image), input_prompts)
-        self.client.run_task(task)
+        task = self.run_task(task)
         return self.postprocess([task.result.objects])[0]
 
+    def generic_inference_many(self,
+                               targets: Iterable,
+                               prompts: List[dict],
+                               max_workers: int = 4,
+                               max_in_flight: int = None,
+                               compile_threshold: int = None,
+                               deadline: Union[Deadline, float] = None,
+                               priority: str = None
+                               ) -> Iterator[Tuple[int, Dict]]:
+        """Generic visual prompt inference on many target images with one prompt set. The
+        prompt images are uploaded only once and shared by every target, while the target
+        images are uploaded and inferred concurrently in a thread pool.
+
+        For bulk runs the prompts can be compiled: they are converted once to an embedding
+        with `customize_embedding` (cached by `compile_prompts`) and the targets are sent
+        through embedding inference in batches of `MAX_BATCH_SIZE`, which needs about four
+        times fewer tasks than running generic inference per target.
+
+        Args:
+            targets (Iterable): Target images, each one is anything accepted by
+                `get_image_url`. Can be a lazy or unbounded iterable, targets are consumed
+                only when there is a free slot.
+            prompts (List[dict]): Generic prompts, same format as in `generic_inference`.
+            max_workers (int): Maximum number of targets running at the same time.
+                Defaults to 4.
+            max_in_flight (int): Maximum number of targets submitted but not yet yielded.
+                Defaults to 2 * max_workers.
+            compile_threshold (int): Compile the prompts when there are more targets than
+                this threshold. Targets without a known length are considered as a bulk run
+                and always compiled. Defaults to None, which never compiles.
+            deadline (Union[Deadline, float]): Deadline of the whole stream, a `Deadline` or
+                a timeout in seconds from the start of the iteration. The requests still
+                running past it raise `DeadlineExceeded`, and cancelling it stops them.
+                Defaults to None, which is the deadline bound in the current thread, if any.
+            priority (str): Priority class of the requests in the scheduler of the wrapper.
+                Defaults to None, which is the class bound in the current thread with
+                `bind_priority`, if any.
+
+        Yields:
+            Tuple[int, Dict]: (target_index, result) in completion order. target_index is
+                the position of the target in `targets` and result is in the same format
+                as the return value of `generic_inference`.
+        """
+        # fail before uploading anything
+        prompts = validate_generic_prompts(prompts)
+        if compile_threshold is not None:
+            num_targets = len(targets) if isinstance(targets, Sized) else None
+            if num_targets is None or num_targets > compile_threshold:
+                yield from self.compiled_inference_many(targets, prompts, max_workers,
+                                                        max_in_flight, deadline, priority)
+                return
+        # upload the prompt images once for all the targets, upload urls may be scoped to
+        # a token so this is done once per client pool
+        input_prompts_per_pool = {}
+        prompts_lock = threading.Lock()
+
+        def infer_leased(target_image):
+            with prompts_lock:
+                if self.current_pool not in input_prompts_per_pool:
+                    input_prompts_per_pool[self.current_pool] = \
+                        self.build_generic_prompts(prompts)
+            input_prompts = input_prompts_per_pool[self.current_pool]
+            task = TRexGenericInfer(self.get_image_url(target_image), input_prompts)
+            task = self.run_task(task)
+            return self.postprocess([task.result.objects])[0]
+
+        def infer(target_image):
+            # retried like the workflow methods, e.g. on another token after a quota error
+            return self.call_leased(infer_leased, target_image)
+
+        yield from imap_unordered(self.bind_stream(infer, deadline, priority), targets,
+                                  max_workers, max_in_flight)
+
+    @with_leased_client
+    def compile_prompts(self, prompts: List[dict], prompts_hash: str = None) -> str:
+        """Convert generic prompts to an embedding with `customize_embedding`. Compiled
+        embeddings are cached against the hash of the prompts, so the same prompt set is
+        only customized once per token.
+
+        Args:
+            prompts (List[dict]): Generic prompts, same format as in `generic_inference`.
+            prompts_hash (str): `hash_prompts(prompts)`, computed once by callers compiling
+                the same prompts repeatedly. Defaults to None, which computes it.
+
+        Returns:
+            str: The url of the compiled embedding.
+        """
+        key = (self.current_pool.token, prompts_hash or hash_prompts(prompts))
+        # concurrent callers wait for one customization instead of running their own,
+        # without blocking the compilations of other prompts or tokens
+        with self.lock:
+            future = self.compiled_embeddings.get(key)
+            owner = future is None
+            if owner:
+                future = self.compiled_embeddings[key] = Future()
+        if not owner:
+            deadline = self.current_deadline
+            try:
+                return future.result(deadline and deadline.remaining())
+            except FutureTimeoutError:
+                raise DeadlineExceeded("Deadline exceeded") from None
+        try:
+            embd_url = self.customize_embedding(prompts)
+        except BaseException as e:
+            # the next caller tries again
+            with self.lock:
+                del self.compiled_embeddings[key]
+            future.set_exception(e)
+            raise
+        future.set_result(embd_url)
+        return embd_url
+
+    def compiled_inference_many(self,
+                                targets: Iterable,
+                                prompts: List[dict],
+                                max_workers: int = 4,
+                                max_in_flight: int = None,
+                                deadline: Union[Deadline, float] = None,
+                                priority: str = None
+                                ) -> Iterator[Tuple[int, Dict]]:
+        """Run generic prompts on many targets through batched embedding inference. See
+        `generic_inference_many` for the arguments.
+
+        Yields:
+            Tuple[int, Dict]: (target_index, result) in completion order. Results are in
+                the same format as `generic_inference`, i.e. all labels are 0.
+        """
+        prompts = validate_generic_prompts(prompts)
+        # hashing reads the prompt images, do it once rather than for every batch
+        prompts_hash = hash_prompts(prompts)
+
+        def infer_leased(batch):
+            embd_url = self.compile_prompts(prompts, prompts_hash)
+            input_prompts = [
+                BatchEmbdInfer(
+                    image=self.get_image_url(target_image),
+                    prompts=[BatchEmbdPrompt(category_id=1, embd=embd_url)],
+                ) for target_image in batch
+            ]
+            task = TRexEmbdInfer(input_prompts)
+            task = self.run_task(task)
+            results = self.postprocess(task.result.object_batches)
+            for result in results:
+                # generic inference does not return category_id
+                result["labels"] = [0] * len(result["labels"])
+            return results
+
+        def infer(batch):
+            return self.call_leased(infer_leased, batch)
+
+        yield from imap_batched(self.bind_stream(infer, deadline, priority), targets,
+                                MAX_BATCH_SIZE, max_workers, max_in_flight)
+
+    @with_leased_client
     def customize_embedding(self, prompts: List[dict]):
         """Customize visual prompt embeddings. Users can provide multiple prompt images to
         get one embedding.
@@ -187,13 +645,13 @@ class TRex2APIWrapper:
             prompts (List[List[dict]]): annotation in standard coco format:
                 [
                     {
-                        "rect": [[ 10, 10, 20, 30],[ 10, 10, 20, 30]]  // [xmin, ymin, xmax, ymax],
-                        "point" (optional): [[cx, cy]]. Point and bbox can not be provided at the same time.
+                        "rects": [[ 10, 10, 20, 30],[ 10, 10, 20, 30]]  // [xmin, ymin, xmax, ymax],
+                        "points" (optional): [[cx, cy]]. Points and rects can not be provided at the same time.
                         "prompt_image" (Union[str, Image.Image]): A prompt image for the target image.
                     },
                     {
-                        "rect": [[ 10, 10, 40, 50],[ 20, 20, 30, 30]]  // [xmin, ymin, xmax, ymax],
-                        "point" (optional): [[cx, cy]]. Point and bbox can not be provided at the same time.
+                        "rects": [[ 10, 10, 40, 50],[ 20, 20, 30, 30]]  // [xmin, ymin, xmax, ymax],
+                        "points" (optional): [[cx, cy]]. Points and rects can not be provided at the same time.
                         "prompt_image" (Union[str, Image.Image]): A prompt image for the target image.
                     },
                 ]
@@ -201,37 +659,46 @@ class TRex2APIWrapper:
         Returns:
            str: Return the url of the embedding, user can download the embedding from the url.
         """
-        input_prompts = []
-        prompt_types = []
-        # check prompt type
-        for prompt in prompts:
-            if "rects" in prompt:
-                prompt_types.append("rects")
-            elif "points" in prompt:
-                prompt_types.append("points")
-            else:
-                assert False, "Invalid prompt type"
-        # check if prompt type is consistent
-        assert len(set(prompt_types)) == 1, "Prompt type must be consistent"
-        prompt_type = prompt_types[0]
-        for prompt in prompts:
-            if prompt_type == "rects":
-                prompt = BatchRectPrompt(
-                    image=self.get_image_url(prompt["prompt_image"]),
-                    rects=prompt["rects"],
-                )
-            elif prompt_type == "points":
-                prompt = BatchPointPrompt(
-                    image=self.get_image_url(prompt["prompt_image"]),
-                    points=prompt["points"],
-                )
-            input_prompts.append(prompt)
+        input_prompts = self.build_generic_prompts(prompts)
         # call the API
         task = TRexEmbdCustomize(batch_prompts=input_prompts)
-        self.client.run_task(task)
+        task = self.run_task(task)
         embd_url = task.result.embd
         return embd_url
 
+    def refine_embedding(self,
+                         embedding_path: str,
+                         prompts: List[dict],
+                         output_path: str = None,
+                         prompt_count: int = None) -> str:
+        """Refine an existing embedding with new visual prompts. Only the new prompts are
+        uploaded and customized, the result is merged locally with the existing embedding
+        by a running mean weighted by the number of visual prompts (boxes or points) of
+        each, see `merge_embeddings`. Create the first embedding of a category with
+        `download_embedding(trex2.customize_embedding(prompts), path, count_prompts(prompts))`
+        so that its prompt count is stored.
+
+        Args:
+            embedding_path (str): Safetensors file of the existing embedding.
+            prompts (List[dict]): New prompts, same format as in `customize_embedding`.
+            output_path (str): Path of the refined embedding. Defaults to None, which
+                overwrites `embedding_path`.
+            prompt_count (int): Prompt count of the existing embedding, only needed if it
+                is not stored in its metadata. Defaults to None.
+
+        Returns:
+            str: The path of the refined embedding.
+        """
+        output_path = output_path or embedding_path
+        embd_url = self.customize_embedding(prompts)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            update_path = download_embedding(embd_url,
+                                             os.path.join(tmp_dir, "update.safetensors"),
+                                             count_prompts(prompts))
+            merge_embeddings(embedding_path, update_path, output_path, base_count=prompt_count)
+        return output_path
+
+    @with_leased_client
     def embedding_inference(self, prompts: List[dict]):
         """Prompt inference workflow. Users can provide prompt in safetensor format
         on current image and get the boxes, scores, labels on current image. We take
@@ -281,6 +748,7 @@ class TRex2APIWrapper:
                         format is (xmin, ymin, ymin, ymax)
                 }
         """
+        prompts = validate_embedding_prompts(prompts)
         # construct input prompts
         input_prompts = []
         for prompt in prompts:
@@ -297,9 +765,246 @@ class TRex2APIWrapper:
             input_prompts.append(prompt)
         # call the API
         task = TRexEmbdInfer(input_prompts)
-        self.client.run_task(task)
+        task = self.run_task(task)
         return self.postprocess(task.result.object_batches)
 
+    def iter_interactive(self,
+                         prompts: Iterable[dict],
+                         batch_size: int = 1,
+                         max_workers: int = 4,
+                         max_in_flight: int = None,
+                         return_exceptions: bool = False,
+                         deadline: Union[Deadline, float] = None,
+                         priority: str = None) -> Iterator[Tuple[int, Dict]]:
+        """Streaming version of `interactve_inference`. Prompts are consumed lazily from a
+        possibly unbounded iterable and results are yielded as soon as each task completes,
+        so downstream stages can start before the slowest request returns.
+
+        Args:
+            prompts (Iterable[dict]): Interactive prompts, each one is a batch annotation in
+                the format of `interactve_inference`.
+            batch_size (int): Number of prompts sent in one task, at most `MAX_BATCH_SIZE`.
+                Defaults to 1.
+            max_workers (int): Maximum number of tasks running at the same time. Defaults
+                to 4.
+            max_in_flight (int): Maximum number of tasks submitted but not yet yielded.
+                Defaults to 2 * max_workers.
+            return_exceptions (bool): Yield the exception of a failed request as its
+                result instead of raising it, which stops the stream. Defaults to False.
+            deadline (Union[Deadline, float]): Deadline of the whole stream, a `Deadline` or
+                a timeout in seconds from the start of the iteration. The requests still
+                running past it raise `DeadlineExceeded`, and cancelling it stops them.
+                Defaults to None, which is the deadline bound in the current thread, if any.
+            priority (str): Priority class of the requests in the scheduler of the wrapper.
+                Defaults to None, which is the class bound in the current thread with
+                `bind_priority`, if any.
+
+        Yields:
+            Tuple[int, Dict]: (input_index, result) in completion order.
+
+        Raises:
+            ValueError: If `batch_size` is not in [1, MAX_BATCH_SIZE].
+        """
+        check_batch_size(batch_size)
+        infer = self.bind_stream(self.interactve_inference, deadline, priority)
+        yield from imap_batched(infer, prompts, batch_size, max_workers,
+                                max_in_flight, return_exceptions)
+
+    def iter_generic(self,
+                     requests: Iterable[Tuple[str, List[dict]]],
+                     max_workers: int = 4,
+                     max_in_flight: int = None,
+                     return_exceptions: bool = False,
+                     deadline: Union[Deadline, float] = None,
+                     priority: str = None) -> Iterator[Tuple[int, Dict]]:
+        """Streaming version of `generic_inference`. Use `generic_inference_many` instead
+        when all the targets share the same prompts.
+
+        Args:
+            requests (Iterable[Tuple[str, List[dict]]]): (target_image, prompts) pairs, in
+                the format of `generic_inference`.
+            max_workers (int): Maximum number of tasks running at the same time. Defaults
+                to 4.
+            max_in_flight (int): Maximum number of tasks submitted but not yet yielded.
+                Defaults to 2 * max_workers.
+            return_exceptions (bool): Yield the exception of a failed request as its
+                result instead of raising it, which stops the stream. Defaults to False.
+            deadline (Union[Deadline, float]): Deadline of the whole stream, a `Deadline` or
+                a timeout in seconds from the start of the iteration. The requests still
+                running past it raise `DeadlineExceeded`, and cancelling it stops them.
+                Defaults to None, which is the deadline bound in the current thread, if any.
+            priority (str): Priority class of the requests in the scheduler of the wrapper.
+                Defaults to None, which is the class bound in the current thread with
+                `bind_priority`, if any.
+
+        Yields:
+            Tuple[int, Dict]: (input_index, result) in completion order.
+        """
+        infer = self.bind_stream(lambda request: self.generic_inference(*request), deadline,
+                                 priority)
+        yield from imap_unordered(infer, requests, max_workers, max_in_flight,
+                                  return_exceptions)
+
+    def iter_customize(self,
+                       prompt_sets: Iterable[List[dict]],
+                       max_workers: int = 4,
+                       max_in_flight: int = None,
+                       return_exceptions: bool = False,
+                       deadline: Union[Deadline, float] = None,
+                       priority: str = None) -> Iterator[Tuple[int, str]]:
+        """Streaming version of `customize_embedding`.
+
+        Args:
+            prompt_sets (Iterable[List[dict]]): Prompts of each embedding, in the format
+                of `customize_embedding`.
+            max_workers (int): Maximum number of tasks running at the same time. Defaults
+                to 4.
+            max_in_flight (int): Maximum number of tasks submitted but not yet yielded.
+                Defaults to 2 * max_workers.
+            return_exceptions (bool): Yield the exception of a failed request as its
+                result instead of raising it, which stops the stream. Defaults to False.
+            deadline (Union[Deadline, float]): Deadline of the whole stream, a `Deadline` or
+                a timeout in seconds from the start of the iteration. The requests still
+                running past it raise `DeadlineExceeded`, and cancelling it stops them.
+                Defaults to None, which is the deadline bound in the current thread, if any.
+            priority (str): Priority class of the requests in the scheduler of the wrapper.
+                Defaults to None, which is the class bound in the current thread with
+                `bind_priority`, if any.
+
+        Yields:
+            Tuple[int, str]: (input_index, embedding_url) in completion order.
+        """
+        infer = self.bind_stream(self.customize_embedding, deadline, priority)
+        yield from imap_unordered(infer, prompt_sets, max_workers,
+                                  max_in_flight, return_exceptions)
+
+    def iter_embedding(self,
+                       prompts: Iterable[dict],
+                       batch_size: int = MAX_BATCH_SIZE,
+                       max_workers: int = 4,
+                       max_in_flight: int = None,
+                       return_exceptions: bool = False,
+                       deadline: Union[Deadline, float] = None,
+                       priority: str = None) -> Iterator[Tuple[int, Dict]]:
+        """Streaming version of `embedding_inference`.
+
+        Args:
+            prompts (Iterable[dict]): Embedding prompts, each one is a batch annotation in
+                the format of `embedding_inference`.
+            batch_size (int): Number of prompts sent in one task, at most `MAX_BATCH_SIZE`.
+                Defaults to `MAX_BATCH_SIZE`.
+            max_workers (int): Maximum number of tasks running at the same time. Defaults
+                to 4.
+            max_in_flight (int): Maximum number of tasks submitted but not yet yielded.
+                Defaults to 2 * max_workers.
+            return_exceptions (bool): Yield the exception of a failed request as its
+                result instead of raising it, which stops the stream. Defaults to False.
+            deadline (Union[Deadline, float]): Deadline of the whole stream, a `Deadline` or
+                a timeout in seconds from the start of the iteration. The requests still
+                running past it raise `DeadlineExceeded`, and cancelling it stops them.
+                Defaults to None, which is the deadline bound in the current thread, if any.
+            priority (str): Priority class of the requests in the scheduler of the wrapper.
+                Defaults to None, which is the class bound in the current thread with
+                `bind_priority`, if any.
+
+        Yields:
+            Tuple[int, Dict]: (input_index, result) in completion order.
+
+        Raises:
+            ValueError: If `batch_size` is not in [1, MAX_BATCH_SIZE].
+        """
+        check_batch_size(batch_size)
+        infer = self.bind_stream(self.embedding_inference, deadline, priority)
+        yield from imap_batched(infer, prompts, batch_size, max_workers,
+                                max_in_flight, return_exceptions)
+
+    async def aiter_interactive(self,
+                                prompts: Union[Iterable[dict], AsyncIterator[dict]],
+                                batch_size: int = 1,
+                                max_workers: int = 4,
+                                max_in_flight: int = None,
+                                return_exceptions: bool = False,
+                                deadline: Union[Deadline, float] = None,
+                                priority: str = None
+                                ) -> AsyncIterator[Tuple[int, Dict]]:
+        """Async version of `iter_interactive`, `prompts` can also be an async iterable."""
+        check_batch_size(batch_size)
+        infer = self.bind_stream(self.interactve_inference, deadline, priority)
+        async for item in aimap_batched(infer, prompts, batch_size,
+                                        max_workers, max_in_flight, return_exceptions):
+            yield item
+
+    async def aiter_generic(self,
+                            requests: Union[Iterable[Tuple], AsyncIterator[Tuple]],
+                            max_workers: int = 4,
+                            max_in_flight: int = None,
+                            return_exceptions: bool = False,
+                            deadline: Union[Deadline, float] = None,
+                            priority: str = None
+                            ) -> AsyncIterator[Tuple[int, Dict]]:
+        """Async version of `iter_generic`, `requests` can also be an async iterable."""
+        infer = self.bind_stream(lambda request: self.generic_inference(*request), deadline,
+                                 priority)
+        async for item in aimap_unordered(infer, requests, max_workers, max_in_flight,
+                                          return_exceptions):
+            yield item
+
+    async def aiter_customize(self,
+                              prompt_sets: Union[Iterable[List], AsyncIterator[List]],
+                              max_workers: int = 4,
+                              max_in_flight: int = None,
+                              return_exceptions: bool = False,
+                              deadline: Union[Deadline, float] = None,
+                              priority: str = None
+                              ) -> AsyncIterator[Tuple[int, str]]:
+        """Async version of `iter_customize`, `prompt_sets` can also be an async iterable."""
+        infer = self.bind_stream(self.customize_embedding, deadline, priority)
+        async for item in aimap_unordered(infer, prompt_sets, max_workers,
+                                          max_in_flight, return_exceptions):
+            yield item
+
+    async def aiter_embedding(self,
+                              prompts: Union[Iterable[dict], AsyncIterator[dict]],
+                              batch_size: int = MAX_BATCH_SIZE,
+                              max_workers: int = 4,
+                              max_in_flight: int = None,
+                              return_exceptions: bool = False,
+                              deadline: Union[Deadline, float] = None,
+                              priority: str = None
+                              ) -> AsyncIterator[Tuple[int, Dict]]:
+        """Async version of `iter_embedding`, `prompts` can also be an async iterable."""
+        check_batch_size(batch_size)
+        infer = self.bind_stream(self.embedding_inference, deadline, priority)
+        async for item in aimap_batched(infer, prompts, batch_size,
+                                        max_workers, max_in_flight, return_exceptions):
+            yield item
+
+    def build_generic_prompts(self, prompts: List[dict]):
+        """Upload the prompt images and build the prompts used by generic inference and
+        embedding customization.
+
+        Args:
+            prompts (List[dict]): Generic prompts, same format as in `generic_inference`.
+
+        Returns:
+            List[Union[BatchRectPrompt, BatchPointPrompt]]: The prompts to send to the API.
+        """
+        prompts = validate_generic_prompts(prompts)
+        input_prompts = []
+        for prompt in prompts:
+            if "rects" in prompt:
+                prompt = BatchRectPrompt(
+                    image=self.get_image_url(prompt["prompt_image"]),
+                    rects=prompt["rects"],
+                )
+            else:
+                prompt = BatchPointPrompt(
+                    image=self.get_image_url(prompt["prompt_image"]),
+                    points=prompt["points"],
+                )
+            input_prompts.append(prompt)
+        return input_prompts
+
     def postprocess(self, object_batches):
         """Postprocess the result from the API
 
@@ -308,7 +1013,7 @@ class TRex2APIWrapper:
                 on each image. Each TRexObject contains the following keys:
                     - category_id (int): The category id of the object
                     - score (float): The score of the object
-                    - bbox (List[int]): The bounding box of the object in format [xmin, ymin, xmax, ymax]
+                    - bbox (List[float]): The bounding box of the object in format [xmin, ymin, xmax, ymax]
 
         Returns:
             List[Dict]: Return a list of dict in format:
@@ -316,43 +1021,78 @@ class TRex2APIWrapper:
                     {
                         "scores": (List[float]): A list of scores for each object in the batch
                         "labels": (List[int]): A list of labels for each object in the batch
-                        "boxes": (List[List[int]]): A list of boxes for each object in the batch
+                        "boxes": (List[List[float]]): A list of boxes for each object in the batch
                     }
                 ]
+                The scores and boxes are the values returned by the API, use
+                `postprocess_batch` for the detections in float32 arrays.
         """
         results = []
         for batch in object_batches:
-            scores = []
-            labels = []
-            boxes = []
-            for obj in batch:
-                scores.append(obj.score)
-                if hasattr(obj, "category_id"):
-                    labels.append(obj.category_id)
-                else:
-                    # generic inference does not return category_id
-                    labels.append(0)
-                boxes.append(obj.bbox)
-            results.append({"scores": scores, "labels": labels, "boxes": boxes})
+            results.append({
+                "scores": [obj.score for obj in batch],
+                # generic inference does not return category_id
+                "labels": [getattr(obj, "category_id", 0) for obj in batch],
+                "boxes": [obj.bbox for obj in batch],
+            })
         return results
 
-    def get_image_url(self, image: Union[str, np.ndarray]):
-        """Upload Image to server and return the url
+    def postprocess_batch(self, object_batches) -> DetectionBatch:
+        """Postprocess the result from the API into a `DetectionBatch`, which stores the
+        detections of all the images in contiguous arrays. See `postprocess` for the
+        format of `object_batches`.
+
+        Returns:
+            DetectionBatch: The detections of each image.
+        """
+        return DetectionBatch.from_object_batches(object_batches)
+
+    @with_leased_client(charge_quota=False)
+    def get_image_url(self, image: Union[str, np.ndarray, Image.Image, bytes, BinaryIO,
+                                         ImageHandle]):
+        """Upload Image to server and return the url. Uploads run no task, so outside of a
+        workflow method they only wait for a client, without a scheduler slot or a quota
+        token.
 
         Args:
-            image (Union[str, np.ndarray]): The image to upload. Can be a file path or np.ndarray.
-                If it is a np.ndarray, it will be saved to a temporary file.
+            image (Union[str, np.ndarray, Image.Image, bytes, BinaryIO, ImageHandle]): The
+                image to upload.
+                Can be:
+                    - an url (str starting with http:// or https://), e.g. an url already
+                        returned by this method. It is returned as it is, without upload.
+                    - a file path (str), uploaded as it is.
+                    - encoded bytes or a binary file-like object, e.g. a JPEG received
+                        from a browser. Uploaded as they are, without decoding.
+                    - a PIL.Image or a np.ndarray, encoded to PNG before upload.
+                    - an ImageHandle, uploaded from its file or its encoded bytes, which
+                        are cached in the handle for the next uploads.
 
         Returns:
             str: The url of the image
         """
+        if is_url(image):
+            return image
+        if is_file_like(image):
+            image = read_file_like(image)
+        upload_cache = self.current_pool.upload_cache
+        if upload_cache is not None:
+            key = image_cache_key(image)
+            url = upload_cache.get(key)
+            if url is not None:
+                return url
+        if isinstance(image, ImageHandle):
+            image = image.path or image.encoded
         if isinstance(image, str):
-            url = self.client.upload_file(image)
+            url = self.upload_file(image)
         else:
-            with tempfile.NamedTemporaryFile(delete=True, suffix=".png") as tmp_file:
-                # image is in numpy format, convert to PIL Image
-                image = Image.fromarray(image)
-                image.save(tmp_file, format="PNG")
-                tmp_file_path = tmp_file.name
-                url = self.client.upload_file(tmp_file_path)
+            if not isinstance(image, (bytes, bytearray, memoryview)):
+                # decoded image, PIL.Image or np.ndarray
+                image = encode_image(image, format="PNG")
+            with tempfile.NamedTemporaryFile(delete=True,
+                                             suffix=guess_suffix(bytes(image[:16]))) as tmp_file:
+                tmp_file.write(image)
+                tmp_file.flush()
+                url = self.upload_file(tmp_file.name)
+        if upload_cache is not None:
+            upload_cache.put(key, url)
         return url
@@ -0,0 +1,167 @@
+import copy
+from typing import Callable, Dict, Iterable, Iterator, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .dedup import load_gray
+from .image import read_image_size
+from .zones import ZoneLookup, ZoneRaster, Zones
+
+
+def block_change(reference: np.ndarray, gray: np.ndarray, pixel_threshold: float,
+                 block_size: int) -> np.ndarray:
+    """Fraction of changed pixels of every block of two grayscale images.
+
+    Args:
+        reference (np.ndarray): Reference image in shape (H, W).
+        gray (np.ndarray): Current image in shape (H, W).
+        pixel_threshold (float): Minimum absolute difference of a changed pixel.
+        block_size (int): Side of the blocks, H and W must be multiples of it.
+
+    Returns:
+        np.ndarray: Changed fraction in shape (H / block_size, W / block_size).
+    """
+    changed = np.abs(gray - reference) > pixel_threshold
+    height, width = changed.shape
+    blocks = changed.reshape(height // block_size, block_size, width // block_size, block_size)
+    return blocks.mean(axis=(1, 3))
+
+
+def zone_mask(zones: ZoneLookup, image_size: Tuple[int, int],
+              size: Tuple[int, int]) -> np.ndarray:
+    """Mask in shape (size[1], size[0]) of the pixels of a downsampled frame in any zone.
+
+    Args:
+        zones (ZoneLookup): Zones in the coordinates of the frames.
+        image_size (Tuple[int, int]): (width, height) of the frames.
+        size (Tuple[int, int]): (width, height) of the downsampled frames.
+    """
+    if isinstance(zones, Zones):
+        scale = np.array(size, dtype=np.float32) / np.array(image_size, dtype=np.float32)
+        raster = ZoneRaster.from_polygons([polygon * scale for polygon in zones.polygons],
+                                          size)
+        return raster.bits != 0
+    assert isinstance(zones, ZoneRaster), "Zones must be Zones or a ZoneRaster"
+    # BOX keeps every source pixel, so a pixel is in a zone if any source pixel is
+    covered = Image.fromarray((zones.bits != 0).astype(np.uint8) * 255)
+    return np.asarray(covered.resize(size, Image.BOX)) > 0
+
+
+class MotionGate:
+    """Skip the API call on snapshots of a fixed camera that did not change.
+
+    Each frame is compared with a downsampled grayscale reference, the frame of the last
+    API call. A block of the downsampled frame changed when more than `block_threshold`
+    of its pixels differ by more than `pixel_threshold`. Without changed block, the last
+    detections are reused. With `zones`, only changed blocks overlapping the zones trigger
+    a call, and the reference follows the frames outside of the zones.
+
+    Args:
+        infer_fn (Callable): Function taking a frame and returning one result of the
+            wrapper, e.g. `trex.tracking.embedding_infer_fn(trex2, prompts)`.
+        size (Tuple[int, int]): (width, height) of the downsampled frames, multiples of
+            `block_size`. Defaults to (160, 96).
+        block_size (int): Side of the blocks in downsampled pixels. Defaults to 8.
+        pixel_threshold (float): Minimum gray level difference of a changed pixel.
+            Defaults to 12.
+        block_threshold (float): Minimum fraction of changed pixels of a changed block.
+            Defaults to 0.1.
+        zones (ZoneLookup): `Zones` or `ZoneRaster` in the coordinates of the frames
+            whose changes matter. Defaults to None, which watches the whole frame.
+        max_reuse (int): Call the API at least every `max_reuse` frames. Defaults to
+            None, which reuses the detections as long as nothing changes.
+    """
+
+    def __init__(self,
+                 infer_fn: Callable,
+                 size: Tuple[int, int] = (160, 96),
+                 block_size: int = 8,
+                 pixel_threshold: float = 12.0,
+                 block_threshold: float = 0.1,
+                 zones: ZoneLookup = None,
+                 max_reuse: int = None):
+        assert size[0] % block_size == 0 and size[1] % block_size == 0, \
+            "The downsampled size must be a multiple of the block size"
+        self.infer_fn = infer_fn
+        self.size = tuple(size)
+        self.block_size = block_size
+        self.pixel_threshold = pixel_threshold
+        self.block_threshold = block_threshold
+        self.zones = zones
+        self.max_reuse = max_reuse
+        self.reference = None
+        self.result = None
+        self.image_size = None
+        # downsampled pixels and blocks inside the zones, built on the first frame
+        self.zone_pixels = None
+        self.zone_blocks = None
+        self.num_frames = 0
+        self.num_inferred = 0
+        self.num_reused = 0
+        self.last_change = 0.0
+
+    @property
+    def skip_rate(self) -> float:
+        """Fraction of the frames whose API call was skipped."""
+        return 1 - self.num_inferred / max(self.num_frames, 1)
+
+    def set_image_size(self, image_size: Tuple[int, int]):
+        self.image_size = image_size
+        if self.zones is None or image_size is None:
+            return
+        self.zone_pixels = zone_mask(self.zones, image_size, self.size)
+        height, width = self.zone_pixels.shape
+        self.zone_blocks = self.zone_pixels.reshape(height // self.block_size, self.block_size,
+                                                    width // self.block_size,
+                                                    self.block_size).any(axis=(1, 3))
+
+    def changed_blocks(self, gray: np.ndarray) -> np.ndarray:
+        """Mask of the changed blocks against the reference, restricted to the zones."""
+        changed = block_change(self.reference, gray, self.pixel_threshold,
+                               self.block_size) > self.block_threshold
+        self.last_change = float(changed.mean())
+        if self.zone_blocks is not None:
+            changed &= self.zone_blocks
+        return changed
+
+    def step(self, frame) -> Dict:
+        """Process the next frame.
+
+        Args:
+            frame: The frame, a file path, an array or a PIL image, also accepted by
+                `infer_fn`.
+
+        Returns:
+            Dict: The result of `infer_fn`, either on this frame or reused, plus "reused"
+                (bool) telling if the API call was skipped.
+        """
+        image_size = read_image_size(frame)
+        if image_size != self.image_size:
+            # new camera geometry, start over
+            self.set_image_size(image_size)
+            self.reference = None
+        gray = load_gray(frame, self.size)
+        self.num_frames += 1
+        reuse = (self.reference is not None
+                 and (self.max_reuse is None or self.num_reused < self.max_reuse)
+                 and not self.changed_blocks(gray).any())
+        if reuse:
+            self.num_reused += 1
+            if self.zone_pixels is not None:
+                # changes outside of the zones do not accumulate against the reference
+                self.reference = np.where(self.zone_pixels, self.reference, gray)
+            result = copy.deepcopy(self.result)
+        else:
+            self.result = self.infer_fn(frame)
+            self.reference = gray
+            self.num_inferred += 1
+            self.num_reused = 0
+            result = copy.deepcopy(self.result)
+        result["reused"] = reuse
+        return result
+
+    def process(self, frames: Iterable) -> Iterator[Dict]:
+        """Process frames lazily, yielding the result of every frame."""
+        for frame in frames:
+            yield self.step(frame)
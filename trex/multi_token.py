@@ -0,0 +1,240 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from dds_cloudapi_sdk import Client
+
+from .client_pool import ClientPool
+from .deadline import POLL_INTERVAL, Deadline
+from .model_wrapper import TRex2APIWrapper
+from .rate_limit import TokenBucket
+from .scheduler import PriorityScheduler
+
+# HTTP status of the responses refused because of the quota of the token
+QUOTA_STATUS_CODES = (429, )
+# phrases of the server error messages returned when a token runs out of quota
+QUOTA_ERROR_PATTERNS = ("quota", "rate limit", "too many requests", "insufficient balance")
+
+
+class HedgeSkipped(Exception):
+    """Raised instead of running a hedged task when its token has no budget left."""
+
+
+def error_status_code(error: Exception) -> Optional[int]:
+    """HTTP status carried by an error, e.g. a `requests.HTTPError`, if any."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Tell if an error raised by the SDK is caused by the quota of the token.
+
+    Errors carrying an HTTP status are quota errors on `QUOTA_STATUS_CODES`. The SDK
+    raises the other API errors as a `RuntimeError` formatted as "..., error: <message of
+    the server>", only the message of the server is matched against
+    `QUOTA_ERROR_PATTERNS`, so task ids, urls or prompt errors never drain a token.
+    """
+    status = error_status_code(error)
+    if status is not None:
+        return status in QUOTA_STATUS_CODES
+    if type(error) is not RuntimeError:
+        return False
+    _, separator, message = str(error).lower().partition("error:")
+    return bool(separator) and any(pattern in message for pattern in QUOTA_ERROR_PATTERNS)
+
+
+class TokenState:
+    """Routing state of one token of `MultiTokenAPIWrapper`.
+
+    Args:
+        pool (ClientPool): Client pool of the token.
+        tasks_per_minute (float): Rate budget of the token. Defaults to None, which is
+            unlimited.
+    """
+
+    def __init__(self, pool: ClientPool, tasks_per_minute: float = None):
+        self.pool = pool
+        self.bucket = TokenBucket(tasks_per_minute / 60.0) if tasks_per_minute else None
+        self.in_flight = 0
+        self.drained_until = 0.0
+        self.num_tasks = 0
+        self.num_quota_errors = 0
+
+    @property
+    def token(self) -> str:
+        return self.pool.token
+
+    @property
+    def load(self) -> float:
+        """Fraction of the clients of the token in use."""
+        return self.in_flight / self.pool.pool_size
+
+    def is_available(self, now: float, charge_quota: bool = True) -> bool:
+        """Whether the token can take a call now, with budget left for a task if
+        `charge_quota`."""
+        return (self.drained_until <= now and self.in_flight < self.pool.pool_size
+                and (not charge_quota or self.bucket is None or self.bucket.available >= 1))
+
+    def wait_time(self, now: float, charge_quota: bool = True) -> float:
+        """Lower bound of the seconds until the token may be available again."""
+        wait_time = max(0.0, self.drained_until - now)
+        if charge_quota and self.bucket is not None:
+            wait_time = max(wait_time, self.bucket.wait_time())
+        return wait_time
+
+
+class MultiTokenAPIWrapper(TRex2APIWrapper):
+    """API wrapper for T-Rex2 balancing the load across several API tokens.
+
+    Every call is routed to the least loaded token which is not drained and has remaining
+    rate budget. A token whose call fails with a quota error is drained, i.e. not used,
+    for `drain_seconds`, and the call is retried once on every other token before the
+    error is raised. Hedged tasks count against the budget and the load of their token,
+    a task is not hedged when its token has no budget left. Standalone uploads run no
+    task, they are routed like the other calls but take no budget. Upload urls and
+    compiled embeddings are tracked per token.
+
+    Args:
+        tokens (List[str]): The tokens for T-Rex2 API.
+        tasks_per_minute (List[float]): Rate budget of each token, None for unlimited.
+            Defaults to None, which is unlimited for all the tokens.
+        drain_seconds (float): Seconds a token is drained after a quota error. Defaults
+            to 60.
+        pool_size (int): Maximum number of SDK clients used at the same time per token.
+            Defaults to 8.
+        idle_timeout (float): Seconds after which an idle pooled client is discarded.
+            Defaults to 60.
+        upload_cache_size (int): Number of upload urls cached per token. Defaults to 0,
+            which disables the cache.
+        hedge_quantile (float): Latency quantile after which tasks are hedged, see
+            `TRex2APIWrapper`. Defaults to None, which never hedges.
+        scheduler (PriorityScheduler): Scheduler admitting the calls by priority class
+            before they are routed, see `TRex2APIWrapper`. Defaults to None.
+    """
+
+    def __init__(self,
+                 tokens: List[str],
+                 tasks_per_minute: List[float] = None,
+                 drain_seconds: float = 60.0,
+                 pool_size: int = 8,
+                 idle_timeout: float = 60.0,
+                 upload_cache_size: int = 0,
+                 hedge_quantile: float = None,
+                 scheduler: PriorityScheduler = None):
+        assert len(tokens) > 0, "At least one token is required"
+        if tasks_per_minute is None:
+            tasks_per_minute = [None] * len(tokens)
+        assert len(tasks_per_minute) == len(tokens), \
+            "tasks_per_minute must have one budget per token"
+        super().__init__(tokens[0], pool_size, idle_timeout, upload_cache_size,
+                         hedge_quantile, scheduler)
+        self.drain_seconds = drain_seconds
+        pools = [self.pool] + [
+            ClientPool(token, pool_size, idle_timeout, upload_cache_size)
+            for token in tokens[1:]
+        ]
+        self.token_states = [
+            TokenState(pool, budget) for pool, budget in zip(pools, tasks_per_minute)
+        ]
+        self.routing_lock = threading.Lock()
+
+    def acquire_token(self,
+                      timeout: float = None,
+                      deadline: Deadline = None,
+                      charge_quota: bool = True) -> TokenState:
+        """Pick the least loaded available token, blocking until one is available. With
+        `charge_quota` the token must have budget left and one task of it is taken,
+        otherwise the budget is neither checked nor taken, e.g. for uploads.
+
+        Raises:
+            TimeoutError: If no token is available within `timeout` seconds.
+            CallCancelled: If the deadline is cancelled while waiting.
+            DeadlineExceeded: If the deadline expires while waiting.
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is not None:
+                deadline.check()
+            now = time.monotonic()
+            with self.routing_lock:
+                candidates = [
+                    state for state in self.token_states
+                    if state.is_available(now, charge_quota)
+                ]
+                # break ties by the number of routed tasks to spread the load evenly
+                candidates.sort(key=lambda state: (state.load, state.num_tasks))
+                for state in candidates:
+                    if (not charge_quota or state.bucket is None
+                            or state.bucket.try_acquire()):
+                        state.in_flight += 1
+                        state.num_tasks += 1
+                        return state
+                wait_time = min(state.wait_time(now, charge_quota) for state in self.token_states)
+            if give_up_at is not None and now >= give_up_at:
+                raise TimeoutError(f"No available token within {timeout}s")
+            # all the clients may be busy, in which case wait_time is 0, so poll shortly
+            wait_time = min(max(wait_time, 0.01), 1.0)
+            if give_up_at is not None:
+                wait_time = min(wait_time, max(give_up_at - now, 0.0))
+            if deadline is not None:
+                wait_time = min(wait_time, POLL_INTERVAL)
+            time.sleep(wait_time)
+
+    def release_token(self, state: TokenState, error: Exception = None):
+        with self.routing_lock:
+            state.in_flight -= 1
+            if error is not None and is_quota_error(error):
+                state.num_quota_errors += 1
+                state.drained_until = time.monotonic() + self.drain_seconds
+
+    @contextmanager
+    def lease_pool_client(self, charge_quota: bool = True) -> Iterator[Tuple[ClientPool, Client]]:
+        """Lease a client of the least loaded token without binding it to the current
+        thread. See `TRex2APIWrapper.lease_client` for `charge_quota`."""
+        deadline = self.current_deadline
+        with self.admit(charge_quota):
+            state = self.acquire_token(deadline=deadline, charge_quota=charge_quota)
+            error = None
+            try:
+                with state.pool.lease(deadline=deadline) as client:
+                    yield state.pool, client
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self.release_token(state, error)
+
+    def call_leased(self, func, *args, charge_quota: bool = True, **kwargs):
+        """Run `func` with a leased client, on another token when it fails with a quota
+        error."""
+        if getattr(self.local, "client", None) is not None:
+            # nested call, retried with its outer call
+            return super().call_leased(func, *args, charge_quota=charge_quota, **kwargs)
+        for attempt in range(len(self.token_states)):
+            try:
+                return super().call_leased(func, *args, charge_quota=charge_quota, **kwargs)
+            except Exception as e:
+                # the failed token is drained, the next lease picks another one
+                if attempt == len(self.token_states) - 1 or not is_quota_error(e):
+                    raise
+
+    def run_hedge(self, pool: ClientPool, task):
+        """Run a hedged task within the budget and the load accounting of its token."""
+        state = next(state for state in self.token_states if state.pool is pool)
+        with self.routing_lock:
+            if (state.drained_until > time.monotonic()
+                    or (state.bucket is not None and not state.bucket.try_acquire())):
+                raise HedgeSkipped("No budget left on the token to hedge the task")
+            state.in_flight += 1
+            state.num_tasks += 1
+        error = None
+        try:
+            return super().run_hedge(pool, task)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release_token(state, error)
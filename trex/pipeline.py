@@ -0,0 +1,186 @@
+import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .image import ImageHandle, encode_image
+from .prompts import (validate_embedding_prompts, validate_generic_prompts,
+                      validate_interactive_prompts)
+
+
+def resolve_prompt_images(prompts: List[Dict], upload: Callable) -> List[Dict]:
+    """Copy of interactive or customize prompts with the prompt images uploaded."""
+    return [dict(prompt, prompt_image=upload(prompt["prompt_image"])) for prompt in prompts]
+
+
+def resolve_generic_images(request: Tuple, upload: Callable) -> Tuple:
+    """Copy of a (target_image, prompts) request with all the images uploaded."""
+    target_image, prompts = request
+    return upload(target_image), resolve_prompt_images(prompts, upload)
+
+
+def resolve_embedding_images(prompts: List[Dict], upload: Callable) -> List[Dict]:
+    """Copy of embedding inference prompts with the images and embeddings uploaded."""
+    return [
+        dict(prompt,
+             image=upload(prompt["image"]),
+             prompts=[dict(p, embd=upload(p["embd"])) for p in prompt["prompts"]])
+        for prompt in prompts
+    ]
+
+
+def validate_generic_request(request: Tuple) -> Tuple:
+    target_image, prompts = request
+    return target_image, validate_generic_prompts(prompts)
+
+
+# workflow: (function validating a request, function uploading its files, function
+# running it)
+WORKFLOWS = {
+    "interactive": (validate_interactive_prompts, resolve_prompt_images,
+                    lambda trex2, r: trex2.interactve_inference(r)),
+    "generic": (validate_generic_request, resolve_generic_images,
+                lambda trex2, r: trex2.generic_inference(*r)),
+    "customize": (validate_generic_prompts, resolve_prompt_images,
+                  lambda trex2, r: trex2.customize_embedding(r)),
+    "embedding": (validate_embedding_prompts, resolve_embedding_images,
+                  lambda trex2, r: trex2.embedding_inference(r)),
+}
+
+
+def decoded_size(image) -> int:
+    """Size in bytes of a decoded image, an upper bound of its encoded size."""
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands())
+
+
+class ByteBudget:
+    """Bound the number of bytes held at the same time by several threads. A single
+    reservation larger than the budget is allowed when nothing else is held, so it can
+    not block forever."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, num_bytes: int) -> Iterator[None]:
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.used == 0 or self.used + num_bytes <= self.max_bytes)
+            self.used += num_bytes
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= num_bytes
+                self.condition.notify_all()
+
+
+class PipelinedExecutor:
+    """Run the tasks of a workflow one after the other while the images of the next
+    tasks are encoded and uploaded in the background, so that the upload of task N + 1
+    overlaps the server-side run of task N.
+
+    Each task keeps the same client from its upload to its run, which keeps the uploaded
+    urls valid with `MultiTokenAPIWrapper`. `prefetch_depth + 1` clients are leased at
+    the same time, the pool of the wrapper must be at least that large.
+
+    Args:
+        trex2 (TRex2APIWrapper): Wrapper running the tasks.
+        prefetch_depth (int): Number of tasks uploaded ahead of the running one.
+            Defaults to 2.
+        max_buffered_bytes (int): Cap on the decoded images (arrays and PIL images) being
+            encoded and uploaded at the same time, in bytes. Files, bytes and urls are
+            not counted since they are already held by the caller. Defaults to 256 MB.
+    """
+
+    def __init__(self, trex2, prefetch_depth: int = 2, max_buffered_bytes: int = 256 << 20):
+        assert prefetch_depth >= 1, "prefetch_depth must be at least 1"
+        self.trex2 = trex2
+        self.prefetch_depth = prefetch_depth
+        self.budget = ByteBudget(max_buffered_bytes)
+
+    def upload(self, image) -> str:
+        """Upload an image, encoding decoded images within the memory budget."""
+        if isinstance(image, (np.ndarray, Image.Image)):
+            with self.budget.reserve(decoded_size(image)):
+                return self.trex2.get_image_url(encode_image(image))
+        if isinstance(image, ImageHandle) and image.needs_encoding:
+            # a handle needs encoding only when its source is decoded
+            with self.budget.reserve(decoded_size(image.source)):
+                return self.trex2.get_image_url(image)
+        return self.trex2.get_image_url(image)
+
+    def prefetch(self, workflow: str, request) -> Tuple:
+        """Lease a client and upload the files of a request with it.
+
+        Returns:
+            Tuple: (request with urls, pool, client, lease), the lease must be closed once
+                the task has run.
+        """
+        validate, resolve, _ = WORKFLOWS[workflow]
+        # fail before leasing a client and uploading anything
+        request = validate(request)
+        lease = ExitStack()
+        pool, client = lease.enter_context(self.trex2.lease_pool_client())
+        try:
+            with self.trex2.bind_client(pool, client):
+                return resolve(request, self.upload), pool, client, lease
+        except BaseException:
+            if not lease.__exit__(*sys.exc_info()):
+                raise
+
+    def map(self, workflow: str, requests: Iterable) -> Iterator:
+        """Run the requests of a workflow in order, uploading ahead.
+
+        Args:
+            workflow (str): One of "interactive", "generic", "customize" or "embedding".
+            requests (Iterable): Arguments of the workflow method: prompts for
+                `interactve_inference`, `customize_embedding` and `embedding_inference`,
+                (target_image, prompts) for `generic_inference`. Consumed lazily.
+
+        Yields:
+            The result of each request, in the same order as `requests`.
+        """
+        assert workflow in WORKFLOWS, f"Invalid workflow {workflow}"
+        _, _, run = WORKFLOWS[workflow]
+        requests = iter(requests)
+        pending = deque()
+        executor = ThreadPoolExecutor(self.prefetch_depth)
+
+        def submit_next():
+            for request in requests:
+                pending.append(executor.submit(self.prefetch, workflow, request))
+                return
+
+        try:
+            # with the running task, at most prefetch_depth + 1 leases are held
+            for _ in range(self.prefetch_depth):
+                submit_next()
+            while pending:
+                request, pool, client, lease = pending.popleft().result()
+                # keep prefetch_depth uploads in flight while this task runs
+                submit_next()
+                with lease, self.trex2.bind_client(pool, client):
+                    result = run(self.trex2, request)
+                yield result
+        finally:
+            for future in pending:
+                self.discard(future)
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def discard(future: Future):
+        """Release the lease of a prefetch whose task will not run."""
+        if future.cancel():
+            return
+        if future.exception() is None:
+            future.result()[3].close()
@@ -0,0 +1,255 @@
+import numbers
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .image import read_image_size
+
+# maximum number of images in one interactive or embedding inference task
+MAX_BATCH_SIZE = 4
+
+# singular keys used in older examples, accepted and renamed
+KEY_ALIASES = {"rect": "rects", "point": "points"}
+# number of coordinates of each visual prompt
+PROMPT_WIDTHS = {"rects": 4, "points": 2}
+# interactive prompt type -> key of its visual prompts
+INTERACTIVE_KEYS = {"rect": "rects", "point": "points"}
+
+
+class PromptValidationError(ValueError):
+    """Raised when prompts are malformed. Prompts are validated before any upload."""
+
+
+class GenericPrompts(list):
+    """Generic prompts returned by `validate_generic_prompts`, which returns them as they
+    are when they are validated again, e.g. by the nested calls of the wrapper, instead
+    of reading the sizes of their images again.
+
+    Args:
+        prompts (List[dict]): The normalized prompts.
+        bounds_checked (bool): Whether the coordinates were checked against the sizes of
+            the prompt images.
+    """
+
+    def __init__(self, prompts: List[dict], bounds_checked: bool):
+        super().__init__(prompts)
+        self.bounds_checked = bounds_checked
+
+
+def require_dict(value, where: str) -> dict:
+    if not isinstance(value, dict):
+        raise PromptValidationError(f"{where}: expected a dict, got {type(value).__name__}")
+    return value
+
+
+def require_list(value, where: str, max_length: int = None) -> list:
+    if not isinstance(value, (list, tuple)) or len(value) == 0:
+        raise PromptValidationError(f"{where}: expected a non-empty list")
+    if max_length is not None and len(value) > max_length:
+        raise PromptValidationError(
+            f"{where}: at most {max_length} images per batch, got {len(value)}")
+    return value
+
+
+def require_keys(prompt: dict, keys: Tuple[str, ...], where: str):
+    missing = [key for key in keys if key not in prompt]
+    if missing:
+        raise PromptValidationError(f"{where}: missing {', '.join(map(repr, missing))}")
+
+
+def require_category_id(prompt: dict, where: str):
+    category_id = prompt.get("category_id")
+    if not isinstance(category_id, numbers.Integral) or isinstance(category_id, bool):
+        raise PromptValidationError(f"{where}: category_id must be an integer")
+
+
+def normalize_keys(prompt: dict, where: str) -> dict:
+    """Copy of a prompt with the `rect` and `point` keys renamed `rects` and `points`."""
+    prompt = dict(prompt)
+    for alias, key in KEY_ALIASES.items():
+        if alias in prompt:
+            if key in prompt:
+                raise PromptValidationError(f"{where}: both {alias!r} and {key!r} are given")
+            prompt[key] = prompt.pop(alias)
+    return prompt
+
+
+def parse_coordinates(values, width: int, where: str) -> Tuple[list, np.ndarray]:
+    """Parse boxes (width 4) or points (width 2). A single box or point is wrapped in a
+    list.
+
+    Returns:
+        Tuple[list, np.ndarray]: The normalized coordinates as nested lists, and as an
+            array in shape (N, width).
+    """
+    try:
+        array = np.asarray(values)
+    except ValueError:
+        array = None
+    if array is None or array.dtype.kind not in "iuf":
+        raise PromptValidationError(f"{where}: coordinates must be numbers")
+    if array.ndim == 1 and len(array) == width:
+        array = array[None]
+    if array.ndim != 2 or array.shape[1] != width or len(array) == 0:
+        raise PromptValidationError(
+            f"{where}: expected a non-empty list of [{', '.join(['v'] * width)}], got shape "
+            f"{array.shape}")
+    return array.tolist(), array.astype(np.float64)
+
+
+def check_coordinates(entries: List[Tuple[str, np.ndarray, object]], check_bounds: bool):
+    """Check all the boxes and points of a request at once.
+
+    Boxes must not be inverted or empty, and boxes and points must lie inside their
+    image, whose size is read from the image header.
+
+    Args:
+        entries (List[Tuple[str, np.ndarray, object]]): (where, coordinates in shape
+            (N, 4) or (N, 2), image) of every prompt.
+        check_bounds (bool): Also check the coordinates against the image sizes.
+
+    Raises:
+        PromptValidationError: Describing the first invalid box or point.
+    """
+    sizes = {}
+    for width in sorted(set(PROMPT_WIDTHS.values())):
+        group = [entry for entry in entries if entry[1].shape[1] == width]
+        if not group:
+            continue
+        coordinates = np.concatenate([array for _, array, _ in group])
+        owners = np.repeat(np.arange(len(group)), [len(array) for _, array, _ in group])
+        xs, ys = coordinates[:, 0::2], coordinates[:, 1::2]
+        reasons = np.zeros(len(coordinates), dtype=np.int8)
+        if check_bounds:
+            # (width, height) of the image of every row, nan when unknown, e.g. urls
+            image_sizes = np.full((len(group), 2), np.nan)
+            for i, (_, _, image) in enumerate(group):
+                if id(image) not in sizes:
+                    sizes[id(image)] = read_image_size(image)
+                if sizes[id(image)] is not None:
+                    image_sizes[i] = sizes[id(image)]
+            image_sizes = image_sizes[owners]
+            outside = ((xs < 0) | (ys < 0) | (xs > image_sizes[:, :1])
+                       | (ys > image_sizes[:, 1:])).any(axis=1)
+            reasons[outside] = 2
+        if width == 4:
+            reasons[(xs[:, 1] <= xs[:, 0]) | (ys[:, 1] <= ys[:, 0])] = 1
+        if reasons.any():
+            row = int(np.argmax(reasons > 0))
+            where, _, image = group[owners[row]]
+            index = row - int(np.searchsorted(owners, owners[row]))
+            value = coordinates[row].tolist()
+            if reasons[row] == 1:
+                message = f"inverted or empty box {value}, expected [xmin, ymin, xmax, ymax]"
+            else:
+                message = f"{value} is outside of the image of size {sizes[id(image)]}"
+            raise PromptValidationError(
+                f"{where}[{index}]: {message} ({int((reasons > 0).sum())} invalid in total)")
+
+
+def validate_generic_prompts(prompts: List[dict], check_bounds: bool = True) -> List[dict]:
+    """Validate and normalize the prompts of `generic_inference` and `customize_embedding`.
+
+    Args:
+        prompts (List[dict]): Generic prompts, see `TRex2APIWrapper.generic_inference`.
+        check_bounds (bool): Check the coordinates against the sizes of the prompt images.
+            Defaults to True.
+
+    Returns:
+        List[dict]: Copies of the prompts with `rects` or `points` keys, as
+            `GenericPrompts`.
+
+    Raises:
+        PromptValidationError: If the prompts are malformed.
+    """
+    if isinstance(prompts, GenericPrompts) and (prompts.bounds_checked or not check_bounds):
+        return prompts
+    require_list(prompts, "prompts")
+    normalized, entries = [], []
+    for i, prompt in enumerate(prompts):
+        where = f"prompts[{i}]"
+        prompt = normalize_keys(require_dict(prompt, where), where)
+        require_keys(prompt, ("prompt_image", ), where)
+        keys = [key for key in PROMPT_WIDTHS if key in prompt]
+        if len(keys) != 1:
+            raise PromptValidationError(f"{where}: expected exactly one of 'rects' and 'points'")
+        key = keys[0]
+        prompt[key], array = parse_coordinates(prompt[key], PROMPT_WIDTHS[key], f"{where}.{key}")
+        entries.append((f"{where}.{key}", array, prompt["prompt_image"]))
+        normalized.append(prompt)
+    prompt_types = {key for prompt in normalized for key in PROMPT_WIDTHS if key in prompt}
+    if len(prompt_types) > 1:
+        raise PromptValidationError("prompts: all the prompts must use the same prompt type, "
+                                    "either 'rects' or 'points'")
+    check_coordinates(entries, check_bounds)
+    return GenericPrompts(normalized, check_bounds)
+
+
+def validate_interactive_prompts(prompts: List[Dict], check_bounds: bool = True) -> List[Dict]:
+    """Validate and normalize the prompts of `interactve_inference`.
+
+    Args:
+        prompts (List[Dict]): Batch annotations, see `TRex2APIWrapper.interactve_inference`.
+        check_bounds (bool): Check the coordinates against the sizes of the prompt images.
+            Defaults to True.
+
+    Returns:
+        List[Dict]: Copies of the prompts with `rects` or `points` keys.
+
+    Raises:
+        PromptValidationError: If the prompts are malformed.
+    """
+    require_list(prompts, "prompts", MAX_BATCH_SIZE)
+    normalized, entries = [], []
+    for i, prompt in enumerate(prompts):
+        where = f"prompts[{i}]"
+        prompt = dict(require_dict(prompt, where))
+        require_keys(prompt, ("prompt_image", "type", "prompts"), where)
+        if prompt["type"] not in INTERACTIVE_KEYS:
+            raise PromptValidationError(
+                f"{where}: type must be 'rect' or 'point', got {prompt['type']!r}")
+        key = INTERACTIVE_KEYS[prompt["type"]]
+        category_prompts = []
+        for j, category_prompt in enumerate(require_list(prompt["prompts"], f"{where}.prompts")):
+            category_where = f"{where}.prompts[{j}]"
+            category_prompt = normalize_keys(require_dict(category_prompt, category_where),
+                                             category_where)
+            require_category_id(category_prompt, category_where)
+            other_keys = [other for other in PROMPT_WIDTHS if other != key and other in
+                          category_prompt]
+            if key not in category_prompt or other_keys:
+                raise PromptValidationError(
+                    f"{category_where}: a {prompt['type']!r} prompt expects {key!r}")
+            category_prompt[key], array = parse_coordinates(category_prompt[key],
+                                                            PROMPT_WIDTHS[key],
+                                                            f"{category_where}.{key}")
+            entries.append((f"{category_where}.{key}", array, prompt["prompt_image"]))
+            category_prompts.append(category_prompt)
+        prompt["prompts"] = category_prompts
+        normalized.append(prompt)
+    check_coordinates(entries, check_bounds)
+    return normalized
+
+
+def validate_embedding_prompts(prompts: List[dict]) -> List[dict]:
+    """Validate the prompts of `embedding_inference`.
+
+    Args:
+        prompts (List[dict]): Batch annotations, see `TRex2APIWrapper.embedding_inference`.
+
+    Returns:
+        List[dict]: The prompts, unchanged.
+
+    Raises:
+        PromptValidationError: If the prompts are malformed.
+    """
+    require_list(prompts, "prompts", MAX_BATCH_SIZE)
+    for i, prompt in enumerate(prompts):
+        where = f"prompts[{i}]"
+        require_keys(require_dict(prompt, where), ("image", "prompts"), where)
+        for j, category_prompt in enumerate(require_list(prompt["prompts"], f"{where}.prompts")):
+            category_where = f"{where}.prompts[{j}]"
+            require_keys(require_dict(category_prompt, category_where), ("category_id", "embd"),
+                         category_where)
+            require_category_id(category_prompt, category_where)
+    return prompts
@@ -0,0 +1,282 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .box_ops import box_area, box_iou
+from .image import ImageHandle
+
+
+def load_rgb(image) -> np.ndarray:
+    """Decode a file path, PIL image, array or ImageHandle to an RGB array in shape
+    (H, W, 3)."""
+    if isinstance(image, ImageHandle):
+        image = image.array
+    if isinstance(image, np.ndarray):
+        return image if image.ndim == 3 and image.shape[2] == 3 else np.asarray(
+            Image.fromarray(image).convert("RGB"))
+    if isinstance(image, str):
+        image = Image.open(image)
+    return np.asarray(image.convert("RGB"))
+
+
+def weighted_box_fusion(boxes: np.ndarray,
+                        scores: np.ndarray,
+                        labels: np.ndarray,
+                        coverage: Callable,
+                        iou_threshold: float = 0.55) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fuse the detections of several passes over the same image.
+
+    Detections are clustered in decreasing score order: a detection joins the cluster of
+    the same label whose fused box overlaps it the most with an IoU above `iou_threshold`.
+    The fused box is the score weighted mean of the boxes of the cluster, and its score the
+    sum of their scores divided by the number of passes which saw the box, so a box found
+    by one of two passes gets half of its score.
+
+    Args:
+        boxes (np.ndarray): Boxes of all the passes in shape (N, 4), [x1, y1, x2, y2].
+        scores (np.ndarray): Scores in shape (N).
+        labels (np.ndarray): Labels in shape (N).
+        coverage (Callable): Function taking fused boxes in shape (M, 4) and returning the
+            number of passes covering each of them in shape (M).
+        iou_threshold (float): Minimum IoU of a detection with its cluster. Defaults to
+            0.55.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Fused boxes, scores and labels, by
+            decreasing score.
+    """
+    order = np.argsort(-scores, kind="stable")
+    same_label = labels[order][:, None] == labels[order][None, :]
+    # cluster of every detection, index of the detection which started it
+    clusters = np.full(len(order), -1)
+    weighted_sums = np.zeros((len(order), 4))
+    score_sums = np.zeros(len(order))
+    fused = np.zeros((len(order), 4))
+    for i in range(len(order)):
+        heads = np.flatnonzero(clusters[:i] == np.arange(i))
+        if len(heads):
+            fused_ious = box_iou(boxes[order[i]], fused[heads])[0]
+            fused_ious[~same_label[i, heads]] = -1
+            best = int(np.argmax(fused_ious))
+            if fused_ious[best] > iou_threshold:
+                head = heads[best]
+                clusters[i] = head
+                weighted_sums[head] += scores[order[i]] * boxes[order[i]]
+                score_sums[head] += scores[order[i]]
+                fused[head] = weighted_sums[head] / score_sums[head]
+                continue
+        clusters[i] = i
+        weighted_sums[i] = scores[order[i]] * boxes[order[i]]
+        score_sums[i] = scores[order[i]]
+        fused[i] = boxes[order[i]]
+    heads = np.flatnonzero(clusters == np.arange(len(order)))
+    sizes = np.bincount(clusters, minlength=len(order))[heads]
+    fused_scores = score_sums[heads] / np.maximum(sizes, coverage(fused[heads]))
+    keep = np.argsort(-fused_scores, kind="stable")
+    return (fused[heads][keep].astype(np.float32), fused_scores[keep].astype(np.float32),
+            labels[order][heads][keep])
+
+
+def crop_bounds(window: np.ndarray, scale: float, image_size: Tuple[int, int]) -> np.ndarray:
+    """Bounds [x1, y1, x2, y2] of the boxes kept from a crop: a box touching a border of
+    the crop inside the image, within 2 pixels of the upscaled crop, is a truncated object.
+    Borders on the border of the image do not cut boxes and are unbounded.
+
+    Args:
+        window (np.ndarray): Window [x1, y1, x2, y2] of the crop in the image.
+        scale (float): Upscale of the crop.
+        image_size (Tuple[int, int]): (width, height) of the image.
+
+    Returns:
+        np.ndarray: Bounds in shape (4), a box is kept when it is strictly inside them.
+    """
+    x1, y1, x2, y2 = window.tolist()
+    width, height = image_size
+    margin = 2 * (x2 - x1) / max(round((x2 - x1) * scale), 1)
+    return np.array([
+        x1 + margin if x1 > 0 else -np.inf,
+        y1 + margin if y1 > 0 else -np.inf,
+        x2 - margin if x2 < width else np.inf,
+        y2 - margin if y2 < height else np.inf,
+    ], dtype=np.float32)
+
+
+def inside_bounds(boxes: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """Whether boxes in shape (..., 4) are strictly inside bounds from `crop_bounds`,
+    broadcast against each other."""
+    return ((boxes[..., :2] > bounds[..., :2]).all(axis=-1) &
+            (boxes[..., 2:] < bounds[..., 2:]).all(axis=-1))
+
+
+class PyramidInference:
+    """Adaptive multi-scale inference recovering small objects without tiling the image.
+
+    A first pass runs on the whole image. Its low confidence and small detections point at
+    the regions worth a second look: the image is split in a `grid_size` x `grid_size` grid
+    and the cells with the most such detections get an extra pass on an upscaled crop, up
+    to `max_crops` of them. The scale of a crop is picked from the sizes of its first pass
+    boxes so that the smaller ones reach about `target_size` pixels, and regions whose
+    objects are already large enough are skipped. The detections of all the passes are
+    fused with `weighted_box_fusion`.
+
+    Args:
+        infer_fn (Callable): Function taking an image and returning one result of the
+            wrapper, e.g. `trex.tracking.generic_infer_fn(trex2, prompts)` or
+            `trex.tracking.embedding_infer_fn(trex2, prompts)`.
+        score_threshold (float): Detections with lower scores are low confidence. Defaults
+            to 0.3.
+        min_score (float): Detections with lower scores are ignored when picking regions.
+            Defaults to 0.05.
+        small_size (float): Detections smaller than this, in pixels of the square root of
+            the area, are small. Defaults to 32.
+        target_size (float): Size in pixels the small objects of a crop are upscaled to.
+            Defaults to 96.
+        min_scale (float): Regions needing a smaller upscale are skipped. Defaults to 1.5.
+        max_scale (float): Maximum upscale of a crop. Defaults to 4.
+        max_crops (int): Maximum number of extra passes per image. Defaults to 2.
+        grid_size (int): Regions are picked among the cells of this grid. Defaults to 4.
+        min_candidates (int): Minimum number of low confidence or small detections in a
+            cell to pick it. Defaults to 2.
+        iou_threshold (float): IoU threshold of the box fusion. Defaults to 0.55.
+    """
+
+    def __init__(self,
+                 infer_fn: Callable,
+                 score_threshold: float = 0.3,
+                 min_score: float = 0.05,
+                 small_size: float = 32,
+                 target_size: float = 96,
+                 min_scale: float = 1.5,
+                 max_scale: float = 4.0,
+                 max_crops: int = 2,
+                 grid_size: int = 4,
+                 min_candidates: int = 2,
+                 iou_threshold: float = 0.55):
+        assert 1 <= min_scale <= max_scale, "Scales must satisfy 1 <= min_scale <= max_scale"
+        self.infer_fn = infer_fn
+        self.score_threshold = score_threshold
+        self.min_score = min_score
+        self.small_size = small_size
+        self.target_size = target_size
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.max_crops = max_crops
+        self.grid_size = grid_size
+        self.min_candidates = min_candidates
+        self.iou_threshold = iou_threshold
+        self.num_images = 0
+        self.num_crops = 0
+
+    @property
+    def crops_per_image(self) -> float:
+        """Mean number of extra passes per image."""
+        return self.num_crops / max(self.num_images, 1)
+
+    def select_regions(self, boxes: np.ndarray, scores: np.ndarray,
+                       image_size: Tuple[int, int]) -> List[Tuple[np.ndarray, float]]:
+        """Pick the regions of the extra passes from the first pass detections.
+
+        Returns:
+            List[Tuple[np.ndarray, float]]: ([x1, y1, x2, y2] in integer pixels, scale) of
+                every region.
+        """
+        width, height = image_size
+        sizes = np.sqrt(box_area(boxes))
+        candidates = (scores >= self.min_score) & ((scores < self.score_threshold)
+                                                   | (sizes < self.small_size))
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        cells = (np.clip((centers[:, 0] / width * self.grid_size).astype(np.int64), 0,
+                         self.grid_size - 1) * self.grid_size +
+                 np.clip((centers[:, 1] / height * self.grid_size).astype(np.int64), 0,
+                         self.grid_size - 1))
+        regions = []
+        while len(regions) < self.max_crops and candidates.sum() >= self.min_candidates:
+            counts = np.bincount(cells[candidates], minlength=self.grid_size**2)
+            cell = int(np.argmax(counts))
+            if counts[cell] < self.min_candidates:
+                break
+            members = candidates & (cells == cell)
+            # bring the smaller objects of the region to the target size
+            scale = min(self.target_size / max(np.quantile(sizes[members], 0.25), 1.0),
+                        self.max_scale)
+            if scale < self.min_scale:
+                # the objects are large enough already, another pass would not help
+                candidates &= ~members
+                continue
+            crop_size = np.array([width, height]) / scale
+            center = centers[members].mean(axis=0)
+            top_left = np.clip(center - crop_size / 2, 0, np.array([width, height]) - crop_size)
+            window = np.concatenate([top_left, top_left + crop_size]).round().astype(np.int64)
+            regions.append((window, scale))
+            inside = ((centers >= window[:2]) & (centers <= window[2:])).all(axis=1)
+            candidates &= ~inside
+        return regions
+
+    def infer_region(self, image: np.ndarray, window: np.ndarray,
+                     scale: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Run `infer_fn` on an upscaled crop and map its boxes back to the image, boxes
+        cut by the crop border are dropped."""
+        x1, y1, x2, y2 = window.tolist()
+        crop = Image.fromarray(image[y1:y2, x1:x2])
+        size = (max(round(crop.width * scale), 1), max(round(crop.height * scale), 1))
+        result = self.infer_fn(np.asarray(crop.resize(size, Image.BICUBIC)))
+        boxes = np.asarray(result["boxes"], dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(result["scores"], dtype=np.float32).reshape(-1)
+        labels = np.asarray(result["labels"], dtype=np.int64).reshape(-1)
+        ratios = np.array([size[0] / crop.width, size[1] / crop.height] * 2, dtype=np.float32)
+        boxes = boxes / ratios + np.array([x1, y1, x1, y1], dtype=np.float32)
+        height, width = image.shape[:2]
+        keep = inside_bounds(boxes, crop_bounds(window, scale, (width, height)))
+        return boxes[keep], scores[keep], labels[keep]
+
+    def __call__(self, image) -> Dict:
+        """Run the adaptive pyramid on an image.
+
+        Args:
+            image: A file path, a PIL image, an array or an ImageHandle. The first pass
+                sends it as it is, the crops are decoded from it once.
+
+        Returns:
+            Dict: Fused result in the format of the wrapper, plus "regions" (List[Dict]):
+                the "window" [x1, y1, x2, y2] and "scale" of every extra pass.
+        """
+        result = self.infer_fn(image)
+        self.num_images += 1
+        boxes = np.asarray(result["boxes"], dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(result["scores"], dtype=np.float32).reshape(-1)
+        labels = np.asarray(result["labels"], dtype=np.int64).reshape(-1)
+        if len(boxes) == 0:
+            return dict(result, regions=[])
+        pixels = load_rgb(image)
+        regions = self.select_regions(boxes, scores, (pixels.shape[1], pixels.shape[0]))
+        if not regions:
+            return dict(result, regions=[])
+        self.num_crops += len(regions)
+        with ThreadPoolExecutor(len(regions)) as executor:
+            passes = list(
+                executor.map(lambda region: self.infer_region(pixels, *region), regions))
+        bounds = np.stack([
+            crop_bounds(window, scale, (pixels.shape[1], pixels.shape[0]))
+            for window, scale in regions
+        ])
+
+        def coverage(fused: np.ndarray) -> np.ndarray:
+            # the first pass and the crops which would have kept the box, a crop cutting
+            # it could not see it whole
+            return 1 + inside_bounds(fused[:, None], bounds[None]).sum(axis=1)
+
+        boxes, scores, labels = weighted_box_fusion(
+            np.concatenate([boxes] + [p[0] for p in passes]),
+            np.concatenate([scores] + [p[1] for p in passes]),
+            np.concatenate([labels] + [p[2] for p in passes]), coverage, self.iou_threshold)
+        return {
+            "scores": scores.tolist(),
+            "labels": labels.tolist(),
+            "boxes": boxes.tolist(),
+            "regions": [{
+                "window": window.tolist(),
+                "scale": float(scale)
+            } for window, scale in regions],
+        }
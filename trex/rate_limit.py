@@ -0,0 +1,69 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter.
+
+    Args:
+        rate (float): Number of tokens refilled per second.
+        capacity (float): Maximum number of tokens, i.e. the allowed burst. Defaults to
+            max(rate, 1).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        assert rate > 0, "Rate must be positive"
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    @property
+    def available(self) -> float:
+        """Number of tokens currently available."""
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        """Take `amount` tokens if they are available, without blocking."""
+        with self.lock:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available."""
+        with self.lock:
+            self.refill()
+            return max(0.0, (amount - self.tokens) / self.rate)
+
+    def acquire(self, amount: float = 1.0, timeout: float = None) -> bool:
+        """Take `amount` tokens, blocking until they are available.
+
+        Args:
+            amount (float): Number of tokens to take. Defaults to 1.
+            timeout (float): Maximum seconds to wait. Defaults to None, which waits forever.
+
+        Returns:
+            bool: True if the tokens were taken, False on timeout.
+        """
+        assert amount <= self.capacity, "Can not acquire more than the capacity"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire(amount):
+            delay = self.wait_time(amount)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return True
@@ -0,0 +1,240 @@
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .deadline import POLL_INTERVAL, Deadline, LatencyTracker
+from .rate_limit import TokenBucket
+
+
+class PriorityClass:
+    """A class of traffic of `PriorityScheduler`, e.g. the clicks of annotators or a bulk
+    labeling job.
+
+    Args:
+        name (str): Name of the class, passed as `priority` to the calls of the wrapper.
+        weight (float): Share of the capacity the class gets when several classes are
+            waiting, relative to the weights of the others. Defaults to 1.
+        reserved_share (float): Fraction of the concurrency and of the quota kept free
+            for this class, which the other classes can not use even when it is idle.
+            Defaults to 0.
+    """
+
+    def __init__(self, name: str, weight: float = 1.0, reserved_share: float = 0.0):
+        assert weight > 0, "Weight must be positive"
+        assert 0 <= reserved_share < 1, "Reserved share must be in [0, 1)"
+        self.name = name
+        self.weight = weight
+        self.reserved_share = reserved_share
+        # set by the scheduler
+        self.reserved_slots = 0
+        self.reserved_tokens = 0
+        # waiting calls, first come first served within the class
+        self.queue = deque()
+        self.running = 0
+        # virtual finish time of the last admitted call, for the weighted fair queuing
+        self.finish_time = 0.0
+        self.num_admitted = 0
+        self.num_abandoned = 0
+        self.max_queued = 0
+        self.total_wait = 0.0
+        self.waits = LatencyTracker(min_samples=1)
+
+    def __repr__(self) -> str:
+        return (f"PriorityClass({self.name!r}, weight={self.weight}, "
+                f"reserved_share={self.reserved_share})")
+
+
+def default_classes() -> List[PriorityClass]:
+    """Interactive calls weighted 4 to 1 against bulk calls, with a quarter of the
+    concurrency and quota reserved for them."""
+    return [
+        PriorityClass("interactive", weight=4.0, reserved_share=0.25),
+        PriorityClass("bulk", weight=1.0),
+    ]
+
+
+class PriorityScheduler:
+    """Admission of the calls of one or several wrappers sharing a token, by priority
+    class.
+
+    At most `max_concurrency` calls run at the same time. When a call ends, the next one
+    is picked among the classes with waiting calls by weighted fair queuing: every class
+    gets a share of the admissions proportional to its weight, and a class which was idle
+    does not accumulate credit. Within a class, calls run in arrival order.
+
+    A class with a `reserved_share` keeps that fraction of the concurrency slots, rounded
+    up, free for itself: other classes can only take the slots left once the unused
+    reserved slots are set aside. With `tasks_per_minute`, admissions also take a token
+    of a shared rate budget, and the reserved fraction of its burst, rounded up, is kept
+    for the class, so that its calls do not wait for the quota behind a backlog of other calls.
+    Both reservations keep the latency of interactive calls low while bulk calls use the
+    rest of the capacity.
+
+    Args:
+        max_concurrency (int): Maximum number of calls running at the same time, at
+            most the number of clients of the wrapper so calls do not queue in the pool.
+            Defaults to 8.
+        tasks_per_minute (float): Rate budget shared by all the classes. Defaults to None,
+            which is unlimited.
+        classes (List[PriorityClass]): The classes, the first one is the most latency
+            sensitive. Defaults to None, which uses `default_classes`.
+        default_class (str): Class of the calls without priority. Defaults to None, which
+            is the last class, e.g. "bulk".
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 8,
+                 tasks_per_minute: float = None,
+                 classes: List[PriorityClass] = None,
+                 default_class: str = None):
+        assert max_concurrency > 0, "Concurrency must be positive"
+        classes = default_classes() if classes is None else list(classes)
+        assert classes, "At least one class is required"
+        self.classes = {priority_class.name: priority_class for priority_class in classes}
+        assert len(self.classes) == len(classes), "Class names must be unique"
+        self.default_class = default_class or classes[-1].name
+        assert self.default_class in self.classes, f"Unknown class {self.default_class}"
+        self.max_concurrency = max_concurrency
+        for priority_class in classes:
+            priority_class.reserved_slots = math.ceil(priority_class.reserved_share *
+                                                      max_concurrency)
+        assert sum(c.reserved_slots for c in classes) < max_concurrency, \
+            "Reserved slots must leave at least one shared slot"
+        self.bucket = None
+        if tasks_per_minute:
+            # the burst of the budget, plus the reserved tokens on top of it
+            burst = max(tasks_per_minute / 60.0, 1.0)
+            for priority_class in classes:
+                priority_class.reserved_tokens = math.ceil(priority_class.reserved_share * burst)
+            self.bucket = TokenBucket(tasks_per_minute / 60.0,
+                                      burst + sum(c.reserved_tokens for c in classes))
+        self.running = 0
+        # virtual time of the weighted fair queuing, start time of the last admitted call
+        self.virtual_time = 0.0
+        self.condition = threading.Condition()
+
+    def held_slots(self, priority_class: PriorityClass) -> int:
+        """Number of free slots reserved for the other classes."""
+        return sum(
+            max(other.reserved_slots - other.running, 0) for other in self.classes.values()
+            if other is not priority_class)
+
+    def held_tokens(self, priority_class: PriorityClass) -> float:
+        """Number of quota tokens reserved for the other classes."""
+        return sum(other.reserved_tokens for other in self.classes.values()
+                   if other is not priority_class)
+
+    def select(self) -> Tuple[Optional[PriorityClass], Optional[float]]:
+        """Pick the class whose first waiting call runs next.
+
+        Returns:
+            Tuple[Optional[PriorityClass], Optional[float]]: The class, None if no call can
+                run now, and the seconds until the quota may admit a call, None if the
+                quota is not what blocks.
+        """
+        free = self.max_concurrency - self.running
+        selected, quota_wait = None, None
+        for priority_class in self.classes.values():
+            if not priority_class.queue or free - self.held_slots(priority_class) < 1:
+                continue
+            if self.bucket is not None:
+                needed = 1 + self.held_tokens(priority_class)
+                wait = self.bucket.wait_time(needed)
+                if wait > 0:
+                    quota_wait = wait if quota_wait is None else min(quota_wait, wait)
+                    continue
+            if selected is None or self.start_time(priority_class) < self.start_time(selected):
+                selected = priority_class
+        return selected, quota_wait
+
+    def start_time(self, priority_class: PriorityClass) -> float:
+        return max(priority_class.finish_time, self.virtual_time)
+
+    def acquire(self, name: str = None, deadline: Deadline = None) -> PriorityClass:
+        """Wait until a call of class `name` may run and take its slot, which must be
+        given back with `release`.
+
+        Args:
+            name (str): Name of the class. Defaults to None, which is `default_class`.
+            deadline (Deadline): Deadline and cancellation of the wait. Defaults to None,
+                which waits forever.
+
+        Returns:
+            PriorityClass: The class of the call.
+
+        Raises:
+            CallCancelled: If the deadline is cancelled while waiting.
+            DeadlineExceeded: If the deadline expires while waiting.
+        """
+        priority_class = self.classes[name or self.default_class]
+        waiter = object()
+        enqueued_at = time.monotonic()
+        with self.condition:
+            priority_class.queue.append(waiter)
+            priority_class.max_queued = max(priority_class.max_queued, len(priority_class.queue))
+            try:
+                while True:
+                    selected, quota_wait = self.select()
+                    if selected is priority_class and priority_class.queue[0] is waiter:
+                        break
+                    if deadline is not None:
+                        deadline.check()
+                    timeout = POLL_INTERVAL if deadline is not None else None
+                    if quota_wait is not None:
+                        timeout = quota_wait if timeout is None else min(timeout, quota_wait)
+                    self.condition.wait(timeout)
+            except BaseException:
+                priority_class.queue.remove(waiter)
+                priority_class.num_abandoned += 1
+                # the call may have been the next one to run
+                self.condition.notify_all()
+                raise
+            priority_class.queue.popleft()
+            if self.bucket is not None:
+                self.bucket.try_acquire()
+            start_time = self.start_time(priority_class)
+            self.virtual_time = start_time
+            priority_class.finish_time = start_time + 1 / priority_class.weight
+            priority_class.running += 1
+            priority_class.num_admitted += 1
+            self.running += 1
+            wait = time.monotonic() - enqueued_at
+            priority_class.total_wait += wait
+            priority_class.waits.record(wait)
+            # the next waiting call may be able to run as well
+            self.condition.notify_all()
+        return priority_class
+
+    def release(self, priority_class: PriorityClass):
+        with self.condition:
+            priority_class.running -= 1
+            self.running -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, name: str = None, deadline: Deadline = None) -> Iterator[PriorityClass]:
+        """Hold a slot of class `name` for the duration of the context, see `acquire`."""
+        priority_class = self.acquire(name, deadline)
+        try:
+            yield priority_class
+        finally:
+            self.release(priority_class)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Queue depth, running calls and wait times in seconds of every class."""
+        with self.condition:
+            return {
+                name: {
+                    "queued": len(priority_class.queue),
+                    "max_queued": priority_class.max_queued,
+                    "running": priority_class.running,
+                    "admitted": priority_class.num_admitted,
+                    "abandoned": priority_class.num_abandoned,
+                    "mean_wait": priority_class.total_wait / max(priority_class.num_admitted, 1),
+                    "p50_wait": priority_class.waits.quantile(0.5),
+                    "p95_wait": priority_class.waits.quantile(0.95),
+                } for name, priority_class in self.classes.items()
+            }
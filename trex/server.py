@@ -0,0 +1,506 @@
+import argparse
+import base64
+import binascii
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+from .client_pool import UploadCache
+from .deadline import Deadline, DeadlineExceeded
+from .image import image_digest, is_url
+from .multi_token import MultiTokenAPIWrapper
+from .pipeline import WORKFLOWS
+from .prompts import MAX_BATCH_SIZE, PromptValidationError
+from .rate_limit import TokenBucket
+from .scheduler import PriorityScheduler
+
+# workflows whose requests are lists of up to MAX_BATCH_SIZE prompts, run as one task
+BATCHED_WORKFLOWS = ("interactive", "embedding")
+
+
+class RateLimited(Exception):
+    """Raised when a caller exceeds its request rate."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+
+class UnknownWorkflow(KeyError):
+    """Raised when a request names a workflow which does not exist."""
+
+
+class InvalidPriority(ValueError):
+    """Raised when a request names a priority class the gateway does not have."""
+
+
+class MicroBatcher:
+    """Coalesce concurrent requests into batched calls. A batch is sent when it is full or
+    when its oldest request waited `max_delay` seconds.
+
+    Args:
+        run_batch (Callable): Function taking the concatenated items of several requests
+            and returning one result per item.
+        max_batch_size (int): Maximum number of items of a batch.
+        max_delay (float): Maximum seconds a request waits for other requests.
+        max_workers (int): Number of batches running at the same time.
+    """
+
+    def __init__(self, run_batch: Callable, max_batch_size: int, max_delay: float,
+                 max_workers: int):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # (items, future, enqueue time) of the waiting requests
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.closed = False
+        self.num_batches = 0
+        self.num_items = 0
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, items: List) -> Future:
+        """Queue a request of 1 to `max_batch_size` items.
+
+        Returns:
+            Future: Resolved with the list of results of the items.
+        """
+        assert 1 <= len(items) <= self.max_batch_size, "Invalid number of items"
+        future = Future()
+        with self.condition:
+            self.queue.append((items, future, time.monotonic()))
+            self.condition.notify_all()
+        return future
+
+    def queued_items(self) -> int:
+        return sum(len(items) for items, _, _ in self.queue)
+
+    def loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.closed)
+                if self.closed:
+                    return
+                send_at = self.queue[0][2] + self.max_delay
+                while self.queued_items() < self.max_batch_size:
+                    remaining = send_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, size = [], 0
+                while self.queue and size + len(self.queue[0][0]) <= self.max_batch_size:
+                    batch.append(self.queue.popleft())
+                    size += len(batch[-1][0])
+            self.executor.submit(self.run, batch)
+
+    def run(self, batch: List):
+        with self.condition:
+            self.num_batches += 1
+            self.num_items += sum(len(items) for items, _, _ in batch)
+        try:
+            results = self.run_batch([item for items, _, _ in batch for item in items])
+        except BaseException as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        start = 0
+        for items, future, _ in batch:
+            future.set_result(results[start:start + len(items)])
+            start += len(items)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.executor.shutdown(wait=False)
+
+
+class Gateway:
+    """Run the workflow requests of many callers through one wrapper, so that they share
+    its upload cache, clients and tokens.
+
+    On top of the wrapper, the gateway caches results, runs concurrent identical requests
+    once, batches concurrent interactive and embedding requests of different callers into
+    tasks of up to `MAX_BATCH_SIZE` prompts, and limits the request rate of each caller.
+    With a `PriorityScheduler` on the wrapper, requests run in the priority class they
+    name, and only requests of the same class are batched together.
+
+    Args:
+        trex2 (TRex2APIWrapper): Wrapper running the requests, with an upload cache to
+            share uploads across callers.
+        result_cache_size (int): Number of results cached. Defaults to 1024, 0 disables
+            the cache.
+        requests_per_minute (float): Request rate of each caller. Defaults to None, which
+            is unlimited.
+        max_batch_delay (float): Seconds an interactive or embedding request waits for
+            other requests to batch with. Defaults to 0.02.
+        timeout (float): Deadline of every request in seconds. Defaults to None.
+        allow_local_files (bool): Accept paths of files on the gateway host as images.
+            Defaults to False, which only accepts urls and base64 encoded bytes.
+    """
+
+    def __init__(self,
+                 trex2,
+                 result_cache_size: int = 1024,
+                 requests_per_minute: float = None,
+                 max_batch_delay: float = 0.02,
+                 timeout: float = None,
+                 allow_local_files: bool = False):
+        self.trex2 = trex2
+        # the url cache is a plain LRU cache, here of results
+        self.result_cache = UploadCache(result_cache_size) if result_cache_size else None
+        self.requests_per_minute = requests_per_minute
+        self.timeout = timeout
+        self.allow_local_files = allow_local_files
+        # caller -> TokenBucket
+        self.buckets = {}
+        # request key -> Future of the request running for it
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        # one client pool per token with `MultiTokenAPIWrapper`
+        self.pools = [state.pool for state in getattr(trex2, "token_states", [])] or [trex2.pool]
+        max_workers = sum(pool.pool_size for pool in self.pools)
+        # None is the default class of the scheduler
+        priorities = [None] + list(trex2.scheduler.classes if trex2.scheduler else [])
+        # (workflow, priority) -> MicroBatcher, a batch runs as one call of one class
+        self.batchers = {(workflow, priority): MicroBatcher(
+            partial(self.call, workflow, priority=priority), MAX_BATCH_SIZE, max_batch_delay,
+            max_workers) for workflow in BATCHED_WORKFLOWS for priority in priorities}
+
+    def decode_image(self, image):
+        """Convert an image of a JSON request to an input of `get_image_url`: urls are kept,
+        base64 strings, either data urls or {"base64": ...}, are decoded to the encoded
+        bytes of the image or embedding, which are uploaded without decoding."""
+        if isinstance(image, dict) and set(image) == {"base64"}:
+            image = image["base64"]
+        elif isinstance(image, str) and image.startswith("data:"):
+            image = image.partition(",")[2]
+        elif is_url(image) or (self.allow_local_files and isinstance(image, str)):
+            return image
+        else:
+            raise PromptValidationError("Images must be urls, data urls or {\"base64\": ...}")
+        try:
+            return base64.b64decode(image, validate=True)
+        except (binascii.Error, TypeError) as e:
+            raise PromptValidationError(f"Invalid base64 image: {e}") from e
+
+    def count(self, name: str):
+        """Increment a counter of `stats`, from any thread."""
+        with self.lock:
+            self.counters[name] += 1
+
+    def check_rate(self, caller: str):
+        if self.requests_per_minute is None:
+            return
+        with self.lock:
+            bucket = self.buckets.get(caller)
+            if bucket is None:
+                bucket = self.buckets[caller] = TokenBucket(self.requests_per_minute / 60.0)
+        if not bucket.try_acquire():
+            self.count("rate_limited")
+            raise RateLimited(bucket.wait_time())
+
+    def check_priority(self, priority: str):
+        if priority is None:
+            return
+        if self.trex2.scheduler is None:
+            raise InvalidPriority("The gateway has no priority classes")
+        if priority not in self.trex2.scheduler.classes:
+            raise InvalidPriority(f"Unknown priority class {priority}, expected one of "
+                                  f"{', '.join(self.trex2.scheduler.classes)}")
+
+    def call(self, workflow: str, request, priority: str = None):
+        """Run a validated request with images resolved, in the priority class `priority`
+        and within the gateway timeout."""
+        _, _, run = WORKFLOWS[workflow]
+        with ExitStack() as stack:
+            if priority is not None:
+                stack.enter_context(self.trex2.bind_priority(priority))
+            if self.timeout is not None:
+                stack.enter_context(self.trex2.bind_deadline(Deadline(self.timeout)))
+            return run(self.trex2, request)
+
+    def run(self, workflow: str, request, priority: str = None):
+        if workflow in BATCHED_WORKFLOWS:
+            return self.batchers[workflow, priority].submit(request).result()
+        return self.call(workflow, request, priority)
+
+    def handle(self,
+               workflow: str,
+               body: Dict,
+               caller: str = "",
+               priority: str = None) -> Tuple[object, bool]:
+        """Run one request.
+
+        Args:
+            workflow (str): One of "interactive", "generic", "customize" or "embedding".
+            body (Dict): {"prompts": [...]} with the prompts of the workflow, plus
+                "target_image" for generic inference. Images are urls or base64 encoded
+                bytes.
+            caller (str): Name of the caller, for rate limiting. Defaults to "".
+            priority (str): Priority class of the request in the scheduler of the wrapper.
+                Defaults to None, which is the default class of the scheduler.
+
+        Returns:
+            Tuple[object, bool]: The result of the workflow method and True if it was
+                served from the cache or by an identical request running at the same time.
+
+        Raises:
+            UnknownWorkflow: If the workflow does not exist.
+            InvalidPriority: If the priority class does not exist.
+            RateLimited: If the caller exceeded its request rate.
+            PromptValidationError: If the request is malformed.
+        """
+        if workflow not in WORKFLOWS:
+            raise UnknownWorkflow(workflow)
+        self.check_priority(priority)
+        self.check_rate(caller)
+        self.count("requests")
+        if not isinstance(body, dict) or "prompts" not in body:
+            raise PromptValidationError("The request body must be an object with prompts")
+        request = body["prompts"]
+        if workflow == "generic":
+            if "target_image" not in body:
+                raise PromptValidationError("Generic requests need a target_image")
+            request = (body["target_image"], request)
+        validate, resolve, _ = WORKFLOWS[workflow]
+        # decode first, the validation reads the sizes of the images
+        try:
+            decoded = resolve(request, self.decode_image)
+        except (KeyError, TypeError, AttributeError):
+            # malformed request, the validation tells what is wrong
+            validate(request)
+            raise PromptValidationError("Malformed request")
+        request = validate(decoded)
+        # requests are identical when they have the same annotations and image contents
+        key = hashlib.sha1(
+            json.dumps([workflow, resolve(request, image_digest)], sort_keys=True,
+                       default=str).encode()).hexdigest()
+        if self.result_cache is not None:
+            result = self.result_cache.get(key)
+            if result is not None:
+                self.count("cache_hits")
+                return result, True
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+        if not owner:
+            self.count("deduplicated")
+            return future.result(), True
+        try:
+            result = self.run(workflow, request, priority)
+        except BaseException as e:
+            future.set_exception(e)
+            with self.lock:
+                del self.in_flight[key]
+            raise
+        # cache the result before the request leaves in_flight, so that an identical
+        # request arriving in between finds one or the other instead of running again
+        if self.result_cache is not None:
+            self.result_cache.put(key, result)
+        with self.lock:
+            del self.in_flight[key]
+        future.set_result(result)
+        return result, False
+
+    def stats(self) -> Dict:
+        """Counters of the gateway, its caches and its batches."""
+        upload_caches = [pool.upload_cache for pool in self.pools if pool.upload_cache]
+        with self.lock:
+            counters = dict(self.counters)
+            in_flight = len(self.in_flight)
+        return {
+            **counters,
+            "in_flight": in_flight,
+            "result_cache": (None if self.result_cache is None else {
+                "size": len(self.result_cache),
+                "hits": self.result_cache.hits,
+                "misses": self.result_cache.misses,
+            }),
+            "upload_cache": (None if not upload_caches else {
+                "size": sum(len(cache) for cache in upload_caches),
+                "hits": sum(cache.hits for cache in upload_caches),
+                "misses": sum(cache.misses for cache in upload_caches),
+            }),
+            "batches": {
+                workflow: {
+                    "batches": sum(batcher.num_batches for (name, _), batcher in
+                                   self.batchers.items() if name == workflow),
+                    "items": sum(batcher.num_items for (name, _), batcher in
+                                 self.batchers.items() if name == workflow),
+                } for workflow in BATCHED_WORKFLOWS
+            },
+            "scheduler": (None if self.trex2.scheduler is None else
+                          self.trex2.scheduler.stats()),
+        }
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    """HTTP front of a `Gateway`:
+        POST /v1/<workflow>    JSON body, see `Gateway.handle`, returns
+                               {"result": ..., "cached": bool}
+        GET  /v1/stats         counters of the gateway
+        GET  /healthz          liveness probe
+    Callers are identified by their X-Client-Id header, or their address. The X-Priority
+    header names the priority class of the request, see `Gateway.handle`.
+    """
+
+    gateway: Gateway = None
+    max_body_bytes = 64 << 20
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status: int, payload, headers: Dict = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/v1/stats":
+            self.send_json(200, self.gateway.stats())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            # without a length the end of the body is unknown
+            self.close_connection = True
+            self.send_json(411, {"error": "Content-Length required"})
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_json(400, {"error": "Invalid Content-Length"})
+            return
+        if length > self.max_body_bytes:
+            self.close_connection = True
+            self.send_json(413, {"error": "Request body too large"})
+            return
+        body = self.rfile.read(length)
+        prefix, _, workflow = self.path.partition("/v1/")
+        caller = self.headers.get("X-Client-Id") or self.client_address[0]
+        priority = self.headers.get("X-Priority")
+        try:
+            if prefix or workflow not in WORKFLOWS:
+                raise UnknownWorkflow(workflow)
+            result, cached = self.gateway.handle(workflow, json.loads(body), caller, priority)
+        except UnknownWorkflow:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+        except RateLimited as e:
+            self.send_json(429, {"error": str(e)}, {"Retry-After": str(int(e.retry_after) + 1)})
+        except (json.JSONDecodeError, PromptValidationError, InvalidPriority) as e:
+            self.send_json(400, {"error": str(e)})
+        except DeadlineExceeded as e:
+            self.send_json(504, {"error": str(e)})
+        except Exception as e:
+            self.send_json(502, {"error": f"{type(e).__name__}: {e}"})
+        else:
+            self.send_json(200, {"result": result, "cached": cached})
+
+    def log_message(self, format, *args):
+        # one line per request is too verbose for a gateway, errors are returned to the
+        # callers
+        pass
+
+
+def make_server(gateway: Gateway, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """Create the HTTP server of a gateway, one thread per connection. Start it with
+    `serve_forever`."""
+    handler = type("BoundGatewayHandler", (GatewayHandler, ), {"gateway": gateway})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--token",
+                        type=str,
+                        action="append",
+                        required=True,
+                        help="T-Rex2 API token, repeat to balance the load over several "
+                        "tokens")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--tasks_per_minute",
+                        type=float,
+                        default=None,
+                        help="rate budget of each token, unlimited by default")
+    parser.add_argument("--requests_per_minute",
+                        type=float,
+                        default=None,
+                        help="request rate of each caller, unlimited by default")
+    parser.add_argument("--pool_size",
+                        type=int,
+                        default=16,
+                        help="number of requests running at the same time per token")
+    parser.add_argument("--upload_cache_size", type=int, default=4096)
+    parser.add_argument("--result_cache_size", type=int, default=1024)
+    parser.add_argument("--max_batch_delay",
+                        type=float,
+                        default=0.02,
+                        help="seconds a request waits for others to batch with")
+    parser.add_argument("--timeout", type=float, default=None, help="timeout of each request")
+    parser.add_argument("--max_concurrency",
+                        type=int,
+                        default=None,
+                        help="admit at most this many requests at a time by the priority "
+                        "class of their X-Priority header, \"interactive\" or \"bulk\" (the "
+                        "default), disabled by default")
+    parser.add_argument("--allow_local_files",
+                        action="store_true",
+                        help="accept paths of files on this host as images")
+
+
+def serve(args: argparse.Namespace):
+    trex2 = MultiTokenAPIWrapper(args.token,
+                                 tasks_per_minute=[args.tasks_per_minute] * len(args.token),
+                                 pool_size=args.pool_size,
+                                 upload_cache_size=args.upload_cache_size,
+                                 scheduler=(None if args.max_concurrency is None else
+                                            PriorityScheduler(args.max_concurrency)))
+    gateway = Gateway(trex2,
+                      result_cache_size=args.result_cache_size,
+                      requests_per_minute=args.requests_per_minute,
+                      max_batch_delay=args.max_batch_delay,
+                      timeout=args.timeout,
+                      allow_local_files=args.allow_local_files)
+    server = make_server(gateway, args.host, args.port)
+    print(f"T-Rex2 gateway listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        gateway.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve T-Rex2 workflows over HTTP")
+    add_arguments(parser)
+    serve(parser.parse_args())
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Tuple, Union
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """Lazily split an iterable into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def item_result(future, return_exceptions: bool):
+    """Result of a done future, or its exception with `return_exceptions`."""
+    error = future.exception()
+    if return_exceptions and isinstance(error, Exception):
+        return error
+    return future.result()
+
+
+def imap_unordered(func: Callable,
+                   iterable: Iterable,
+                   max_workers: int = 4,
+                   max_in_flight: int = None,
+                   return_exceptions: bool = False) -> Iterator[Tuple[int, object]]:
+    """Apply `func` to every item of `iterable` in a thread pool and yield the results as
+    soon as they are ready. At most `max_in_flight` items are pending at any time, so the
+    iterable is consumed lazily and memory stays bounded for unbounded inputs.
+
+    By default the first item whose `func` raises stops the stream: the error is raised
+    to the consumer and the pending items are cancelled.
+
+    Args:
+        func (Callable): Function applied to each item.
+        iterable (Iterable): Input items.
+        max_workers (int): Number of worker threads. Defaults to 4.
+        max_in_flight (int): Maximum number of submitted but not yet yielded items.
+            Defaults to 2 * max_workers.
+        return_exceptions (bool): Yield the exception raised by `func` as the result of
+            its item and go on with the next items. Defaults to False.
+
+    Yields:
+        Tuple[int, object]: (input_index, func(item)) in completion order.
+    """
+    max_in_flight = max(max_in_flight or 2 * max_workers, 1)
+    items = enumerate(iterable)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    try:
+        for index, item in itertools.islice(items, max_in_flight):
+            pending[executor.submit(func, item)] = index
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                yield index, item_result(future, return_exceptions)
+            # refill the freed slots
+            for index, item in itertools.islice(items, len(done)):
+                pending[executor.submit(func, item)] = index
+    finally:
+        # stop the remaining work if the consumer stops early or an error is raised
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def batch_errors(func: Callable, return_exceptions: bool) -> Callable:
+    """Wrap a batched `func` to return its exception once per item with
+    `return_exceptions`."""
+    if not return_exceptions:
+        return func
+
+    def run(batch):
+        try:
+            return func(batch)
+        except Exception as e:
+            return [e] * len(batch)
+
+    return run
+
+
+def imap_batched(func: Callable,
+                 iterable: Iterable,
+                 batch_size: int,
+                 max_workers: int = 4,
+                 max_in_flight: int = None,
+                 return_exceptions: bool = False) -> Iterator[Tuple[int, object]]:
+    """Same as `imap_unordered` but `func` takes a list of at most `batch_size` items and
+    returns one result per item. Results are flattened back to per item results, with
+    `return_exceptions` the error of a batch is the result of each of its items.
+
+    Yields:
+        Tuple[int, object]: (input_index, result) in completion order.
+    """
+    batches = chunked(iterable, batch_size)
+    for batch_index, results in imap_unordered(batch_errors(func, return_exceptions),
+                                               batches, max_workers, max_in_flight):
+        for i, result in enumerate(results):
+            yield batch_index * batch_size + i, result
+
+
+async def _aiterate(iterable: Union[Iterable, AsyncIterator]) -> AsyncIterator:
+    if hasattr(iterable, "__aiter__"):
+        async for item in iterable:
+            yield item
+    elif isinstance(iterable, (list, tuple)):
+        for item in iterable:
+            yield item
+    else:
+        # lazy iterables may block, e.g. generators reading files, advance them in a
+        # thread so the event loop is never blocked
+        loop = asyncio.get_running_loop()
+        iterator = iter(iterable)
+        done = object()
+        while True:
+            item = await loop.run_in_executor(None, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+
+async def aimap_unordered(func: Callable,
+                          iterable: Union[Iterable, AsyncIterator],
+                          max_workers: int = 4,
+                          max_in_flight: int = None,
+                          return_exceptions: bool = False) -> AsyncIterator[Tuple[int, object]]:
+    """Async version of `imap_unordered`. The blocking `func` runs in a thread pool so the
+    event loop is never blocked, and `iterable` can be a sync or an async iterable, whose
+    items are pulled in a thread as well.
+
+    Yields:
+        Tuple[int, object]: (input_index, func(item)) in completion order.
+    """
+    loop = asyncio.get_running_loop()
+    max_in_flight = max(max_in_flight or 2 * max_workers, 1)
+    items = _aiterate(iterable)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    next_index = 0
+    exhausted = False
+
+    async def fill(num_slots):
+        nonlocal next_index, exhausted
+        while num_slots > 0 and not exhausted:
+            try:
+                item = await items.__anext__()
+            except StopAsyncIteration:
+                exhausted = True
+                break
+            pending[loop.run_in_executor(executor, func, item)] = next_index
+            next_index += 1
+            num_slots -= 1
+
+    try:
+        await fill(max_in_flight)
+        while pending:
+            done, _ = await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                yield index, item_result(future, return_exceptions)
+            await fill(len(done))
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+async def aimap_batched(func: Callable,
+                        iterable: Union[Iterable, AsyncIterator],
+                        batch_size: int,
+                        max_workers: int = 4,
+                        max_in_flight: int = None,
+                        return_exceptions: bool = False) -> AsyncIterator[Tuple[int, object]]:
+    """Async version of `imap_batched`.
+
+    Yields:
+        Tuple[int, object]: (input_index, result) in completion order.
+    """
+
+    async def batches():
+        batch = []
+        async for item in _aiterate(iterable):
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async for batch_index, results in aimap_unordered(batch_errors(func, return_exceptions),
+                                                      batches(), max_workers, max_in_flight):
+        for i, result in enumerate(results):
+            yield batch_index * batch_size + i, result
@@ -0,0 +1,382 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .box_ops import box_iou, cxcywh_to_xyxy, xyxy_to_cxcywh
+from .image import ImageHandle
+
+
+class KalmanBoxFilter:
+    """Constant velocity Kalman filter on boxes, vectorized over all the tracks.
+
+    The state of a track is [cx, cy, w, h, vcx, vcy, vw, vh] and the measurement is the
+    box in [cx, cy, w, h] format. Noise is proportional to the box size.
+
+    Args:
+        std_position (float): Position noise relative to the box size. Defaults to 1/20.
+        std_velocity (float): Velocity noise relative to the box size. Defaults to 1/160.
+    """
+
+    def __init__(self, std_position: float = 1 / 20, std_velocity: float = 1 / 160):
+        self.std_position = std_position
+        self.std_velocity = std_velocity
+        self.motion = np.eye(8, dtype=np.float32)
+        self.motion[:4, 4:] = np.eye(4)
+        self.observation = np.eye(4, 8, dtype=np.float32)
+
+    def box_scale(self, means: np.ndarray) -> np.ndarray:
+        # (N, 4) scale of each state dimension, w for x and h for y
+        wh = np.maximum(means[:, 2:4], 1.0)
+        return np.concatenate([wh, wh], axis=1)
+
+    def initiate(self, boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Create the states of new tracks from boxes in shape (N, 4), xyxy format."""
+        measurements = xyxy_to_cxcywh(boxes).reshape(-1, 4)
+        means = np.concatenate([measurements, np.zeros_like(measurements)], axis=1)
+        scale = self.box_scale(means)
+        std = np.concatenate([2 * self.std_position * scale, 10 * self.std_velocity * scale],
+                             axis=1)
+        covariances = np.zeros((len(means), 8, 8), dtype=np.float32)
+        covariances[:, np.arange(8), np.arange(8)] = std**2
+        return means, covariances
+
+    def predict(self, means: np.ndarray,
+                covariances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Advance the states of all the tracks by one frame."""
+        scale = self.box_scale(means)
+        std = np.concatenate([self.std_position * scale, self.std_velocity * scale], axis=1)
+        means = means @ self.motion.T
+        covariances = self.motion @ covariances @ self.motion.T
+        covariances[:, np.arange(8), np.arange(8)] += std**2
+        # width and height can not be negative
+        means[:, 2:4] = np.maximum(means[:, 2:4], 1.0)
+        return means, covariances
+
+    def update(self, means: np.ndarray, covariances: np.ndarray,
+               boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Correct the states of tracks with their matched boxes in shape (N, 4), xyxy."""
+        measurements = xyxy_to_cxcywh(boxes).reshape(-1, 4)
+        scale = self.box_scale(means)[:, :4]
+        projected_cov = self.observation @ covariances @ self.observation.T
+        projected_cov[:, np.arange(4), np.arange(4)] += (self.std_position * scale)**2
+        # Kalman gain K = P H^T S^-1, in shape (N, 8, 4)
+        gain = np.linalg.solve(projected_cov, self.observation @ covariances).transpose(0, 2, 1)
+        innovation = measurements - means[:, :4]
+        means = means + (gain @ innovation[:, :, None])[:, :, 0]
+        covariances = covariances - gain @ projected_cov @ gain.transpose(0, 2, 1)
+        return means, covariances
+
+
+class IoUTracker:
+    """Greedy IoU tracker with Kalman motion prediction and stable track ids.
+
+    On every frame `predict` propagates the tracks with the Kalman filter. On frames with
+    detections `update` matches them to the predicted tracks by IoU, corrects the matched
+    tracks, starts new tracks for the unmatched detections and drops tracks that were
+    missed too many times.
+
+    Args:
+        iou_threshold (float): Minimum IoU to match a detection with a track. Defaults
+            to 0.3.
+        max_misses (int): Number of consecutive updates a track can be missed before it
+            is dropped. Defaults to 1.
+        confidence_decay (float): Decay of the track confidence per predicted frame.
+            Defaults to 0.97.
+        match_labels (bool): Only match detections and tracks of the same label. Defaults
+            to True.
+    """
+
+    def __init__(self,
+                 iou_threshold: float = 0.3,
+                 max_misses: int = 1,
+                 confidence_decay: float = 0.97,
+                 match_labels: bool = True):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.confidence_decay = confidence_decay
+        self.match_labels = match_labels
+        self.kalman = KalmanBoxFilter()
+        self.means = np.zeros((0, 8), dtype=np.float32)
+        self.covariances = np.zeros((0, 8, 8), dtype=np.float32)
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.track_ids = np.zeros(0, dtype=np.int64)
+        # frames since the last update and number of consecutive missed updates
+        self.ages = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+        # fraction of each predicted box inside the image
+        self.visibility = np.zeros(0, dtype=np.float32)
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def boxes(self) -> np.ndarray:
+        """Current boxes of the tracks in shape (N, 4), xyxy format."""
+        return cxcywh_to_xyxy(self.means[:, :4])
+
+    @property
+    def confidences(self) -> np.ndarray:
+        """Confidence of each track, its score decayed by the frames since its last update
+        and by the fraction of its box that left the image."""
+        return self.scores * self.confidence_decay**self.ages * self.visibility
+
+    def predict(self, image_size: Tuple[int, int] = None) -> Dict:
+        """Propagate the tracks to the next frame.
+
+        Args:
+            image_size (Tuple[int, int]): (width, height) of the frame, used to lower the
+                confidence of tracks leaving the image. Defaults to None.
+
+        Returns:
+            Dict: The current tracks, see `results`.
+        """
+        if len(self):
+            self.means, self.covariances = self.kalman.predict(self.means, self.covariances)
+            self.ages += 1
+            self.visibility = self.inside_fraction(image_size)
+        return self.results()
+
+    def update(self, boxes: np.ndarray, scores: np.ndarray, labels: np.ndarray,
+               image_size: Tuple[int, int] = None) -> Dict:
+        """Match detections of the current frame with the tracks.
+
+        Args:
+            boxes (np.ndarray): Detected boxes in shape (N, 4), xyxy format.
+            scores (np.ndarray): Scores of the detections in shape (N).
+            labels (np.ndarray): Labels of the detections in shape (N).
+            image_size (Tuple[int, int]): (width, height) of the frame. Defaults to None.
+
+        Returns:
+            Dict: The current tracks, see `results`.
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        track_indices, det_indices = self.match(boxes, labels)
+
+        # correct matched tracks
+        if len(track_indices):
+            self.means[track_indices], self.covariances[track_indices] = self.kalman.update(
+                self.means[track_indices], self.covariances[track_indices],
+                boxes[det_indices])
+            self.scores[track_indices] = scores[det_indices]
+            self.ages[track_indices] = 0
+            self.misses[track_indices] = 0
+        # drop tracks missed too many times
+        missed = np.ones(len(self), dtype=bool)
+        missed[track_indices] = False
+        self.misses[missed] += 1
+        self.keep(self.misses <= self.max_misses)
+        # start new tracks for unmatched detections
+        unmatched = np.ones(len(boxes), dtype=bool)
+        unmatched[det_indices] = False
+        if unmatched.any():
+            means, covariances = self.kalman.initiate(boxes[unmatched])
+            num_new = len(means)
+            self.means = np.concatenate([self.means, means])
+            self.covariances = np.concatenate([self.covariances, covariances])
+            self.scores = np.concatenate([self.scores, scores[unmatched]])
+            self.labels = np.concatenate([self.labels, labels[unmatched]])
+            self.track_ids = np.concatenate(
+                [self.track_ids, np.arange(self.next_id, self.next_id + num_new)])
+            self.ages = np.concatenate([self.ages, np.zeros(num_new, dtype=np.int64)])
+            self.misses = np.concatenate([self.misses, np.zeros(num_new, dtype=np.int64)])
+            self.next_id += num_new
+        self.visibility = self.inside_fraction(image_size)
+        return self.results()
+
+    def match(self, boxes: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Greedily match tracks and detections by decreasing IoU.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Indices of the matched tracks and detections.
+        """
+        if len(self) == 0 or len(boxes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        ious = box_iou(self.boxes, boxes)
+        if self.match_labels:
+            ious[self.labels[:, None] != labels[None, :]] = 0
+        rows, cols = np.nonzero(ious >= self.iou_threshold)
+        order = np.argsort(-ious[rows, cols], kind="stable")
+        used_rows, used_cols = set(), set()
+        track_indices, det_indices = [], []
+        for row, col in zip(rows[order], cols[order]):
+            if row in used_rows or col in used_cols:
+                continue
+            used_rows.add(row)
+            used_cols.add(col)
+            track_indices.append(row)
+            det_indices.append(col)
+        return np.array(track_indices, dtype=np.int64), np.array(det_indices, dtype=np.int64)
+
+    def keep(self, mask: np.ndarray):
+        for name in ("means", "covariances", "scores", "labels", "track_ids", "ages",
+                     "misses", "visibility"):
+            setattr(self, name, getattr(self, name)[mask])
+
+    def inside_fraction(self, image_size: Tuple[int, int] = None) -> np.ndarray:
+        if image_size is None:
+            return np.ones(len(self), dtype=np.float32)
+        width, height = image_size
+        boxes = self.boxes
+        inside = np.stack([
+            np.clip(boxes[:, 0], 0, width),
+            np.clip(boxes[:, 1], 0, height),
+            np.clip(boxes[:, 2], 0, width),
+            np.clip(boxes[:, 3], 0, height),
+        ], axis=1)
+        area = np.prod(np.maximum(boxes[:, 2:] - boxes[:, :2], 1e-6), axis=1)
+        inside_area = np.prod(np.maximum(inside[:, 2:] - inside[:, :2], 0), axis=1)
+        return (inside_area / area).astype(np.float32)
+
+    def results(self) -> Dict:
+        """Return the current tracks in format:
+            {
+                "boxes": (np.ndarray): Boxes in shape (N, 4), xyxy format.
+                "scores": (np.ndarray): Confidence of each track in shape (N).
+                "labels": (np.ndarray): Label of each track in shape (N).
+                "track_ids": (np.ndarray): Stable id of each track in shape (N).
+            }
+        """
+        return {
+            "boxes": self.boxes,
+            "scores": self.confidences,
+            "labels": self.labels.copy(),
+            "track_ids": self.track_ids.copy(),
+        }
+
+
+def get_image_size(image) -> Tuple[int, int]:
+    """Return the (width, height) of a PIL image, an array in HWC format or an ImageHandle,
+    None for other inputs such as file paths."""
+    if isinstance(image, ImageHandle):
+        return image.size
+    if isinstance(image, Image.Image):
+        return image.size
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return None
+
+
+class KeyframeVideoDetector:
+    """Detect objects in a video calling the API only on keyframes.
+
+    A frame is a keyframe every `keyframe_interval` frames, or earlier when the mean
+    confidence of the tracks drops below `min_confidence`. On keyframes `infer_fn` is
+    called and its detections update an `IoUTracker`, between keyframes the tracker
+    propagates the last detections, so every frame gets boxes with stable track ids.
+
+    Args:
+        infer_fn (Callable): Function taking a frame and returning one result of the
+            wrapper, e.g. `embedding_infer_fn(trex2, prompts)`.
+        keyframe_interval (int): Maximum number of frames between two keyframes.
+            Defaults to 15.
+        min_confidence (float): Run a keyframe when the mean track confidence is lower.
+            Defaults to 0.3.
+        score_threshold (float): Detections with lower scores are ignored. Defaults to 0.3.
+        tracker (IoUTracker): Tracker to use. Defaults to None, which creates an
+            `IoUTracker` with default arguments.
+    """
+
+    def __init__(self,
+                 infer_fn: Callable,
+                 keyframe_interval: int = 15,
+                 min_confidence: float = 0.3,
+                 score_threshold: float = 0.3,
+                 tracker: IoUTracker = None):
+        assert keyframe_interval > 0, "Keyframe interval must be positive"
+        self.infer_fn = infer_fn
+        self.keyframe_interval = keyframe_interval
+        self.min_confidence = min_confidence
+        self.score_threshold = score_threshold
+        self.tracker = tracker or IoUTracker()
+        self.num_frames = 0
+        self.num_keyframes = 0
+        self.last_keyframe = None
+
+    @property
+    def keyframe_rate(self) -> float:
+        """Fraction of the frames on which the API was called."""
+        return self.num_keyframes / max(self.num_frames, 1)
+
+    def is_keyframe(self) -> bool:
+        if self.last_keyframe is None:
+            return True
+        if self.num_frames - self.last_keyframe >= self.keyframe_interval:
+            return True
+        confidences = self.tracker.confidences
+        return len(confidences) > 0 and confidences.mean() < self.min_confidence
+
+    def step(self, frame) -> Dict:
+        """Process the next frame of the video.
+
+        Args:
+            frame: The frame, anything accepted by `infer_fn`. Arrays and PIL images also
+                let the tracker lower the confidence of tracks leaving the frame.
+
+        Returns:
+            Dict: The tracks on the frame, see `IoUTracker.results`, plus "keyframe" (bool)
+                telling if the API was called on this frame.
+        """
+        image_size = get_image_size(frame)
+        self.tracker.predict(image_size)
+        keyframe = self.is_keyframe()
+        if keyframe:
+            result = self.infer_fn(frame)
+            scores = np.asarray(result["scores"], dtype=np.float32).reshape(-1)
+            mask = scores > self.score_threshold
+            results = self.tracker.update(
+                np.asarray(result["boxes"], dtype=np.float32).reshape(-1, 4)[mask],
+                scores[mask],
+                np.asarray(result["labels"], dtype=np.int64).reshape(-1)[mask],
+                image_size,
+            )
+            self.num_keyframes += 1
+            self.last_keyframe = self.num_frames
+        else:
+            results = self.tracker.results()
+        self.num_frames += 1
+        results["keyframe"] = keyframe
+        return results
+
+    def process(self, frames: Iterable) -> Iterator[Dict]:
+        """Process the frames of a video lazily, yielding the result of every frame."""
+        for frame in frames:
+            yield self.step(frame)
+
+
+def embedding_infer_fn(trex2, prompts: List[dict]) -> Callable:
+    """Build an `infer_fn` for `KeyframeVideoDetector` running embedding inference.
+
+    Args:
+        trex2 (TRex2APIWrapper): The API wrapper.
+        prompts (List[dict]): Embedding prompts of one image, i.e. the "prompts" entry of
+            `embedding_inference`, e.g. [{"category_id": 1, "embd": "cate1.safetensors"}].
+    """
+    return lambda frame: trex2.embedding_inference([{"image": frame, "prompts": prompts}])[0]
+
+
+def generic_infer_fn(trex2, prompts: List[dict]) -> Callable:
+    """Build an `infer_fn` running generic inference with fixed prompts on every image.
+
+    Args:
+        trex2 (TRex2APIWrapper): The API wrapper.
+        prompts (List[dict]): Generic prompts, same format as in `generic_inference`. Use
+            an upload cache, or urls, so the prompt images are uploaded only once.
+    """
+    return lambda frame: trex2.generic_inference(frame, prompts)
+
+
+def interactive_infer_fn(trex2, prompts: dict) -> Callable:
+    """Build an `infer_fn` for `KeyframeVideoDetector` running interactive inference with
+    fixed visual prompts on every keyframe, e.g. for a static camera.
+
+    Args:
+        trex2 (TRex2APIWrapper): The API wrapper.
+        prompts (dict): Interactive prompts of one image without "prompt_image", i.e.
+            {"type": "rect", "prompts": [{"category_id": 1, "rects": [[...]]}]}.
+    """
+    return lambda frame: trex2.interactve_inference([dict(prompts, prompt_image=frame)])[0]
@@ -3,6 +3,8 @@ from typing import Dict
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
+from .image import ImageHandle
+
 
 def visualize(image_pil: Image,
               target: Dict,
@@ -16,7 +18,8 @@ def visualize(image_pil: Image,
     """Plot bounding boxes and labels on an image.
 
     Args:
-        image_pil (PIL.Image): The input image as a PIL Image object.
+        image_pil (PIL.Image): The input image as a PIL Image object, or an ImageHandle
+            which is drawn on a copy of its pixels.
         model_targetoutput (Dict[str, Union[torch.Tensor, List[torch.Tensor]]]): The target dictionary containing
             the bounding boxes and labels. The keys are:
                 - boxes (List[int]): A list of bounding boxes in shape (N, 4), [x1, y1, x2, y2] format.
@@ -32,6 +35,8 @@ def visualize(image_pil: Image,
     Returns:
         Union[PIL.Image, PIL.Image]: A tuple containing the input image and ploted image.
     """
+    if isinstance(image_pil, ImageHandle):
+        image_pil = image_pil.to_pil()
     # Get the bounding boxes and labels from the target dictionary
     boxes = target["boxes"]
     scores = target["scores"]
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .multi_token import MultiTokenAPIWrapper
+from .pipeline import WORKFLOWS
+from .prompts import PromptValidationError
+from .workqueue import WorkQueue
+
+
+class Worker:
+    """Run the requests of a `WorkQueue` with a wrapper. Start one worker per process on
+    as many machines as needed, they share the queue and an item is only claimed again
+    once the lease of its previous worker expired.
+
+    Args:
+        queue (WorkQueue): The queue to claim items from.
+        trex2 (TRex2APIWrapper): Wrapper running the requests, e.g. a
+            `MultiTokenAPIWrapper` to spread the load over several tokens.
+        workflow (str): One of "interactive", "generic", "customize" or "embedding". Item
+            payloads are the arguments of the workflow method, see
+            `PipelinedExecutor.map`, with images as paths or urls.
+        owner (str): Unique name of the worker. Defaults to None, which uses the host name,
+            the process id and a random suffix.
+        max_workers (int): Number of items running at the same time. Defaults to 4.
+        poll_interval (float): Seconds between two claims while the queue has no pending
+            item. Defaults to 5.
+    """
+
+    def __init__(self,
+                 queue: WorkQueue,
+                 trex2,
+                 workflow: str,
+                 owner: str = None,
+                 max_workers: int = 4,
+                 poll_interval: float = 5.0):
+        assert workflow in WORKFLOWS, f"Invalid workflow {workflow}"
+        self.queue = queue
+        self.trex2 = trex2
+        self.workflow = workflow
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.num_done = 0
+        self.num_failed = 0
+
+    def run_item(self, payload):
+        validate, _, run = WORKFLOWS[self.workflow]
+        if self.workflow == "generic":
+            payload = tuple(payload)
+        return run(self.trex2, validate(payload))
+
+    def run(self, exit_when_empty: bool = True, max_items: int = None) -> int:
+        """Claim and run items until the queue is finished.
+
+        Args:
+            exit_when_empty (bool): Return when no item is pending or leased, otherwise
+                keep polling for new items. Defaults to True.
+            max_items (int): Return after claiming this many items. Defaults to None.
+
+        Returns:
+            int: Number of results committed by this worker.
+        """
+        heartbeat_interval = self.queue.lease_seconds / 3
+        last_heartbeat = time.monotonic()
+        num_claimed = 0
+        # future -> item id
+        in_flight = {}
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            while True:
+                free = self.max_workers - len(in_flight)
+                if max_items is not None:
+                    free = min(free, max_items - num_claimed)
+                if free > 0:
+                    for item_id, payload in self.queue.claim(self.owner, free):
+                        in_flight[executor.submit(self.run_item, payload)] = item_id
+                        num_claimed += 1
+                if not in_flight:
+                    if max_items is not None and num_claimed >= max_items:
+                        break
+                    if exit_when_empty and self.queue.is_finished():
+                        break
+                    # other workers hold the remaining items, or new items may come
+                    time.sleep(self.poll_interval)
+                    continue
+                done, _ = wait(in_flight, timeout=heartbeat_interval,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.commit(in_flight.pop(future), future)
+                if in_flight and time.monotonic() - last_heartbeat >= heartbeat_interval:
+                    # items requeued in the meantime keep running, the first result of an
+                    # item wins anyway
+                    self.queue.heartbeat(self.owner, in_flight.values())
+                    last_heartbeat = time.monotonic()
+        return self.num_done
+
+    def commit(self, item_id: int, future):
+        error = future.exception()
+        if error is None:
+            if self.queue.complete(item_id, future.result()):
+                self.num_done += 1
+            return
+        self.num_failed += 1
+        # malformed requests fail the same way every time
+        retry = not isinstance(error, PromptValidationError)
+        self.queue.fail(item_id, self.owner, f"{type(error).__name__}: {error}", retry)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Run T-Rex2 requests from a work queue")
+    parser.add_argument("queue", type=str, help="Path of the queue database")
+    parser.add_argument("--workflow",
+                        type=str,
+                        required=True,
+                        choices=sorted(WORKFLOWS),
+                        help="Workflow of the requests of the queue")
+    parser.add_argument("--token",
+                        type=str,
+                        action="append",
+                        required=True,
+                        help="T-Rex2 API token, repeat to balance the load over several "
+                        "tokens")
+    parser.add_argument("--tasks_per_minute",
+                        type=float,
+                        default=None,
+                        help="rate budget of each token, unlimited by default")
+    parser.add_argument("--max_workers",
+                        type=int,
+                        default=4,
+                        help="number of requests running at the same time")
+    parser.add_argument("--lease_seconds", type=float, default=60.0)
+    parser.add_argument("--max_attempts", type=int, default=3)
+    parser.add_argument("--upload_cache_size", type=int, default=1024)
+    parser.add_argument("--no_wal",
+                        action="store_true",
+                        help="disable write-ahead logging, needed on network filesystems")
+    parser.add_argument("--keep_running",
+                        action="store_true",
+                        help="keep polling for new items when the queue is finished")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    queue = WorkQueue(args.queue, args.lease_seconds, args.max_attempts, wal=not args.no_wal)
+    trex2 = MultiTokenAPIWrapper(args.token,
+                                 tasks_per_minute=[args.tasks_per_minute] * len(args.token),
+                                 pool_size=args.max_workers,
+                                 upload_cache_size=args.upload_cache_size)
+    worker = Worker(queue, trex2, args.workflow, max_workers=args.max_workers)
+    start = time.monotonic()
+    worker.run(exit_when_empty=not args.keep_running)
+    print(
+        json.dumps({
+            "owner": worker.owner,
+            "done": worker.num_done,
+            "failed": worker.num_failed,
+            "seconds": round(time.monotonic() - start, 1),
+            "queue": queue.counts(),
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, id);
+"""
+
+STATUSES = ("pending", "leased", "done", "failed")
+
+
+class WorkQueue:
+    """Work queue in a SQLite database shared by workers on one or several machines,
+    without any external service.
+
+    Workers claim items with a lease which they extend with heartbeats. Items whose lease
+    expires, e.g. because their worker died, go back to pending and are claimed again, up
+    to `max_attempts` times. Result commits are idempotent: the first result of an item
+    is kept and later commits of the same item, e.g. from a worker whose lease expired,
+    are ignored. Leases use the wall clock, so the clocks of the machines must be roughly
+    synchronized.
+
+    Args:
+        path (str): Path of the database, created if it does not exist.
+        lease_seconds (float): Duration of a lease, renewed by heartbeats. Defaults to 60.
+        max_attempts (int): Number of claims of an item before it is marked failed.
+            Defaults to 3.
+        wal (bool): Use write-ahead logging, faster but only for databases on a local
+            disk. Set to False for a database on a network filesystem. Defaults to True.
+    """
+
+    def __init__(self,
+                 path: str,
+                 lease_seconds: float = 60.0,
+                 max_attempts: int = 3,
+                 wal: bool = True):
+        assert lease_seconds > 0, "Lease duration must be positive"
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.wal = wal
+        # sqlite connections can not be shared between threads
+        self.local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+            db.execute(f"PRAGMA journal_mode={'WAL' if self.wal else 'DELETE'}")
+            self.local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction taking the database lock right away, so concurrent claims
+        never hand out the same item."""
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def add(self, payloads: Iterable, keys: Iterable[str] = None) -> int:
+        """Add items to the queue. Items with a key already in the queue are skipped, so
+        a job can be enqueued again safely.
+
+        Args:
+            payloads (Iterable): JSON serializable payloads, e.g. workflow requests.
+            keys (Iterable[str]): Unique key of each item, e.g. the image path. Defaults to
+                None, which never skips items.
+
+        Returns:
+            int: Number of items added.
+        """
+        payloads = [json.dumps(payload) for payload in payloads]
+        keys = list(keys) if keys is not None else [None] * len(payloads)
+        assert len(keys) == len(payloads), "There must be one key per payload"
+        now = time.time()
+        with self.transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO items (key, payload, updated) VALUES (?, ?, ?)",
+                [(key, payload, now) for key, payload in zip(keys, payloads)])
+            return db.total_changes - before
+
+    def requeue_expired(self, db: sqlite3.Connection, now: float):
+        """Return the items whose lease expired to pending, or fail them if they were
+        claimed `max_attempts` times."""
+        db.execute(
+            "UPDATE items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+            " owner = NULL, lease_expires = NULL, updated = ?,"
+            " error = COALESCE(error, 'lease expired')"
+            " WHERE status = 'leased' AND lease_expires < ?", (self.max_attempts, now, now))
+
+    def claim(self, owner: str, limit: int = 1) -> List[Tuple[int, object]]:
+        """Lease up to `limit` pending items.
+
+        Args:
+            owner (str): Unique name of the worker, e.g. "host:pid".
+            limit (int): Maximum number of items. Defaults to 1.
+
+        Returns:
+            List[Tuple[int, object]]: (item_id, payload) of the claimed items.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            self.requeue_expired(db, now)
+            rows = db.execute(
+                "SELECT id, payload FROM items WHERE status = 'pending' ORDER BY id LIMIT ?",
+                (limit, )).fetchall()
+            db.executemany(
+                "UPDATE items SET status = 'leased', owner = ?, lease_expires = ?,"
+                " attempts = attempts + 1, updated = ? WHERE id = ?",
+                [(owner, now + self.lease_seconds, now, item_id) for item_id, _ in rows])
+        return [(item_id, json.loads(payload)) for item_id, payload in rows]
+
+    def heartbeat(self, owner: str, item_ids: Iterable[int]) -> List[int]:
+        """Extend the leases of items held by `owner`.
+
+        Returns:
+            List[int]: The ids of the items still leased by `owner`, the others were
+                requeued and should be abandoned.
+        """
+        item_ids = list(item_ids)
+        if not item_ids:
+            return []
+        now = time.time()
+        placeholders = ",".join("?" * len(item_ids))
+        with self.transaction() as db:
+            db.execute(
+                f"UPDATE items SET lease_expires = ?, updated = ? WHERE status = 'leased'"
+                f" AND owner = ? AND id IN ({placeholders})",
+                [now + self.lease_seconds, now, owner] + item_ids)
+            rows = db.execute(
+                f"SELECT id FROM items WHERE status = 'leased' AND owner = ?"
+                f" AND id IN ({placeholders})", [owner] + item_ids).fetchall()
+        return [item_id for item_id, in rows]
+
+    def complete(self, item_id: int, result) -> bool:
+        """Commit the result of an item, idempotent.
+
+        Returns:
+            bool: True if the result was stored, False if the item already had one.
+        """
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE items SET status = 'done', result = ?, error = NULL, owner = NULL,"
+                " lease_expires = NULL, updated = ? WHERE id = ? AND status != 'done'",
+                (json.dumps(result), time.time(), item_id))
+            return cursor.rowcount == 1
+
+    def fail(self, item_id: int, owner: str, error: str, retry: bool = True):
+        """Release a leased item after an error. It is claimed again later if `retry` and
+        it has attempts left, otherwise it is marked failed."""
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE items SET status = CASE WHEN ? AND attempts < ? THEN 'pending'"
+                " ELSE 'failed' END, error = ?, owner = NULL, lease_expires = NULL, updated = ?"
+                " WHERE id = ? AND status = 'leased' AND owner = ?",
+                (retry, self.max_attempts, error, time.time(), item_id, owner))
+
+    def reset_failed(self) -> int:
+        """Return the failed items to pending with their attempts reset."""
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE items SET status = 'pending', attempts = 0, updated = ?"
+                " WHERE status = 'failed'", (time.time(), )).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of items per status."""
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(self.db.execute("SELECT status, COUNT(*) FROM items GROUP BY status"))
+        return counts
+
+    def is_finished(self) -> bool:
+        """Tell if no item is pending or leased."""
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["leased"] == 0
+
+    def results(self) -> Iterator[Tuple[str, object, object]]:
+        """Iterate over (key, payload, result) of the done items, in insertion order."""
+        rows = self.db.execute(
+            "SELECT key, payload, result FROM items WHERE status = 'done' ORDER BY id")
+        for key, payload, result in rows:
+            yield key, json.loads(payload), json.loads(result)
+
+    def errors(self) -> Iterator[Tuple[str, object, str]]:
+        """Iterate over (key, payload, error) of the failed items, in insertion order."""
+        rows = self.db.execute(
+            "SELECT key, payload, error FROM items WHERE status = 'failed' ORDER BY id")
+        for key, payload, error in rows:
+            yield key, json.loads(payload), error
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Manage a T-Rex2 work queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser(
+        "add", help="Add the requests of a JSON lines file, one request per line")
+    add_parser.add_argument("queue", type=str, help="Path of the queue database")
+    add_parser.add_argument("requests", type=str, help="JSON lines file of requests")
+    add_parser.add_argument("--key_field",
+                            type=str,
+                            default=None,
+                            help="field of the lines used as unique key, the request is "
+                            "then read from the 'request' field")
+    status_parser = subparsers.add_parser("status", help="Print the number of items per status")
+    status_parser.add_argument("queue", type=str, help="Path of the queue database")
+    export_parser = subparsers.add_parser("export", help="Write the results as JSON lines")
+    export_parser.add_argument("queue", type=str, help="Path of the queue database")
+    export_parser.add_argument("output", type=str, help="Path of the JSON lines output")
+    retry_parser = subparsers.add_parser("retry", help="Requeue the failed items")
+    retry_parser.add_argument("queue", type=str, help="Path of the queue database")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    queue = WorkQueue(args.queue)
+    if args.command == "add":
+        with open(args.requests) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if args.key_field is not None:
+            num_added = queue.add([line["request"] for line in lines],
+                                  [str(line[args.key_field]) for line in lines])
+        else:
+            num_added = queue.add(lines)
+        print(f"Added {num_added} of {len(lines)} requests")
+    elif args.command == "status":
+        print(json.dumps(queue.counts()))
+    elif args.command == "export":
+        with open(args.output, "w") as f:
+            for key, payload, result in queue.results():
+                f.write(json.dumps({"key": key, "request": payload, "result": result}) + "\n")
+    else:
+        print(f"Requeued {queue.reset_failed()} failed items")
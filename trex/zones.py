@@ -0,0 +1,224 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from .box_ops import BOX_ANCHORS, box_anchors
+from .detections import DetectionBatch, as_detection_batch
+
+# maximum number of (point, edge) pairs tested at once, bounds the memory of `contains`
+CHUNK_SIZE = 1 << 22
+
+
+def anchor_pixels(boxes: np.ndarray, anchor: str = "bottom_center") -> np.ndarray:
+    """Compute the pixel holding the anchor point of every box. An anchor on the right or
+    bottom edge of a box is in the last pixel of the box rather than in the next one, so
+    that e.g. the bottom center of a box touching the bottom of the frame is in the frame.
+
+    Args:
+        boxes (np.ndarray): Boxes in shape (N, 4), [x1, y1, x2, y2] format.
+        anchor (str): One of the keys of `trex.box_ops.BOX_ANCHORS`. Defaults to
+            "bottom_center".
+
+    Returns:
+        np.ndarray: Pixel indices in shape (N, 2), [x, y] format.
+    """
+    points = box_anchors(boxes, anchor)
+    ends = np.array(BOX_ANCHORS[anchor]) == 1.0
+    return np.where(ends, np.ceil(points) - 1, np.floor(points)).astype(np.int64)
+
+
+class ZoneLookup(ABC):
+    """Base class of the zone tests, subclasses implement `contains`.
+
+    All the lookups share one boundary rule: a point is in a zone when the center of the
+    pixel holding it is inside the polygon of the zone, by ray casting. Pixel centers are
+    never on the edges of polygons with integer vertices, so a point on the border of two
+    adjacent zones is in exactly one of them, and `Zones` and `ZoneRaster` always agree.
+
+    Args:
+        num_zones (int): Number of zones.
+        names (List[str]): Name of each zone. Defaults to None, which names the zones by
+            their index.
+        anchor (str): Point of the boxes tested against the zones, one of the keys of
+            `trex.box_ops.BOX_ANCHORS`. Defaults to "bottom_center".
+    """
+
+    def __init__(self, num_zones: int, names: List[str] = None, anchor: str = "bottom_center"):
+        self.names = list(names) if names is not None else [str(i) for i in range(num_zones)]
+        assert len(self.names) == num_zones, "There must be one name per zone"
+        self.anchor = anchor
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @abstractmethod
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        """Test points against all the zones.
+
+        Args:
+            points (np.ndarray): Points in shape (N, 2), [x, y] format.
+
+        Returns:
+            np.ndarray: Membership mask in shape (N, Z), bool.
+        """
+
+    def membership(self, boxes: np.ndarray) -> np.ndarray:
+        """Membership mask in shape (N, Z) of the anchor points of boxes in shape (N, 4),
+        see `anchor_pixels`."""
+        return self.contains(anchor_pixels(boxes, self.anchor) + 0.5)
+
+    def count(self, results: Union[Dict, List[Dict], DetectionBatch]
+              ) -> Tuple[np.ndarray, np.ndarray]:
+        """Count the detections of every image in every zone.
+
+        Args:
+            results (Union[Dict, List[Dict], DetectionBatch]): Detections of one or several
+                images, in the format returned by `postprocess` or as a `DetectionBatch`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Counts in shape (B, Z) and membership mask in
+                shape (N, Z) of all the detections, concatenated in image order.
+        """
+        batch = as_detection_batch(results)
+        masks = self.membership(batch.boxes)
+        # flat (image, zone) index of every detection inside a zone
+        cells = batch.image_ids[:, None] * len(self) + np.arange(len(self))
+        counts = np.bincount(cells[masks], minlength=len(batch) * len(self))
+        return counts.reshape(len(batch), len(self)), masks
+
+    def count_dict(self, result: Dict) -> Dict[str, int]:
+        """Count the detections of one image per zone name."""
+        counts, _ = self.count(result)
+        return dict(zip(self.names, counts[0].tolist()))
+
+
+class Zones(ZoneLookup):
+    """Polygon zones, e.g. lanes, shelves or entrances, tested with a vectorized ray
+    casting over all the points, zones and edges at once.
+
+    Args:
+        polygons (Sequence): Polygons, each one an array-like of vertices in shape (V, 2),
+            [x, y] format, in image coordinates.
+        names (List[str]): Name of each zone. Defaults to None.
+        anchor (str): Point of the boxes tested against the zones. Defaults to
+            "bottom_center".
+    """
+
+    def __init__(self,
+                 polygons: Sequence,
+                 names: List[str] = None,
+                 anchor: str = "bottom_center"):
+        super().__init__(len(polygons), names, anchor)
+        self.polygons = [np.asarray(polygon, dtype=np.float32).reshape(-1, 2)
+                         for polygon in polygons]
+        assert all(len(polygon) >= 3 for polygon in self.polygons), \
+            "Polygons need at least 3 vertices"
+        # edges of all the polygons padded to the same count, padding edges are
+        # horizontal and never crossed
+        num_edges = max((len(polygon) for polygon in self.polygons), default=3)
+        self.starts = np.zeros((len(self.polygons), num_edges, 2), dtype=np.float32)
+        self.ends = np.zeros_like(self.starts)
+        for i, polygon in enumerate(self.polygons):
+            self.starts[i, :len(polygon)] = polygon
+            self.ends[i, :len(polygon)] = np.roll(polygon, -1, axis=0)
+        slopes = self.ends - self.starts
+        crossable = slopes[..., 1] != 0
+        # x step per unit of y of every crossable edge
+        self.inverse_slopes = np.where(crossable, slopes[..., 0] /
+                                       np.where(crossable, slopes[..., 1], 1), 0)
+        self.crossable = crossable
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        # test the center of the pixel of every point
+        points = np.floor(np.asarray(points, dtype=np.float32).reshape(-1, 2)) + 0.5
+        masks = np.zeros((len(points), len(self)), dtype=bool)
+        chunk = max(CHUNK_SIZE // max(self.starts.shape[0] * self.starts.shape[1], 1), 1)
+        x1, y1 = self.starts[..., 0], self.starts[..., 1]
+        y2 = self.ends[..., 1]
+        for begin in range(0, len(points), chunk):
+            px = points[begin:begin + chunk, 0, None, None]
+            py = points[begin:begin + chunk, 1, None, None]
+            # the horizontal ray from the point crosses the edge
+            spans = (y1 > py) != (y2 > py)
+            crossings = spans & self.crossable & (px < x1 + (py - y1) * self.inverse_slopes)
+            masks[begin:begin + chunk] = np.bitwise_xor.reduce(crossings, axis=2)
+        return masks
+
+    def rasterize(self, image_size: Tuple[int, int]) -> "ZoneRaster":
+        """Precompute a lookup mask of the zones for a fixed camera geometry, which turns
+        every test into one array lookup.
+
+        Args:
+            image_size (Tuple[int, int]): (width, height) of the frames.
+
+        Returns:
+            ZoneRaster: Lookup of the zones with the same names and anchor.
+        """
+        return ZoneRaster.from_polygons(self.polygons, image_size, self.names, self.anchor)
+
+
+class ZoneRaster(ZoneLookup):
+    """Zones rasterized in a per pixel bit mask, bit `z` of a pixel is set when the center
+    of the pixel is in zone `z`. Points outside of the image are in no zone.
+
+    Args:
+        bits (np.ndarray): Bit masks in shape (H, W), unsigned integers.
+        names (List[str]): Name of each zone, at most 64 zones.
+        anchor (str): Point of the boxes tested against the zones. Defaults to
+            "bottom_center".
+    """
+
+    def __init__(self, bits: np.ndarray, names: List[str], anchor: str = "bottom_center"):
+        assert len(names) <= 64, "Rasterized zones are limited to 64"
+        super().__init__(len(names), names, anchor)
+        self.bits = bits
+
+    @classmethod
+    def from_polygons(cls,
+                      polygons: Sequence,
+                      image_size: Tuple[int, int],
+                      names: List[str] = None,
+                      anchor: str = "bottom_center") -> "ZoneRaster":
+        """Rasterize polygons, see `Zones` for the arguments."""
+        num_zones = len(polygons)
+        assert num_zones <= 64, "Rasterized zones are limited to 64"
+        dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                     if np.iinfo(dtype).bits >= num_zones)
+        width, height = image_size
+        bits = np.zeros((height, width), dtype=dtype)
+        if num_zones:
+            # the same test as `Zones.contains` on every pixel, a band of rows at a time
+            zones = Zones(polygons)
+            band = max(CHUNK_SIZE // max(width * zones.starts.size, 1), 1)
+            for top in range(0, height, band):
+                rows = slice(top, min(top + band, height))
+                ys, xs = np.mgrid[rows, :width]
+                masks = zones.contains(np.stack([xs.ravel(), ys.ravel()], axis=1))
+                masks = masks.reshape(ys.shape + (num_zones, ))
+                for i in range(num_zones):
+                    bits[rows] |= masks[..., i].astype(dtype) << dtype(i)
+        if names is None:
+            names = [str(i) for i in range(num_zones)]
+        return cls(bits, names, anchor)
+
+    @property
+    def image_size(self) -> Tuple[int, int]:
+        return self.bits.shape[1], self.bits.shape[0]
+
+    def zone_mask(self, zone: Union[int, str]) -> np.ndarray:
+        """Boolean mask in shape (H, W) of one zone, by index or name."""
+        if isinstance(zone, str):
+            zone = self.names.index(zone)
+        return (self.bits >> self.bits.dtype.type(zone)) & 1 == 1
+
+    def contains(self, points: np.ndarray) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        height, width = self.bits.shape
+        xs = np.floor(points[:, 0]).astype(np.int64)
+        ys = np.floor(points[:, 1]).astype(np.int64)
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        bits = np.zeros(len(points), dtype=self.bits.dtype)
+        bits[inside] = self.bits[ys[inside], xs[inside]]
+        shifts = np.arange(len(self), dtype=self.bits.dtype)
+        return (bits[:, None] >> shifts) & 1 == 1